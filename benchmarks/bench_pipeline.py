@@ -0,0 +1,297 @@
+"""Benchmark of the cell query pipeline: parse -> fetch -> decode -> DataFrame.
+
+Runs UserInputParser.parse_input, MongoAPI.find, ResponseParser._handler and
+the final pd.DataFrame wrap from Mongo.customQuery against a stand-in server,
+over synthetic collections (flat, wide and nested documents) of growing size.
+Each case runs in a fresh interpreter so its peak RSS is its own, and reports
+docs/sec, peak RSS and the time spent in each stage.
+
+The default stand-in is an in-process fake that serves pre-encoded BSON
+batches, so "fetch + decode" measures real BSON decoding without a network.
+Use --backend mongomock to go through mongomock instead. With the fake,
+--raw measures the bson.decode_all raw path, since pymongoarrow needs a
+real collection.
+
+Usage: python benchmarks/bench_pipeline.py [--shapes flat,wide,nested]
+    [--sizes 1000,10000,100000] [--raw] [--infer-dtypes] [--backend fake|mongomock]
+    [--json PATH]
+"""
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+
+# Synthetic documents #
+
+def flat_document(i):
+    return {
+        "_id": i,
+        "name": f"user_{i % 5000}",
+        "status": ("active", "inactive", "pending")[i % 3],
+        "age": 18 + i % 60,
+        "score": (i * 7919 % 10000) / 100,
+        "verified": i % 2 == 0,
+        "created": datetime(2020, 1, 1) + timedelta(seconds=i),
+        "country": ("US", "DE", "FR", "JP", "BR")[i % 5],
+        "visits": i % 1000,
+        "ratio": (i % 97) / 97
+    }
+
+
+def wide_document(i):
+    document = {"_id": i}
+    for field in range(200):
+        document[f"f{field}"] = (i + field) % 1000 if field % 2 else f"v{(i + field) % 50}"
+    return document
+
+
+def nested_document(i):
+    return {
+        "_id": i,
+        "user": {
+            "name": f"user_{i % 5000}",
+            "address": {"city": ("Berlin", "Paris", "Tokyo")[i % 3], "zip": f"{i % 99999:05d}",
+                        "geo": {"lat": (i % 180) - 90.0, "lon": (i % 360) - 180.0}}
+        },
+        "tags": [f"t{i % 10}", f"t{i % 7}", f"t{i % 3}"],
+        "events": [{"type": "click", "ts": datetime(2020, 1, 1) + timedelta(seconds=i + n)} for n in range(3)],
+        "metrics": {"a": i % 10, "b": {"c": i % 100, "d": {"e": i % 1000}}}
+    }
+
+
+SHAPES = {"flat": flat_document, "wide": wide_document, "nested": nested_document}
+
+
+# In-process stand-in server #
+
+class FakeCursor:
+    """Serves pre-encoded BSON batches, decoding each one like pymongo does per server batch"""
+
+    def __init__(self, raw_batches, raw=False):
+        self.raw_batches = raw_batches
+        self.raw = raw
+        self.cursor_id = 1
+        self.documents = self._documents()
+
+    def _documents(self):
+        import bson
+
+        for raw_batch in self.raw_batches:
+            if self.raw:
+                yield raw_batch
+            else:
+                yield from bson.decode_all(raw_batch)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.documents)
+
+    def close(self):
+        self.cursor_id = 0
+
+
+class FakeCollection:
+    def __init__(self, raw_batches):
+        import bson
+
+        self.raw_batches = raw_batches
+        self.codec_options = bson.DEFAULT_CODEC_OPTIONS
+
+    def find(self, *args, **kwargs):
+        return FakeCursor(self.raw_batches)
+
+    def find_raw_batches(self, *args, **kwargs):
+        return FakeCursor(self.raw_batches, raw=True)
+
+
+class FakeDatabase:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getitem__(self, name):
+        return self.collection
+
+
+class FakeClient:
+    """client[database][collection] returns the one collection, whatever the names"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getitem__(self, name):
+        return FakeDatabase(self.collection)
+
+
+def encode_batches(shape, size, batch_size):
+    import bson
+
+    make_document = SHAPES[shape]
+    return [b"".join(bson.encode(make_document(i)) for i in range(start, min(start + batch_size, size)))
+            for start in range(0, size, batch_size)]
+
+
+def make_session(backend, shape, size, batch_size):
+    from mongo_utils.mongo_api import MongoAPI
+
+    api = MongoAPI.__new__(MongoAPI)
+    api.new_client = False
+
+    if backend == "mongomock":
+        import mongomock
+
+        api.session = mongomock.MongoClient()
+        collection = api.session["bench"]["bench"]
+        make_document = SHAPES[shape]
+        for start in range(0, size, batch_size):
+            collection.insert_many([make_document(i) for i in range(start, min(start + batch_size, size))])
+    else:
+        api.session = FakeClient(FakeCollection(encode_batches(shape, size, batch_size)))
+
+    return api
+
+
+# Timing #
+
+class TimedStream:
+    """Wraps a stream, adding the time spent pulling each batch (fetch + decode) to stages"""
+
+    def __init__(self, stream, stages):
+        self.stream = stream
+        self.stages = stages
+
+    def __iter__(self):
+        iterator = iter(self.stream)
+        while True:
+            start = time.perf_counter()
+            batch = next(iterator, None)
+            self.stages["fetch_decode"] += time.perf_counter() - start
+            if batch is None:
+                return
+            yield batch
+
+
+def current_rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_case(backend, shape, size, batch_size, raw, infer_dtypes=False):
+    import pandas as pd
+    from mongo_utils.user_input_parser import UserInputParser
+    from mongo_utils.api_response_parser import ResponseParser
+
+    if raw and backend == "fake":
+        # pymongoarrow needs a real collection, so the fake measures the bson.decode_all raw path
+        sys.modules["pymongoarrow.api"] = None
+
+    session = make_session(backend, shape, size, batch_size)
+    baseline = current_rss() if Path("/proc/self/statm").exists() else peak_rss()
+
+    stages = {"parse": 0.0, "fetch_decode": 0.0, "build": 0.0, "dataframe": 0.0}
+    cell = f"find -i bench -d bench -c bench -b {batch_size}{' --raw' if raw else ''}\n{{}}"
+
+    start = time.perf_counter()
+    parsed_input = UserInputParser().parse_input(cell, type="cell")
+    stages["parse"] = time.perf_counter() - start
+
+    query_input = dict(parsed_input["input"], infer_dtypes=infer_dtypes)
+
+    start = time.perf_counter()
+    response = session._handler(**query_input)
+    if not hasattr(response, "to_pandas"):
+        response = TimedStream(response, stages)
+    parsed_response = ResponseParser()._handler(response, **query_input)
+    stages["build"] = time.perf_counter() - start - stages["fetch_decode"]
+
+    start = time.perf_counter()
+    dataframe = pd.DataFrame(parsed_response)
+    stages["dataframe"] = time.perf_counter() - start
+
+    total = sum(stages.values())
+
+    return {
+        "backend": backend,
+        "shape": shape,
+        "documents": size,
+        "batch_size": batch_size,
+        "raw": raw,
+        "infer_dtypes": infer_dtypes,
+        "rows": len(dataframe),
+        "columns": len(dataframe.columns),
+        "seconds": total,
+        "docs_per_sec": size / total if total else None,
+        "stages": stages,
+        "baseline_rss": baseline,
+        "peak_rss": peak_rss(),
+        "peak_rss_delta": peak_rss() - baseline,
+        "dataframe_bytes": int(dataframe.memory_usage(index=True, deep=True).sum())
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shapes", default="flat,wide,nested", help="comma separated document shapes")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated collection sizes, up to 10^7")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--raw", action="store_true", help="use the raw BSON batch path (find --raw)")
+    parser.add_argument("--infer-dtypes", action="store_true", help="build typed columns, like the infer_dtypes opt")
+    parser.add_argument("--backend", choices=["fake", "mongomock"], default="fake")
+    parser.add_argument("--json", help="write the results to this file as JSON")
+    parser.add_argument("--run-case", nargs=2, metavar=("SHAPE", "SIZE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        shape, size = args.run_case
+        print(json.dumps(run_case(args.backend, shape, int(float(size)), args.batch_size, args.raw,
+                                  args.infer_dtypes)))
+        return
+
+    results = []
+
+    print(f"{'shape':<8}{'docs':>10}{'docs/sec':>12}{'total s':>9}{'parse':>8}{'fetch+dec':>11}{'build':>8}"
+          f"{'frame':>8}{'peak MB':>9}{'delta MB':>10}{'df MB':>8}")
+
+    for shape in args.shapes.split(","):
+        for size in args.sizes.split(","):
+            command = [sys.executable, __file__, "--run-case", shape, size, "--batch-size", str(args.batch_size),
+                       "--backend", args.backend] + (["--raw"] if args.raw else []) + \
+                (["--infer-dtypes"] if args.infer_dtypes else [])
+            output = subprocess.run(command, cwd=ROOT, capture_output=True, text=True, check=True)
+            result = json.loads(output.stdout.strip().splitlines()[-1])
+            results.append(result)
+
+            stages = result["stages"]
+            mb = 1024 * 1024
+            print(f"{shape:<8}{result['documents']:>10}{result['docs_per_sec']:>12.0f}{result['seconds']:>9.3f}"
+                  f"{stages['parse']:>8.4f}{stages['fetch_decode']:>11.3f}{stages['build']:>8.3f}"
+                  f"{stages['dataframe']:>8.3f}{result['peak_rss'] / mb:>9.1f}{result['peak_rss_delta'] / mb:>10.1f}"
+                  f"{result['dataframe_bytes'] / mb:>8.1f}")
+
+    if args.json:
+        report = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "created": datetime.now().isoformat(),
+            "results": results
+        }
+        Path(args.json).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Micro-benchmark of the cell query parser against the previous
+regex + json + ast implementation of UserInputParser.transform_query.
+
+Usage: python benchmarks/bench_query_parser.py [--repeat N] [--json PATH]
+"""
+import argparse
+import ast
+import json
+import re
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from mongo_utils.query_parser import QueryParser, parse_query  # noqa: E402
+
+
+def legacy_transform_query(query):
+    """The transform_query implementation this parser replaced"""
+    split_query = re.split(r"(?<=\})\s{0,}\,\s{0,}(?=\{)", query)
+    return list(map(lambda q: ast.literal_eval(json.loads(json.dumps(q))), split_query))
+
+
+def make_queries():
+    ids = ", ".join(f"'{i:024x}'" for i in range(50000))
+    numbers = ", ".join(str(i) for i in range(50000))
+
+    return {
+        "small filter": "{'status': 'active', 'age': {'$gte': 21}}",
+        "filter + projection": "{'status': 'active'}, {'name': 1, 'address.city': 1, '_id': 0}",
+        "nested $or": "{'$or': [" + ", ".join(f"{{'field_{i}': {{'$in': [1, 2, 3]}}}}" for i in range(200)) + "]}",
+        "$in 50k strings": "{'_id': {'$in': [" + ids + "]}}",
+        "$in 50k numbers": "{'n': {'$in': [" + numbers + "]}}",
+    }
+
+
+def bench(function, query, repeat):
+    timer = timeit.Timer(lambda: function(query))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="write the results to this file as JSON")
+    args = parser.parse_args()
+
+    results = []
+
+    for name, query in make_queries().items():
+        # The legacy parser splits on every "}, {", so it fails on some queries, e.g. lists of documents
+        try:
+            legacy_result = legacy_transform_query(query)
+        except SyntaxError:
+            legacy_result = None
+
+        if legacy_result is not None and legacy_result != parse_query(query):
+            raise AssertionError(f"parsers disagree on {name!r}")
+
+        legacy = bench(legacy_transform_query, query, args.repeat) if legacy_result is not None else None
+        uncached = bench(lambda q: QueryParser(q).parse(), query, args.repeat)
+        cached = bench(parse_query, query, args.repeat)
+
+        results.append({
+            "query": name,
+            "chars": len(query),
+            "legacy_ms": legacy * 1000 if legacy is not None else None,
+            "parser_ms": uncached * 1000,
+            "memoized_ms": cached * 1000,
+            "speedup": legacy / uncached if legacy is not None else None
+        })
+
+    print(f"{'query':<22}{'chars':>10}{'legacy ms':>12}{'parser ms':>12}{'memoized ms':>14}{'speedup':>10}")
+    for row in results:
+        legacy = f"{row['legacy_ms']:>12.3f}" if row["legacy_ms"] is not None else f"{'fails':>12}"
+        speedup = f"{row['speedup']:>9.1f}x" if row["speedup"] is not None else f"{'-':>10}"
+        print(f"{row['query']:<22}{row['chars']:>10}{legacy}{row['parser_ms']:>12.3f}"
+              f"{row['memoized_ms']:>14.4f}{speedup}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
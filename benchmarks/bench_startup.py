@@ -0,0 +1,96 @@
+"""Startup timing benchmark: how long importing the extension's modules
+takes in a fresh interpreter, which heavy dependencies each import pulls
+in, and how long building a UserInputParser takes the first time and
+once the argparse trees are shared.
+
+Usage: python benchmarks/bench_startup.py [--runs N] [--json PATH]
+"""
+import argparse
+import json
+import subprocess
+import sys
+import timeit
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+MODULES = [
+    "mongo_core",
+    "mongo_utils.mongo_api",
+    "mongo_utils.user_input_parser",
+    "mongo_utils.api_response_parser",
+    "mongo_core.mongo_full"
+]
+
+HEAVY_MODULES = ["pandas", "numpy", "pymongo", "bson", "pyarrow", "pymongoarrow", "integration_core"]
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+try:
+    import {module}
+    error = None
+except Exception as e:
+    error = repr(e)
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "error": error, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def time_import(module, runs):
+    """Import a module in fresh interpreters, keeping the fastest run"""
+
+    best = None
+
+    for _ in range(runs):
+        script = IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+        output = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True)
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+
+    return best
+
+
+def time_parser_construction():
+    """Time the first UserInputParser, which builds the argparse trees, and a later one"""
+
+    from mongo_utils.user_input_parser import UserInputParser
+
+    UserInputParser._shared_parsers = None
+    first = timeit.timeit(UserInputParser, number=1)
+    shared = timeit.timeit(UserInputParser, number=100) / 100
+
+    return {"first_ms": first * 1000, "shared_ms": shared * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per module, the fastest is kept")
+    parser.add_argument("--json", help="write the results to this file as JSON")
+    args = parser.parse_args()
+
+    results = {"imports": {}, "user_input_parser": time_parser_construction()}
+
+    print(f"{'module':<34}{'import ms':>12}  heavy modules loaded")
+    for module in MODULES:
+        result = time_import(module, args.runs)
+        results["imports"][module] = result
+
+        if result["error"]:
+            print(f"{module:<34}{'-':>12}  not importable here: {result['error']}")
+        else:
+            print(f"{module:<34}{result['seconds'] * 1000:>12.1f}  {', '.join(result['loaded']) or '-'}")
+
+    construction = results["user_input_parser"]
+    print(f"\nUserInputParser(): first {construction['first_ms']:.2f} ms, "
+          f"shared {construction['shared_ms']:.4f} ms")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import importlib
 from IPython.core.magic import (Magics, magics_class, line_cell_magic)
 from mongo_core._version import __desc__
 import jupyter_integrations_utility as jiu
@@ -52,11 +53,14 @@ class Mongo(Magics):
             else:
                 if self.debug:
                     jiu.displayMD(f"**[ Dbg ]** Loading full {self.name_str} from base")
-                full_load = (f"from {self.name_str}_core.{self.name_str}_full import {self.name_str.capitalize()}\n"
-                             f"{self.name_str}_full = {self.name_str.capitalize()}(ipy, debug={str(self.debug)})\n"
-                             f"ipy.register_magics({self.name_str}_full)\n")
+                # Import and register the full integration directly, rather than executing
+                # the import code in the user's namespace
+                full_module = f"{self.name_str}_core.{self.name_str}_full"
                 if self.debug:
-                    jiu.displayMD("**[ Dbg ]** Load Code: {full_load}")
-                self.shell.ex(full_load)
+                    jiu.displayMD(f"**[ Dbg ]** Loading: {full_module}.{self.name_str.capitalize()}")
+                full_class = getattr(importlib.import_module(full_module), self.name_str.capitalize())
+                full_integration = full_class(self.shell, debug=self.debug)
+                self.shell.user_ns[f"{self.name_str}_full"] = full_integration
+                self.shell.register_magics(full_integration)
                 self.shell.user_ns['jupyter_loaded_integrations'][self.name_str] = f"{self.name_str}_full"
                 self.shell.run_cell_magic(self.name_str, line, cell)
@@ -1,12 +1,20 @@
-import pandas as pd
+import os
+import tempfile
+import time
 from IPython.core.magic import (magics_class, line_cell_magic)
-from pymongo.errors import OperationFailure, ConnectionFailure
 from mongo_core._version import __desc__
 from integration_core import Integration
 import jupyter_integrations_utility as jiu
 from mongo_utils.mongo_api import MongoAPI
 from mongo_utils.user_input_parser import UserInputParser
 from mongo_utils.api_response_parser import ResponseParser
+from mongo_utils.result_cache import ResultCache
+from mongo_utils.background import BackgroundQueries
+from mongo_utils.catalog import MetadataCatalog
+from mongo_utils.incremental import IncrementalResults
+from mongo_utils.paged_result import PagedResult
+from mongo_utils.query_stats import query_stats
+from mongo_utils.spill import SpilledResult
 
 
 @magics_class
@@ -15,16 +23,50 @@ class Mongo(Integration):
     # The name of the integration
     name_str = "mongo"
     instances = {}
-    custom_evars = ["mongo_conn_default", "server_selection_timeout"]
+    custom_evars = ["mongo_conn_default", "server_selection_timeout", "find_batch_size", "cache_max_mb", "cache_ttl",
+                    "stats_history", "stats_track_bytes", "spill_dir", "spill_threshold_mb", "infer_dtypes",
+                    "objectid_dtype", "catalog_ttl", "max_result_docs", "max_result_mb", "default_max_time_ms",
+                    "preflight_count"]
 
     # These are the variables in the opts dict that allowed to be set by the user.
     # These are specific to this custom integration and are joined
     # with the base_allowed_set_opts from the integration base
-    custom_allowed_set_opts = ["mongo_conn_default", "server_selection_timeout"]
+    custom_allowed_set_opts = ["mongo_conn_default", "server_selection_timeout", "find_batch_size", "cache_max_mb",
+                               "cache_ttl", "stats_history", "stats_track_bytes", "spill_dir", "spill_threshold_mb",
+                               "infer_dtypes", "objectid_dtype", "catalog_ttl", "max_result_docs", "max_result_mb",
+                               "default_max_time_ms", "preflight_count"]
 
     myopts = {}
     myopts["mongo_conn_default"] = ["default", "Default instance to connect with"]
     myopts["server_selection_timeout"] = [5, "Time (in seconds) to wait while attempting to connect to an instance"]
+    myopts["find_batch_size"] = [10000, "Number of documents pulled from the cursor per batch when building a find \
+        result"]
+    myopts["cache_max_mb"] = [512, "Memory budget (in MB) for cached query results. 0 disables the cache"]
+    myopts["cache_ttl"] = [600, "Time (in seconds) a cached query result stays valid. 0 disables the cache"]
+    myopts["stats_history"] = [1000, "Number of queries kept in the history shown by %mongo stats"]
+    myopts["stats_track_bytes"] = [0, "Set to 1 to measure the size of every server reply in %mongo stats. \
+        Costs re-encoding each reply, raw (--raw) queries are always measured"]
+    myopts["spill_dir"] = [os.path.join(tempfile.gettempdir(), "jupyter_mongo_spill"), "Directory find and \
+        aggregate results are spilled to with --spill or past spill_threshold_mb"]
+    myopts["spill_threshold_mb"] = [0, "Estimated in-memory size (in MB) past which a find or aggregate result is \
+        spilled to disk. 0 only spills with --spill"]
+    myopts["infer_dtypes"] = [1, "Set to 0 to keep find and aggregate values as Python objects instead of inferring \
+        compact dtypes (categoricals, int32, float32, ...) from each batch"]
+    myopts["objectid_dtype"] = ["string", "How ObjectIds are stored when infer_dtypes is on: string, bytes (12 byte \
+        values) or object (ObjectId instances)"]
+    myopts["catalog_ttl"] = [300, "Time (in seconds) before database and collection listings, and collection \
+        stats, are refreshed in the background. 0 lists them from the server every time"]
+    myopts["max_result_docs"] = [0, "Number of documents past which a find, aggregate or value_counts is aborted \
+        while it streams (or refused before it runs, see preflight_count). 0 for no limit. Lift it for one query \
+        with --no-guardrails"]
+    myopts["max_result_mb"] = [4096, "Size (in BSON MB, measured as it streams) past which an in-memory find, \
+        aggregate or value_counts result is aborted (or refused before it runs, see preflight_count). 0 for no \
+        limit. Results spilled to disk aren't limited"]
+    myopts["default_max_time_ms"] = [0, "Time limit (in milliseconds) on the server for cell commands without \
+        --max-time-ms. 0 for no limit"]
+    myopts["preflight_count"] = [0, "1 to count the documents a find matches (for up to 2 s) before it runs, and \
+        refuse it if it's over the max_result_docs or max_result_mb budget. 0 only aborts queries once they stream \
+        past the budgets. Ask for the count on one query with --preflight"]
     instvars = ["noAuth", "noPass", "namedpw"]
 
     # Class Init function - Obtain a reference to the get_ipython()
@@ -38,6 +80,26 @@ class Mongo(Integration):
 
         self.user_input_parser = UserInputParser()
         self.response_parser = ResponseParser()
+        self.result_cache = ResultCache()
+        self.background_queries = BackgroundQueries()
+        self.incremental_results = IncrementalResults()
+        self.catalog = MetadataCatalog()
+        self.query_stats = query_stats
+        self.spilled_results = 0
+        self.paged_results = 0
+        self.local_line_commands = {
+            "cache": self.handleCacheCommand,
+            "jobs": self.handleJobsCommand,
+            "cancel": self.handleCancelCommand,
+            "stats": self.handleStatsCommand,
+            "insert_df": self.handleInsertCommand,
+            "show_dbs": self.handleShowDbsCommand,
+            "show_collections": self.handleShowCollectionsCommand
+        }
+
+        # Complete -i, -d and -c in %mongo lines and %%mongo cells from the metadata catalog
+        if getattr(shell, "Completer", None) is not None:
+            shell.Completer.custom_matchers.append(self.completeMetadata)
         self.load_env(self.custom_evars)
         self.parse_instances()
 
@@ -72,14 +134,71 @@ class Mongo(Integration):
                             "| %%mongo instance<br>find -i instance -d database -c collection<br>{'field': \
                                 {'eq': 'value'}} | Execute a `find()` command against a MongoDB collection. \
                                     Supports an optional filter. **Don't wrap in quotes.** |\n"
+                            "| %%mongo instance<br>find -i instance -d database -c collection --fields name,ts \
+                                --sort ts:-1 --limit 100<br>{'field': {'eq': 'value'}} | Push the projection, sort, \
+                                skip, limit, hint and max time down to the server. Also supported by `find_one`. \
+                                See `find --help` |\n"
+                            "| %%mongo instance<br>find -i instance -d database -c collection --spill --as big<br>{} \
+                                | Write the result to local disk (Arrow IPC, or Parquet with `--spill-format`) and \
+                                bind a lazily loaded handle to `big`. Results past the `spill_threshold_mb` opt are \
+                                spilled automatically. Also supported by `aggregate` |\n"
+                            "| %%mongo instance<br>find -i instance -d database -c collection --preview 50 \
+                                --as page<br>{} | Fetch only the first 50 documents and bind a handle on the \
+                                open cursor to `page`. The next page is fetched in the background while one is \
+                                shown, see `page.next()`, `page.page(n)` and `page.to_pandas()`. Also supported \
+                                by `aggregate` |\n"
+                            "| %%mongo instance<br>find -i instance -d database -c events --as events \
+                                --incremental ts --follow<br>{'type': 'click'} | Keep `events` and, when the cell \
+                                is re-run, only fetch the documents past the highest `ts` (default: `_id`) fetched \
+                                so far and append them. `--follow` also appends new inserts from a change stream \
+                                in the background |\n"
+                            "| %%mongo instance<br>find -i instance -d database -c collection --no-guardrails<br>{} \
+                                | Lift the `max_result_docs` and `max_result_mb` budgets for one query. Queries \
+                                that grow past them while streaming are aborted and their cursor killed, and with \
+                                `--preflight` (or the `preflight_count` opt) finds over them are refused before they \
+                                run. `default_max_time_ms` limits every command \
+                                without `--max-time-ms` |\n"
+                            "| %%mongo instance<br>find -i instance -d database -c collection --flatten \
+                                --arrays explode --fields user.name,events<br>{} | Expand sub-documents into \
+                                dotted-path columns while the result is built. Arrays are kept, joined or \
+                                exploded into a row per element. Also supported by `find_one` and `aggregate` |\n"
                             "| %%mongo instance<br>find_one -i instance -d database -c collection<br>{'field': \
                                 {'eq': 'value'}}  | Get a single document from a collection by executing a \
                                 MongoDB `find_one()` command. Supports an optional filter. \
                                 **Don't wrap in quotes.** |\n"
+                            "| %%mongo instance<br>aggregate -i instance -d database -c collection \
+                                --allow-disk-use<br>[{'$match': {'field': 'value'}}, {'$group': {'_id': '$other', \
+                                'n': {'$sum': 1}}}] | Run an aggregation pipeline on the server and stream the \
+                                results into a dataframe. **Don't wrap in quotes.** |\n"
+                            "| %%mongo instance<br>explain find -i instance -d database -c collection \
+                                --sort ts:-1<br>{'field': 'value'} | Show the query plan of a `find`, \
+                                `count_documents` or `aggregate` with its execution stats. Warns about collection \
+                                scans and in-memory sorts, and suggests an index |\n"
+                            "| %%mongo instance<br>export -i instance -d database -c collection -o \
+                                events.parquet --compression zstd --fields ts,user.name<br>{'type': 'click'} | \
+                                Stream the result to a local csv, jsonl or parquet file (optionally compressed, e.g. \
+                                `-o events.csv.gz`) without building a dataframe, in constant memory. Reports the \
+                                rows and MB written per second. Supports the pushdown options of `find` |\n"
+                            "| %%mongo instance<br>distinct status -i instance -d database -c collection<br>{'type': \
+                                'click'} | List the distinct values of a field on the server, without fetching the \
+                                documents. `--limit` returns only the first values |\n"
+                            "| %%mongo instance<br>value_counts user.country -i instance -d database -c collection \
+                                --top 10<br>{} | Count the documents holding each value of a field on the server, \
+                                most frequent first. `--unwind` counts the elements of arrays one by one |\n"
                             "| %%mongo instance<br>count_documents -i instance -d database -c collection<br> \
                                 {'some': {'filter': 'here'} } | Count the number of documents in a collection \
                                 by executing a MongoDB `count_documents()` command. Supports an optional filter. \
-                                **Don't wrap in quotes.** |\n")
+                                **Don't wrap in quotes.** |\n"
+                            "| %%mongo instance<br>count_documents -i instance -d database -c collection \
+                                --hint ts_-1 --limit 1000000 --max-time-ms 5000<br>{'ts': {'$gte': ...}} | An empty \
+                                filter `{}` is answered from the collection metadata in milliseconds (`--exact` to \
+                                scan instead). Filtered counts can be hinted, capped and given a time limit |\n"
+                            "| %%mongo instance<br>find -i instance -d db -c users --as users<br>{}<br>\
+                                count_documents -i other -d db -c events<br>{}<br>aggregate -i instance -d db \
+                                -c orders<br>[...] | Put several commands (each a command line and a query line) \
+                                in one cell to run them concurrently, on one or more instances. Results with \
+                                `--as` are bound to their variable, the others are concatenated with `_statement` \
+                                and `_source` columns |\n")
 
         line_magic_helper_text = (f"\n## Running {magic_name} line magics\n"
                                   "-------------------------------\n"
@@ -91,15 +210,35 @@ class Mongo(Integration):
                             "| ---------- | ----------- |\n"
                             "| %mongo --help | Display usage syntax help for `%mongo` line magics |\n"
                             "| %mongo command --help | Display usage syntax for a specific command |\n"
-                            "| %mongo show_dbs -i instance | Show the databases in the instance you're connected to |\n"
-                            "| %mongo show_collections -i instance -d database | Show the collections \
-                                inside of a database |\n")
+                            "| %mongo show_dbs -i instance [--refresh] | Show the databases in the instance you're \
+                                connected to, with their size on disk. Listings come from a metadata catalog \
+                                refreshed in the background every `catalog_ttl` seconds, which also completes \
+                                `-i`, `-d` and `-c` with the tab key |\n"
+                            "| %mongo indexes -i instance -d database -c collection | List a collection's indexes \
+                                with their size and how often they've been used |\n"
+                            "| %mongo cache [-i instance] [--clear] | Show or clear the cached query results. \
+                                Use `--refresh` or `--no-cache` on a cell command to bypass the cache |\n"
+                            "| %mongo insert_df scores -i instance -d database -c collection --upsert-on _id \
+                                --objectids _id --write-concern majority | Write the `scores` dataframe to a \
+                                collection in unordered batches, several at a time, and report the throughput and \
+                                the errors of each failed batch. Without `--upsert-on` the rows are inserted |\n"
+                            "| %mongo jobs | Show the progress of queries started with `--background` |\n"
+                            "| %mongo cancel job_id | Cancel a background query and kill its cursor on the server |\n"
+                            "| %mongo stats [-n 20] [--as name] [--clear] | Show the timing breakdown, documents, \
+                                batches and bytes of recent queries, and percentiles over the history. \
+                                Use `mongo_full.query_stats.add_exporter(function)` to export each query |\n"
+                            "| %mongo show_collections -i instance -d database [--refresh] [--no-stats] | Show the \
+                                collections inside of a database, with their document count, average document \
+                                size, and data, storage and index sizes |\n")
 
         help_out = cell_magic_helper_text + cell_magic_table + line_magic_helper_text + line_magic_table
 
         return help_out
 
     def customAuth(self, instance):
+        # pymongo and pandas are imported on first use, to keep loading the extension fast
+        from pymongo.errors import OperationFailure, ConnectionFailure
+
         result = -1
         inst = None
         if instance not in self.instances.keys():
@@ -125,7 +264,7 @@ class Mongo(Integration):
                     **inst["options"]
                 )
 
-                inst["session"].session.admin.command("ismaster")
+                inst["session"]._verify()
 
                 result = 0
 
@@ -148,16 +287,23 @@ class Mongo(Integration):
         status = ""
 
         try:
-            parsed_input = self.user_input_parser.parse_input(query, type="cell")
+            statements = self.user_input_parser.split_statements(query)
 
-            if self.debug:
-                jiu.displayMD(f"**[ Dbg ]** parsed_input\n{parsed_input}")
+            if len(statements) > 1:
+                return self.executeStatements(statements), status
 
-            response = self.instances[instance]["session"]._handler(**parsed_input["input"])
+            query_input, parse_seconds = self.parseStatement(query)
 
-            parsed_response = self.response_parser._handler(response, **parsed_input["input"])
+            if query_input.get("follow") and not query_input.get("incremental"):
+                raise Exception("--follow needs --incremental, the field new documents are appended by")
 
-            dataframe = pd.DataFrame(parsed_response)
+            if query_input.get("incremental"):
+                dataframe = self.executeIncremental(instance, query_input, parse_seconds)
+            elif query_input.get("background"):
+                dataframe = self.startBackgroundQuery(instance, query_input, parse_seconds)
+            else:
+                dataframe = self.executeQuery(instance, query_input, parse_seconds=parse_seconds)
+                dataframe = self.bindResult(dataframe, query_input)
 
         except Exception as e:
             dataframe = None
@@ -165,6 +311,698 @@ class Mongo(Integration):
 
         return dataframe, status
 
+    def parseStatement(self, statement):
+        """Parse a cell command and fill in the options that come from the opts
+
+        Args:
+            statement (str): the command line and query line of the command
+
+        Returns:
+            query_input (dict): the parsed command
+            parse_seconds (float): the time spent parsing it
+        """
+
+        start = time.perf_counter()
+        parsed_input = self.user_input_parser.parse_input(statement, type="cell")
+        parse_seconds = time.perf_counter() - start
+
+        if self.debug:
+            jiu.displayMD(f"**[ Dbg ]** parsed_input\n{parsed_input}")
+
+        if parsed_input["error"] is True:
+            raise Exception(parsed_input["message"])
+
+        query_input = parsed_input["input"]
+
+        if query_input.get("batch_size") is None:
+            query_input["batch_size"] = int(self.opts["find_batch_size"][0])
+
+        if query_input.get("preview"):
+            conflicts = [f"--{option}" for option in ["raw", "parallel", "spill", "incremental", "background"]
+                         if query_input.get(option)]
+            if conflicts:
+                raise Exception(f"--preview can't be combined with {', '.join(conflicts)}")
+
+            # Each page is one batch of the cursor. A page is small, so it's neither cached nor budgeted
+            query_input.update(batch_size=query_input["preview"], no_cache=True, no_guardrails=True)
+
+        if query_input["command"] in ("find", "aggregate"):
+            query_input["spill_dir"] = self.opts["spill_dir"][0]
+            query_input["spill_threshold"] = 0 if query_input.get("preview") else \
+                int(float(self.opts["spill_threshold_mb"][0]) * 1024 * 1024)
+            query_input["infer_dtypes"] = bool(int(self.opts["infer_dtypes"][0])) and \
+                not query_input.pop("no_infer_dtypes", False)
+            query_input["objectid_dtype"] = self.opts["objectid_dtype"][0]
+
+        if query_input["command"] in ("find", "aggregate", "value_counts") and \
+                not query_input.pop("no_guardrails", False):
+            query_input["max_result_docs"] = int(self.opts["max_result_docs"][0])
+            query_input["preflight"] = query_input.get("preflight") or bool(int(self.opts["preflight_count"][0]))
+
+            # Results written to disk don't count against the memory budget
+            if not query_input.get("spill") and not query_input.get("spill_threshold"):
+                query_input["max_result_bytes"] = int(float(self.opts["max_result_mb"][0]) * 1024 * 1024)
+
+        if "max_time_ms" in query_input and query_input["max_time_ms"] is None:
+            query_input["max_time_ms"] = int(self.opts["default_max_time_ms"][0]) or None
+
+        return query_input, parse_seconds
+
+    def checkResultSize(self, instance, query_input):
+        """Refuse a find whose result would be over the max_result_docs or max_result_mb budget, before it runs.
+            Note: with the preflight_count opt or --preflight, the result size is
+            estimated from a count capped just past the budget, and the average
+            document size from the metadata catalog (unless it's projected with
+            --fields). Streaming results are charged their own measured size.
+
+        Args:
+            instance (str): the instance the query runs against
+            query_input (dict): the parsed command
+
+        Returns:
+            query_input (dict): the command
+        """
+
+        from mongo_utils.cursor_stream import ResultTooLarge
+
+        max_docs, max_bytes = query_input.get("max_result_docs"), query_input.get("max_result_bytes")
+
+        # The count scans the matching documents, so it's only run when asked for. Otherwise the budget is
+        # enforced as the result streams
+        if query_input["command"] != "find" or not query_input.get("preflight") or not (max_docs or max_bytes):
+            return query_input
+
+        api = self.instances[instance]["session"]
+        database, collection = query_input.get("database"), query_input.get("collection")
+        query = query_input.get("query") or [{}]
+        projected = query_input.get("fields") or len(query) > 1
+
+        self.catalog.configure(int(self.opts["catalog_ttl"][0]))
+        stats = self.catalog.collection_stats(instance, api, database, [collection]).get(collection) or {}
+        document_bytes = 0 if projected else int(stats.get("avgObjSize") or 0)
+
+        caps = [max_docs] if max_docs else []
+        if max_bytes and document_bytes:
+            caps.append(max_bytes // document_bytes)
+
+        if not caps:
+            return query_input
+
+        cap = min(caps)
+
+        # A limit under the budget can't go over it
+        if query_input.get("limit") and query_input["limit"] <= cap:
+            return query_input
+
+        count = api._preflight_count(cap + 1, **query_input)
+
+        if query_input.get("limit") and count is not None:
+            count = min(count, query_input["limit"])
+
+        if count is not None and count > cap:
+            size = f" (about {count * document_bytes / (1024 * 1024):,.1f} MB)" if document_bytes else ""
+            budget = f"max_result_docs budget of {max_docs:,}" if max_docs and cap == max_docs else \
+                f"max_result_mb budget of {max_bytes / (1024 * 1024):,.0f} MB"
+
+            raise ResultTooLarge(f"The query matches more than {cap:,} documents{size}, over the {budget}. "
+                                 f"{ResultTooLarge.alternatives}")
+
+        return query_input
+
+    def bindResult(self, dataframe, query_input):
+        """Show a result's notes and warnings, and bind it to its --as variable
+
+        Args:
+            dataframe (DataFrame or SpilledResult): the result
+            query_input (dict): the parsed command
+
+        Returns:
+            dataframe (DataFrame): the result to display, the first rows of a spilled or previewed result
+        """
+
+        for note in getattr(dataframe, "attrs", {}).get("notes", []):
+            jiu.displayMD(note)
+
+        for warning in getattr(dataframe, "attrs", {}).get("warnings", []):
+            jiu.display_warning(warning)
+
+        if isinstance(dataframe, SpilledResult):
+            dataframe = self.bindSpilledResult(dataframe, query_input.get("result_name"))
+
+        elif isinstance(dataframe, PagedResult):
+            dataframe = self.bindPagedResult(dataframe, query_input.get("result_name"))
+
+        elif query_input.get("result_name"):
+            self.shell.user_ns[query_input["result_name"]] = dataframe
+
+        return dataframe
+
+    def executeStatements(self, statements):
+        """Run the commands of a multi-query cell concurrently, each in its own worker thread.
+            Results with --as are bound to their variable. The others are
+            concatenated into the returned dataframe, with the statement number
+            and instance.database.collection they came from in the _statement
+            and _source columns.
+
+        Args:
+            statements (list): the command line and query line of each command
+
+        Returns:
+            dataframe (DataFrame): the concatenated results, or a summary of the
+                queries if every result was bound to a variable
+        """
+
+        import pandas as pd
+
+        parsed = []
+        for number, statement in enumerate(statements, 1):
+            try:
+                query_input, parse_seconds = self.parseStatement(statement)
+            except Exception as e:
+                raise Exception(f"Statement {number}: {e}")
+
+            unsupported = [f"--{option}" for option in ["background", "incremental", "follow"]
+                           if query_input.get(option)]
+            if unsupported:
+                raise Exception(f"Statement {number}: {', '.join(unsupported)} "
+                                f"{'is' if len(unsupported) == 1 else 'are'}n't supported in multi-query cells")
+
+            if self.instances.get(query_input["instance"], {}).get("session") is None:
+                raise Exception(f"Statement {number}: instance {query_input['instance']} isn't connected")
+
+            parsed.append((query_input, parse_seconds))
+
+        def run(job, query_input, parse_seconds):
+            job.result = self.executeQuery(job.instance, query_input, job=job, parse_seconds=parse_seconds)
+
+        start = time.perf_counter()
+        jobs = [self.background_queries.start(query_input.get("result_name"), query_input["instance"], query_input,
+                                              lambda job, q=query_input, p=parse_seconds: run(job, q, p))
+                for query_input, parse_seconds in parsed]
+
+        try:
+            for job in jobs:
+                job.thread.join()
+        except KeyboardInterrupt:
+            for job in jobs:
+                if job.status == "running":
+                    job.cancel(self.instances[job.instance]["session"])
+            raise
+
+        elapsed = time.perf_counter() - start
+
+        frames, summary = [], []
+        for number, ((query_input, _), job) in enumerate(zip(parsed, jobs), 1):
+            source = f"{job.instance}.{query_input.get('database')}.{query_input.get('collection')}"
+            # The job stays listed in %mongo jobs, without holding on to the result
+            result, job.result = job.result, None
+
+            if job.status != "done":
+                jiu.display_error(f"Statement {number} ({query_input['command']} on {source}) {job.status}: "
+                                  f"{job.error}")
+
+            elif query_input.get("result_name") or isinstance(result, (SpilledResult, PagedResult)):
+                self.bindResult(result, query_input)
+
+            else:
+                self.bindResult(result, {})
+                frames.append(result.assign(_statement=number, _source=source))
+
+            summary.append({"statement": number, "command": query_input["command"], "source": source,
+                            "name": query_input.get("result_name"), "status": job.status,
+                            "rows": len(result) if result is not None else None, "seconds": job.elapsed,
+                            "error": job.error})
+
+        if all(row["status"] != "done" for row in summary):
+            raise Exception(f"All {len(summary)} queries failed")
+
+        jiu.displayMD(f"Ran **{len(jobs)}** queries concurrently in **{elapsed:.2f}** s (slowest "
+                      f"**{max(row['seconds'] for row in summary):.2f}** s, "
+                      f"**{sum(row['seconds'] for row in summary):.2f}** s if run one after another)")
+
+        if not frames:
+            return pd.DataFrame(summary)
+
+        dataframe = pd.concat(frames, ignore_index=True)
+
+        columns = ["_statement", "_source"]
+
+        return dataframe[columns + [column for column in dataframe.columns if column not in columns]]
+
+    def executeQuery(self, instance, query_input, job=None, parse_seconds=0.0):
+        """Run a parsed cell command and build its dataframe, going through the result cache.
+            The query's timings and resource usage are recorded in the query stats.
+
+        Args:
+            instance (str): the instance to run the command against
+            query_input (dict): the parsed command
+            job (BackgroundQuery): the background job running the query, if any
+            parse_seconds (float): the time spent parsing the cell
+
+        Returns:
+            dataframe (DataFrame): the result
+        """
+
+        import pandas as pd
+
+        dataframe = None
+
+        self.result_cache.configure(int(float(self.opts["cache_max_mb"][0]) * 1024 * 1024),
+                                    int(self.opts["cache_ttl"][0]))
+        self.query_stats.configure(int(self.opts["stats_history"][0]), bool(int(self.opts["stats_track_bytes"][0])))
+        cache_key = self.result_cache.key(instance, query_input)
+
+        with self.query_stats.track(instance, query_input, job.comment if job is not None else None) as record:
+            record.stages["parse"] = parse_seconds
+
+            if not query_input.get("no_cache") and not query_input.get("refresh"):
+                dataframe = self.result_cache.get(cache_key)
+
+                if dataframe is not None:
+                    record.cached = True
+
+                    if job is None:
+                        jiu.displayMD("*Result served from the query cache. Use `--refresh` to re-run the query*")
+
+            if dataframe is None:
+                query_input = dict(query_input, comment=record.comment)
+                query_input = self.checkResultSize(instance, query_input)
+
+                with record.time("build"):
+                    response = self.instances[instance]["session"]._handler(**query_input)
+
+                    if job is not None:
+                        job.stream = response
+
+                    try:
+                        parsed_response = self.response_parser._handler(response, **query_input)
+                    except KeyboardInterrupt:
+                        if hasattr(response, "cancel"):
+                            self.instances[instance]["session"]._cancel(response, **query_input)
+                        raise
+
+                with record.time("dataframe"):
+                    if isinstance(parsed_response, PagedResult):
+                        # Only the first page is fetched now, the rest on demand
+                        parsed_response.page(0)
+                        dataframe = parsed_response
+                    elif isinstance(parsed_response, (SpilledResult, pd.DataFrame)):
+                        dataframe = parsed_response
+                    else:
+                        dataframe = pd.DataFrame(parsed_response)
+
+                # The build stage is what's left once the time spent on the server and pulling batches is taken out
+                record.stages["fetch"] = getattr(response, "seconds", 0.0)
+                record.stages["build"] = max(record.stages["build"] - max(record.stages["fetch"],
+                                                                          record.stages["round_trips"]), 0.0)
+                record.documents = getattr(response, "documents", len(dataframe))
+                record.batches = getattr(response, "batches", 0)
+                record.bytes = getattr(response, "bytes", 0) or record.bytes
+
+                if not query_input.get("no_cache") and not isinstance(dataframe, (SpilledResult, PagedResult)):
+                    self.result_cache.put(cache_key, dataframe.copy(deep=False),
+                                          **dict(query_input, instance=instance))
+
+            record.rows = len(dataframe)
+
+        return dataframe
+
+    def executeIncremental(self, instance, query_input, parse_seconds=0.0):
+        """Refresh a find result with only the documents past its watermark (--incremental).
+            Note: the first run, or a run whose query changed, fetches the result
+            in full. With --follow, the documents inserted afterwards are appended
+            from a change stream in the background. The change stream is opened
+            before the watermark is read, so no insert falls between the two.
+
+        Args:
+            instance (str): the instance to run the command against
+            query_input (dict): the parsed command
+            parse_seconds (float): the time spent parsing the cell
+
+        Returns:
+            dataframe (DataFrame): the whole result, bound to its --as variable
+        """
+
+        from mongo_utils.frame_builder import append_frame
+        from mongo_utils.incremental import delta_filter, highest
+
+        name, field = query_input.get("result_name"), query_input["incremental"]
+
+        if not name:
+            raise Exception("--incremental needs --as, the variable the result is kept in")
+
+        for option in ["skip", "limit", "spill", "background"]:
+            if query_input.get(option):
+                raise Exception(f"--{option} can't be combined with --incremental")
+
+        self.stopChangeStreamTail(name)
+
+        api = self.instances[instance]["session"]
+        key = self.incremental_results.key(instance, query_input)
+        current = self.shell.user_ns.get(name)
+        after = self.incremental_results.get(name, key, current)
+
+        tail = api._watch(**query_input) if query_input.get("follow") else None
+
+        try:
+            upto = api._watermark(field, **query_input)
+
+            if after is not None and highest([after, upto]) == after:
+                dataframe = current
+                jiu.displayMD(f"No new documents for `{name}` since the last fetch (`{field}` up to {after})")
+
+            else:
+                query = query_input.get("query") or [{}]
+                delta = dict(query_input, no_cache=True, spill_threshold=0)
+
+                if upto is not None:
+                    delta["query"] = [delta_filter(query[0], field, after, upto)] + query[1:]
+
+                dataframe = self.executeQuery(instance, delta, parse_seconds=parse_seconds)
+
+                if after is not None:
+                    jiu.displayMD(f"Appended **{len(dataframe)}** new documents to `{name}`")
+                    dataframe = append_frame(current, dataframe)
+
+            self.incremental_results.put(name, key, dataframe, upto)
+            self.shell.user_ns[name] = dataframe
+
+            if tail is not None:
+                self.startChangeStreamTail(instance, query_input, tail, upto)
+
+        except BaseException:
+            if tail is not None:
+                tail.close()
+            raise
+
+        return dataframe
+
+    def startChangeStreamTail(self, instance, query_input, tail, watermark):
+        """Append the documents inserted into a collection to an incremental result, in a background job.
+            The job stops when it's cancelled, or when the result's variable is rebound in the notebook.
+
+        Args:
+            instance (str): the instance the change stream is open on
+            query_input (dict): the parsed command
+            tail (ChangeStreamTail): the open change stream
+            watermark (object): the watermark of the fetched result, older inserts are skipped
+        """
+
+        from mongo_utils.cursor_stream import QueryCancelled
+        from mongo_utils.frame_builder import append_frame
+        from mongo_utils.incremental import field_value, highest
+
+        name, field = query_input["result_name"], query_input["incremental"]
+        new_builder = self.response_parser._builder(**query_input)
+
+        def newer(value):
+            try:
+                return watermark is None or value > watermark
+            except TypeError:
+                return True
+
+        def run(job):
+            job.stream = tail
+            dataframe = self.shell.user_ns.get(name)
+
+            for batch in tail:
+                values = [field_value(document, field) for document in batch]
+                batch = [document for document, value in zip(batch, values) if newer(value)]
+
+                if not batch:
+                    continue
+
+                if self.shell.user_ns.get(name) is not dataframe:
+                    tail.cancel()
+                    raise QueryCancelled(f"{name} was rebound in the notebook")
+
+                builder = new_builder()
+                builder.append(batch)
+
+                dataframe = append_frame(dataframe, builder.to_frame())
+                self.shell.user_ns[name] = dataframe
+                self.incremental_results.advance(name, dataframe, highest(values))
+
+        job = self.background_queries.start(name, instance, query_input, run)
+        self.incremental_results.tails[name] = job
+
+        jiu.displayMD(f"Following inserts into `{name}` in background query **{job.job_id}**. Use `%mongo jobs` to "
+                      f"see its progress or `%mongo cancel {job.job_id}` to stop it")
+
+    def stopChangeStreamTail(self, name):
+        """Stop the change stream appending to an incremental result, if one is running.
+            The tail closes its own change stream, so nothing needs killing on the server.
+        """
+
+        job = self.incremental_results.tails.pop(name, None)
+
+        if job is not None and job.status == "running":
+            job.cancelled = True
+            job.stream.cancel()
+            job.thread.join()
+
+    def bindSpilledResult(self, spilled, name=None):
+        """Bind a result spilled to disk in the notebook, to the --as variable or mongo_spill_<n>
+
+        Args:
+            spilled (SpilledResult): the handle on the spilled files
+            name (str): the variable to bind it to
+
+        Returns:
+            preview (DataFrame): the first rows of the result
+        """
+
+        self.spilled_results += 1
+        name = name or f"mongo_spill_{self.spilled_results}"
+        self.shell.user_ns[name] = spilled
+
+        jiu.displayMD(f"Spilled **{len(spilled)}** rows (**{spilled.bytes / (1024 * 1024):.2f}** MB) to "
+                      f"`{spilled.path}`, bound to `{name}`. Use `{name}.to_pandas(columns=[...], filter=...)` "
+                      f"to load it, or `{name}.remove()` to delete it. The first rows are shown below")
+
+        return spilled.head(10)
+
+    def bindPagedResult(self, paged, name=None):
+        """Bind a previewed result in the notebook, to the --as variable or mongo_preview_<n>
+
+        Args:
+            paged (PagedResult): the handle on the open cursor
+            name (str): the variable to bind it to
+
+        Returns:
+            preview (DataFrame): the first page of the result
+        """
+
+        self.paged_results += 1
+        name = name or f"mongo_preview_{self.paged_results}"
+        self.shell.user_ns[name] = paged
+
+        first = paged.page(0)
+
+        more = "It's the whole result" if len(first) < paged.page_size else \
+            f"Use `{name}.next()`, `{name}.previous()` or `{name}.page(n)` to page through it, " \
+            f"`{name}.to_pandas()` to fetch the whole result, or `{name}.close()` to release the cursor"
+
+        jiu.displayMD(f"Showing the first **{len(first)}** rows, bound to `{name}`. {more}")
+
+        return first
+
+    def startBackgroundQuery(self, instance, query_input, parse_seconds=0.0):
+        """Run a parsed cell command in a background thread.
+            The result is bound to the --as variable (or mongo_job_<id>) in the notebook when it finishes.
+
+        Args:
+            instance (str): the instance to run the command against
+            query_input (dict): the parsed command
+            parse_seconds (float): the time spent parsing the cell
+
+        Returns:
+            dataframe (DataFrame): a single row describing the started job
+        """
+
+        import pandas as pd
+
+        def run(job):
+            self.shell.user_ns[job.name] = self.executeQuery(instance, query_input, job=job,
+                                                             parse_seconds=parse_seconds)
+
+        job = self.background_queries.start(query_input.get("result_name"), instance, query_input, run)
+
+        jiu.displayMD(f"Started background query **{job.job_id}**. The result will be bound to `{job.name}`. "
+                      f"Use `%mongo jobs` to see its progress or `%mongo cancel {job.job_id}` to cancel it")
+
+        return pd.DataFrame([{"job_id": job.job_id, "name": job.name, "status": job.status}])
+
+    def handleStatsCommand(self, **kwargs):
+        """Show or clear the per-query timings (the "stats" line command).
+            With --as, every recorded query is also bound to a dataframe in the notebook.
+        """
+
+        if kwargs.get("clear"):
+            self.query_stats.clear()
+            jiu.displayMD("Cleared the query stats")
+            return
+
+        response = self.query_stats.describe(kwargs.get("last"))
+        jiu.displayMD(self.response_parser._handler(response, **kwargs))
+
+        if kwargs.get("result_name"):
+            import pandas as pd
+
+            records = self.query_stats.describe(len(self.query_stats.history))["records"]
+            self.shell.user_ns[kwargs["result_name"]] = pd.DataFrame(records)
+
+    def handleShowDbsCommand(self, **kwargs):
+        """List an instance's databases from the metadata catalog (the "show_dbs" line command)"""
+
+        api = self.connectedSession(kwargs.get("instance"))
+
+        if api is not None:
+            self.catalog.configure(int(self.opts["catalog_ttl"][0]))
+            databases, age = self.catalog.databases(kwargs["instance"], api, kwargs.get("refresh"))
+
+            response = {"databases": databases, "age": age}
+            jiu.displayMD(self.response_parser._handler(response, **kwargs))
+
+    def handleShowCollectionsCommand(self, **kwargs):
+        """List a database's collections and their sizes from the metadata catalog (the "show_collections" line
+            command). The stats of collections that aren't cached yet are fetched concurrently.
+        """
+
+        api = self.connectedSession(kwargs.get("instance"))
+
+        if api is not None:
+            instance, database, refresh = kwargs["instance"], kwargs.get("database"), kwargs.get("refresh")
+
+            self.catalog.configure(int(self.opts["catalog_ttl"][0]))
+            collections, age = self.catalog.collections(instance, api, database, refresh)
+            collections = [dict(collection) for collection in collections]
+
+            if not kwargs.get("no_stats"):
+                names = [collection["name"] for collection in collections if collection["type"] == "collection"]
+                stats = self.catalog.collection_stats(instance, api, database, names, refresh)
+
+                for collection in collections:
+                    collection["stats"] = stats.get(collection["name"])
+
+            response = {"collections": collections, "age": age}
+            jiu.displayMD(self.response_parser._handler(response, **kwargs))
+
+    def connectedSession(self, instance):
+        """Return an instance's session, or display an error and return None if it isn't connected"""
+
+        if instance not in self.instances:
+            jiu.display_error(f"Instance **{instance}** not found in instances")
+            return None
+
+        if self.instances[instance].get("session") is None:
+            jiu.display_error(f"Instance **{instance}** isn't connected")
+            return None
+
+        return self.instances[instance]["session"]
+
+    def completeMetadata(self, text):
+        """Complete instance, database and collection names after -i, -d and -c, from the metadata catalog.
+            Never waits on the server: names that aren't cached yet are fetched in
+            the background, for the next completion.
+
+        Args:
+            text (str): the word being completed
+
+        Returns:
+            matches (list): the names starting with text
+        """
+
+        line = self.shell.Completer.text_until_cursor
+        tokens = line.split()
+
+        if not tokens:
+            return []
+
+        option = tokens[-1] if line[-1:].isspace() else (tokens[-2] if len(tokens) > 1 else "")
+
+        def value(*names):
+            for i, token in enumerate(tokens[:-1]):
+                if token in names:
+                    return tokens[i + 1]
+
+            return None
+
+        names = []
+
+        if option in ("-i", "--instance"):
+            names = list(self.instances)
+
+        elif option in ("-d", "--database", "-c", "--collection"):
+            instance = value("-i", "--instance") or self.opts["mongo_conn_default"][0]
+            session = self.instances.get(instance, {}).get("session")
+
+            if session is None:
+                return []
+
+            database = value("-d", "--database") if option in ("-c", "--collection") else None
+            if option in ("-c", "--collection") and database is None:
+                return []
+
+            try:
+                names = self.catalog.names(instance, session, database)
+            except Exception:
+                return []
+
+        return [name for name in names if name.startswith(text)]
+
+    def handleInsertCommand(self, **kwargs):
+        """Write a dataframe from the notebook to a collection (the "insert_df" line command)"""
+
+        import pandas as pd
+
+        name, instance = kwargs.get("dataframe"), kwargs.get("instance")
+        dataframe = self.shell.user_ns.get(name)
+
+        if not isinstance(dataframe, pd.DataFrame):
+            jiu.display_error(f"**{name}** isn't a dataframe in the notebook")
+        elif self.instances.get(instance, {}).get("session") is None:
+            jiu.display_error(f"Instance **{instance}** isn't connected")
+        else:
+            for option in ["upsert_on", "objectids"]:
+                if kwargs.get(option):
+                    kwargs[option] = [field.strip() for field in kwargs[option].split(",") if field.strip()]
+
+            kwargs["batch_size"] = kwargs.get("batch_size") or int(self.opts["find_batch_size"][0])
+
+            response = self.instances[instance]["session"]._handler(**dict(kwargs, dataframe=dataframe))
+            jiu.displayMD(self.response_parser._handler(response, **kwargs))
+
+    def handleJobsCommand(self, **kwargs):
+        """Show the progress of background queries (the "jobs" line command)"""
+
+        response = self.background_queries.describe()
+        jiu.displayMD(self.response_parser._handler(response, **kwargs))
+
+    def handleCancelCommand(self, **kwargs):
+        """Cancel a background query (the "cancel" line command)"""
+
+        job = self.background_queries.get(kwargs.get("job_id"))
+
+        if job is None:
+            jiu.display_error(f"Background query **{kwargs.get('job_id')}** not found. See `%mongo jobs`")
+        elif job.status != "running":
+            jiu.display_error(f"Background query **{job.job_id}** isn't running, its status is **{job.status}**")
+        else:
+            killed = job.cancel(self.instances[job.instance]["session"])
+            jiu.displayMD(f"Cancelled background query **{job.job_id}**, killed **{killed['cursors']}** cursors "
+                          f"and **{killed['operations']}** operations on the server")
+
+    def handleCacheCommand(self, **kwargs):
+        """Show or clear the query result cache (the "cache" line command)"""
+
+        if kwargs.get("clear"):
+            removed = self.result_cache.clear(kwargs.get("instance"))
+            jiu.displayMD(f"Removed **{removed}** cached results")
+        else:
+            response = self.result_cache.describe(kwargs.get("instance"))
+            jiu.displayMD(self.response_parser._handler(response, **kwargs))
+
     # This is the magic name.
     @line_cell_magic
     def mongo(self, line, cell=None):
@@ -187,6 +1025,9 @@ class Mongo(Integration):
                     if parsed_input["error"] is True:
                         jiu.display_error(f"{parsed_input['message']}")
 
+                    elif parsed_input["input"]["command"] in self.local_line_commands:
+                        self.local_line_commands[parsed_input["input"]["command"]](**parsed_input["input"])
+
                     else:
                         instance = parsed_input["input"]["instance"]
 
@@ -1,3 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
+from mongo_utils.cursor_stream import PartitionedStream
+from mongo_utils.frame_builder import FrameBuilder, TypedFrameBuilder
+from mongo_utils.paged_result import PagedResult
+
+
 class ResponseParser:
     """ A class to parse API responses from the Flashpoint API.
         Note: I follow this simple idiom: APIs return data. Formatting
@@ -20,46 +26,74 @@ class ResponseParser:
         return getattr(self, issued_command)(response, **kwargs)
 
     def show_dbs(self, response, **kwargs):
-        """Parse the "show_dbs" response from the Jupyter Mongo API
+        """Parse the "show_dbs" response from the metadata catalog
 
         Args:
-            response (list): list of databases from the Jupyter Mongo API
+            response (dict): the databases, and the age of the listing in seconds
 
         Returns:
-            formatted_db_list (str): Markdown formatted string of dbs
+            formatted_db_list (str): Markdown formatted table of dbs
         """
 
         instance = kwargs.get("instance")
+        mb = 1024 * 1024
+
+        def size(db):
+            return "" if db["size"] is None else f"{db['size'] / mb:.2f}"
 
-        formatted_db_names = "".join(f"* {db}\n" for db in response)
+        formatted_db_names = "".join(f"| {db['name']} | {size(db)} |\n" for db in response["databases"])
 
         formatted_db_list = (f"#### Databases in `{instance}`\n"
                              "***\n"
+                             f"{self._catalog_age(response['age'])}"
+                             "| Database | Size on disk (MB) |\n"
+                             "| -------- | ----------------- |\n"
                              f"{formatted_db_names}\n")
 
         return formatted_db_list
 
     def show_collections(self, response, **kwargs):
-        """Parse the "show_collections" response from the Jupyter Mongo API
+        """Parse the "show_collections" response from the metadata catalog
 
         Args:
-            response (list): list of collections from the Jupyter Mongo API
+            response (dict): the collections, their stats, and the age of the listing in seconds
 
         Returns:
-            collections (str): Markdown formatted string of collections
+            collections (str): Markdown formatted table of collections
         """
 
         instance = kwargs.get("instance")
         db_name = kwargs.get("database")
+        mb = 1024 * 1024
 
-        formatted_collections_names = "".join(f"* {col}\n" for col in response)
+        def cell(stats, field, scale=1, format_spec=".2f"):
+            return "" if not stats else format(stats[field] / scale, format_spec)
+
+        formatted_collections_names = "".join(
+            f"| {col['name']} | {col['type']} | {cell(col.get('stats'), 'count', format_spec='.0f')} | "
+            f"{cell(col.get('stats'), 'avgObjSize', format_spec='.0f')} | {cell(col.get('stats'), 'size', mb)} | "
+            f"{cell(col.get('stats'), 'storageSize', mb)} | {cell(col.get('stats'), 'totalIndexSize', mb)} |\n"
+            for col in response["collections"])
 
         collections = (f"#### Collections in `{db_name}` in `{instance}` instance\n"
                        "***\n"
+                       f"{self._catalog_age(response['age'])}"
+                       "| Collection | Type | Documents | Avg document (B) | Data (MB) | Storage (MB) | "
+                       "Indexes (MB) |\n"
+                       "| ---------- | ---- | --------- | ---------------- | --------- | ------------ | "
+                       "------------ |\n"
                        f"{formatted_collections_names}\n")
 
         return collections
 
+    def _catalog_age(self, age):
+        """Note how old a listing from the metadata catalog is, if it didn't come straight from the server"""
+
+        if age is None or age < 1:
+            return ""
+
+        return f"*From the metadata catalog, {age:.0f} s old. Use `--refresh` to list again from the server*\n\n"
+
     def find_one(self, response, **kwargs):
         """Parse the "find_one" response from the Jupyter Mongo API
             Note: Mongo returns a single dictionary, so we're transforming
@@ -71,31 +105,536 @@ class ResponseParser:
         Returns:
             (list): the original response, now encapsulated in a list
         """
+
+        if response is not None and kwargs.get("flatten") is not None:
+            return self._flattener(**kwargs).flatten_batch([response])
+
         return [response]
 
     def find(self, response, **kwargs):
         """Parse the "find" response from the Jupyter Mongo API
+            Note: the batches are appended into column buffers as they
+            arrive, so the full list of documents never exists at once.
+            With --spill, or once the result outgrows the spill threshold,
+            the batches are written to disk instead. With --preview, nothing
+            is fetched yet, the cursor is wrapped to be paged through
+
+        Args:
+            response (CursorStream or Table): an iterable of document batches from Mongo,
+                or an Arrow table when the raw fast path decoded it already
+
+        Returns:
+            (DataFrame, SpilledResult or PagedResult): the documents, built column-wise, a handle on the
+                spilled files, or a handle on the open cursor
+        """
+
+        if kwargs.get("preview"):
+            return PagedResult(response, self._builder(**kwargs))
+
+        if kwargs.get("spill") or kwargs.get("spill_threshold"):
+            return self._consume_spilling(response, **kwargs)
+
+        if hasattr(response, "to_pandas"):
+            return self._flatten_table(response, **kwargs).to_pandas()
+
+        if isinstance(response, PartitionedStream):
+            return self._consume_partitions(response, self._builder(**kwargs)).to_frame()
+
+        return self._builder(**kwargs)().consume(response).to_frame()
+
+    def _builder(self, **kwargs):
+        """Pick the frame builder for a query: typed columns, unless dtype inference is off,
+            flattening nested documents with --flatten
+
+        Returns:
+            (function): creates an empty builder
+        """
+
+        flattener = self._flattener(**kwargs)
+
+        if kwargs.get("infer_dtypes"):
+            return lambda: TypedFrameBuilder(objectid_dtype=kwargs.get("objectid_dtype") or "string",
+                                             flattener=flattener)
+
+        return lambda: FrameBuilder(flattener)
+
+    def _flattener(self, **kwargs):
+        """Build the document flattener for --flatten [DEPTH] and --arrays, or None without --flatten"""
+
+        from mongo_utils.flatten import DocumentFlattener
+
+        if kwargs.get("flatten") is None:
+            return None
+
+        return DocumentFlattener(kwargs["flatten"], kwargs.get("arrays") or "keep")
+
+    def _flatten_table(self, table, **kwargs):
+        """Flatten the struct columns of an Arrow table from the raw fast path into dotted-path columns
+
+        Args:
+            table (Table): the decoded result
+
+        Returns:
+            table (Table): the table, flattened up to --flatten levels deep
+        """
+
+        import pyarrow as pa
+
+        if kwargs.get("flatten") is None:
+            return table
+
+        if (kwargs.get("arrays") or "keep") != "keep" and \
+                any(pa.types.is_list(field.type) for field in table.schema):
+            raise ValueError("--arrays join and explode aren't supported on Arrow results (--raw with pymongoarrow)")
+
+        depth = 0
+        while any(pa.types.is_struct(field.type) for field in table.schema) and \
+                (not kwargs["flatten"] or depth < kwargs["flatten"]):
+            table = table.flatten()
+            depth += 1
+
+        return table
+
+    def _consume_partitions(self, response, new_builder=FrameBuilder, writer=None):
+        """Drain the partitions of a parallel scan concurrently, one builder each,
+            then combine the builders in partition order so the result is deterministic
 
         Args:
-            response (list): a list of dictionaries from Mongo
+            response (PartitionedStream): the partitions to drain
+            new_builder (function): creates the builder of each partition
+            writer (SpillWriter): write the batches to disk instead, tagged with their partition
 
         Returns:
-            (list): at the moment, this simply passes the response back through
+            builder (FrameBuilder): a builder holding every partition's rows, or
+                the writer once every partition is written
         """
 
-        return response
+        def consume(partition):
+            index, stream = partition
+
+            if writer is None:
+                return new_builder().consume(stream)
+
+            for batch in stream:
+                writer.write(batch, partition=index)
+
+        pool = ThreadPoolExecutor(max_workers=response.workers)
+
+        try:
+            builders = list(pool.map(consume, enumerate(response.streams)))
+        except BaseException:
+            # Stop the other partitions at their next batch instead of draining them
+            response.cancel()
+            raise
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        if writer is not None:
+            return writer
+
+        builder = new_builder()
+        for partial in builders:
+            builder.extend(partial)
+
+        return builder
+
+    def _consume_spilling(self, response, **kwargs):
+        """Write the result to disk with --spill, or build it in memory until
+            its estimated size passes the spill threshold, then move it to disk.
+            Note: the size is estimated from the in-memory size of the first batch.
+            Parallel scans are only spilled with --spill.
+
+        Returns:
+            (DataFrame or SpilledResult): the documents, or a handle on the spilled files
+        """
+
+        from mongo_utils.spill import SpillWriter, spill_path
+
+        spill = kwargs.get("spill")
+        threshold = kwargs.get("spill_threshold") or 0
+
+        def new_writer():
+            path = spill if isinstance(spill, str) else \
+                spill_path(kwargs.get("spill_dir"), kwargs.get("database"), kwargs.get("collection"))
+
+            return SpillWriter(path, kwargs.get("spill_format") or "feather", self._builder(**kwargs))
+
+        if hasattr(response, "to_pandas"):
+            response = self._flatten_table(response, **kwargs)
+
+            if not spill and response.nbytes <= threshold:
+                return response.to_pandas()
+
+            writer = new_writer()
+            writer.write(response)
+
+            return writer.close()
+
+        if isinstance(response, PartitionedStream):
+            if not spill:
+                return self._consume_partitions(response, self._builder(**kwargs)).to_frame()
+
+            return self._consume_partitions(response, writer=new_writer()).close()
+
+        writer = new_writer() if spill else None
+        builder = self._builder(**kwargs)()
+        row_bytes = None
+
+        for batch in response:
+            if writer is not None:
+                writer.write(batch)
+                continue
+
+            if row_bytes is None:
+                sample = self._builder(**kwargs)()
+                sample.append(batch)
+                row_bytes = sample.to_frame().memory_usage(index=False, deep=True).sum() / max(len(batch), 1)
+
+            builder.append(batch)
+
+            if builder.rows * row_bytes > threshold:
+                writer = new_writer()
+                writer.write(builder.to_frame())
+
+        if writer is not None:
+            return writer.close()
+
+        return builder.to_frame()
+
+    def aggregate(self, response, **kwargs):
+        """Parse the "aggregate" response from the Jupyter Mongo API
+            Note: aggregation results stream through the same column-wise
+            builder as "find"
+
+        Args:
+            response (CursorStream or Table): an iterable of document batches from Mongo,
+                or an Arrow table when the raw fast path decoded it already
+
+        Returns:
+            (DataFrame): the documents, built column-wise
+        """
+
+        return self.find(response, **kwargs)
+
+    def export(self, response, **kwargs):
+        """Parse the "export" response from the Jupyter Mongo API
+            Note: the batches are written to the export file as they arrive,
+            without building a dataframe. An interrupted or failed export
+            leaves no file behind.
+
+        Args:
+            response (CursorStream): an iterable of document batches from Mongo
+
+        Returns:
+            (DataFrame): a single row with the file written, its size and the write rates
+        """
+
+        import pandas as pd
+        from mongo_utils.export import export_writer
+
+        writer = export_writer(kwargs.get("output"), kwargs.get("format"), kwargs.get("compression"),
+                               kwargs.get("chunk_size"), self._flattener(**kwargs), kwargs.get("overwrite"))
+
+        try:
+            summary = writer.consume(response).close()
+        except BaseException:
+            writer.abort()
+            raise
+
+        dataframe = pd.DataFrame([summary])
+        dataframe.attrs["notes"] = [f"Exported **{summary['rows']:,}** rows (**{summary['bytes'] / (1024 * 1024):,.2f}"
+                                    f"** MB) to `{summary['path']}` in **{summary['seconds']:.2f}** s, "
+                                    f"**{summary['rows_per_second']:,.0f}** rows/s and "
+                                    f"**{summary['mb_per_second']:,.2f}** MB/s"]
+        dataframe.attrs["warnings"] = writer.warnings
+
+        return dataframe
 
     def count_documents(self, response, **kwargs):
         """Parse the "count_documents" response from the Jupyter Mongo API
 
         Args:
-            response (int): the total number of documents from a collection
+            response (dict): the number of documents, and whether it's an estimate
 
         Returns:
             formatted_response (list): a list with a single dictionary item
                 so we can easily turn it into a dataframe
         """
 
-        formatted_response = [{"count": response}]
+        formatted_response = [response]
 
         return formatted_response
+
+    def distinct(self, response, **kwargs):
+        """Parse the "distinct" response from the Jupyter Mongo API
+
+        Args:
+            response (list): the distinct values of the field
+
+        Returns:
+            (DataFrame): a single column named after the field, its values sorted
+                unless they're of types that can't be compared
+        """
+
+        import pandas as pd
+
+        try:
+            values = sorted(response, key=lambda value: (value is None, value))
+        except TypeError:
+            values = response
+
+        return pd.DataFrame({kwargs.get("field"): values})
+
+    def value_counts(self, response, **kwargs):
+        """Parse the "value_counts" response from the Jupyter Mongo API
+
+        Args:
+            response (CursorStream): batches of dicts with each value (_id) and its count, most frequent first
+
+        Returns:
+            (DataFrame): the values and their counts, in a column named after the field and a count column
+        """
+
+        import pandas as pd
+
+        response = [row for batch in response for row in batch]
+
+        return pd.DataFrame({kwargs.get("field"): [row["_id"] for row in response],
+                             "count": [row["count"] for row in response]})
+
+    def explain(self, response, **kwargs):
+        """Parse the "explain" response from the Jupyter Mongo API
+            Note: the plan is flattened into one row per stage, parents first.
+            A summary of each plan goes into the frame's attrs["notes"], and
+            collection scans, in-memory sorts and unselective indexes into
+            attrs["warnings"], along with a candidate index for the query
+
+        Args:
+            response (dict): the output of the explain command
+
+        Returns:
+            (DataFrame): the stages of the plan
+        """
+
+        import pandas as pd
+        from mongo_utils.explain_plan import plan_sections, plan_stages, plan_warnings, query_shape, suggest_index
+
+        db_name = kwargs.get("database")
+        collection = kwargs.get("collection")
+
+        rows = []
+        notes = []
+
+        for shard, planner, stats in plan_sections(response):
+            winning_plan = planner.get("winningPlan") or {}
+
+            # Per-stage stats of the slot based engine don't map to the classic stages, so show the winning plan
+            plan = winning_plan if "queryPlan" in winning_plan else stats.get("executionStages") or winning_plan
+            rows.extend(plan_stages(plan, shard))
+
+            where = f"Shard `{shard}`: " if shard else ""
+            rejected = len(planner.get("rejectedPlans") or [])
+
+            if stats:
+                notes.append(f"{where}returned **{stats.get('nReturned')}** documents in "
+                             f"**{stats.get('executionTimeMillis')}** ms, examining "
+                             f"**{stats.get('totalKeysExamined')}** index keys and "
+                             f"**{stats.get('totalDocsExamined')}** documents. {rejected} rejected plans")
+            else:
+                notes.append(f"{where}{rejected} rejected plans. Use `--verbosity executionStats` for run time stats")
+
+        if not rows:
+            notes.append("The explain output has no query plan, see the raw output with `--verbosity queryPlanner`")
+
+        warnings = plan_warnings(rows, f"{db_name}.{collection}")
+
+        if any(row["stage"] in ("COLLSCAN", "SORT") for row in rows):
+            query_filter, sort = query_shape(kwargs.get("explained_command"), kwargs.get("query") or [],
+                                             kwargs.get("sort"))
+            keys = suggest_index(query_filter, sort)
+
+            if keys:
+                formatted_keys = ", ".join(f"'{field}': {direction}" for field, direction in keys)
+                warnings.append(f"Candidate index for this query: db.{collection}.createIndex({{{formatted_keys}}})")
+
+        dataframe = pd.DataFrame(rows, columns=["shard", "depth", "stage", "index", "key_pattern", "direction",
+                                                "returned", "keys_examined", "docs_examined", "time_ms",
+                                                "uses_disk", "filter"])
+
+        for column in ["key_pattern", "filter"]:
+            dataframe[column] = dataframe[column].map(lambda value: None if value is None else str(value))
+
+        dataframe.attrs["notes"] = notes
+        dataframe.attrs["warnings"] = warnings
+
+        return dataframe
+
+    def indexes(self, response, **kwargs):
+        """Parse the "indexes" response from the Jupyter Mongo API
+
+        Args:
+            response (list): a list of dicts describing each index
+
+        Returns:
+            formatted_indexes (str): Markdown formatted table of indexes
+        """
+
+        instance = kwargs.get("instance")
+        db_name = kwargs.get("database")
+        collection = kwargs.get("collection")
+
+        mb = 1024 * 1024
+        options = ["unique", "sparse", "hidden", "expireAfterSeconds", "partialFilterExpression"]
+
+        def cell(value, format_value=str):
+            return "" if value is None else format_value(value)
+
+        formatted_rows = "".join(
+            f"| {index['name']} | `{dict(index['key'])}` | {cell(index['size'], lambda v: f'{v / mb:.2f}')} | "
+            f"{cell(index['ops'])} | {cell(index['since'])} | "
+            f"{', '.join(f'{o}: {index[o]}' for o in options if index.get(o) not in (None, False))} |\n"
+            for index in response)
+
+        unused = [index["name"] for index in response if index["ops"] == 0 and index["name"] != "_id_"]
+        formatted_unused = f"Unused since the last restart: **{', '.join(unused)}**\n\n" if unused else ""
+
+        formatted_indexes = (f"#### Indexes of `{db_name}.{collection}` in `{instance}` instance\n"
+                             "***\n"
+                             f"{formatted_unused}"
+                             "| Name | Keys | Size (MB) | Ops | Counting ops since | Options |\n"
+                             "| ---- | ---- | --------- | --- | ------------------ | ------- |\n"
+                             f"{formatted_rows}\n")
+
+        return formatted_indexes
+
+    def insert_df(self, response, **kwargs):
+        """Parse the "insert_df" response from the Jupyter Mongo API
+
+        Args:
+            response (dict): the totals, elapsed time and errors of the write
+
+        Returns:
+            formatted_response (str): Markdown formatted summary, and a table of the failed batches
+        """
+
+        seconds = response["seconds"]
+        rate = response["rows"] / seconds if seconds else 0
+
+        formatted_response = (f"Wrote **{response['rows']}** rows to `{kwargs.get('database')}."
+                              f"{kwargs.get('collection')}` in **{response['batches']}** batches, in "
+                              f"**{seconds:.2f}** s (**{rate:,.0f}** rows/s). Inserted **{response['inserted']}**")
+
+        if kwargs.get("upsert_on"):
+            formatted_response += (f", upserted **{response['upserted']}**, matched **{response['matched']}**, "
+                                   f"modified **{response['modified']}**")
+
+        formatted_response += "\n"
+
+        if response["errors"]:
+            formatted_rows = "".join(f"| {error['batch']} | {error['rows']} | {error['failed']} | {error['error']} |\n"
+                                     for error in response["errors"])
+
+            formatted_response += ("\n#### Failed batches\n"
+                                   "***\n"
+                                   "| Batch | Rows | Failed writes | First error |\n"
+                                   "| ----- | ---- | ------------- | ----------- |\n"
+                                   f"{formatted_rows}\n")
+
+        return formatted_response
+
+    def cache(self, response, **kwargs):
+        """Parse the description of the query result cache
+
+        Args:
+            response (dict): the cache totals and its entries, from ResultCache.describe()
+
+        Returns:
+            formatted_cache (str): Markdown formatted table of cached results
+        """
+
+        mb = 1024 * 1024
+
+        formatted_entries = "".join(f"| {entry['instance']} | {entry['command']} | {entry['database']} | "
+                                    f"{entry['collection']} | {entry['rows']} | {entry['bytes'] / mb:.2f} | "
+                                    f"{entry['age']:.0f} | {entry['hits']} |\n" for entry in response["entries"])
+
+        formatted_cache = (f"#### Query result cache\n"
+                           "***\n"
+                           f"Using **{response['bytes'] / mb:.2f}** of **{response['max_bytes'] / mb:.2f}** MB, "
+                           f"entries expire after **{response['ttl']}** seconds. "
+                           f"Hits: **{response['hits']}**, misses: **{response['misses']}**\n\n"
+                           "| Instance | Command | Database | Collection | Rows | Size (MB) | Age (s) | Hits |\n"
+                           "| -------- | ------- | -------- | ---------- | ---- | --------- | ------- | ---- |\n"
+                           f"{formatted_entries}\n")
+
+        return formatted_cache
+
+    def jobs(self, response, **kwargs):
+        """Parse the description of the background queries
+
+        Args:
+            response (list): a list of dicts describing each job, from BackgroundQueries.describe()
+
+        Returns:
+            formatted_jobs (str): Markdown formatted table of background queries
+        """
+
+        formatted_rows = "".join(f"| {job['job_id']} | `{job['name']}` | {job['instance']} | {job['command']} | "
+                                 f"{job['collection']} | {job['status']} | {job['documents']} | {job['batches']} | "
+                                 f"{job['elapsed']:.1f} | {job['error'] or ''} |\n" for job in response)
+
+        formatted_jobs = ("#### Background queries\n"
+                          "***\n"
+                          "| Id | Variable | Instance | Command | Collection | Status | Documents | Batches | "
+                          "Elapsed (s) | Error |\n"
+                          "| -- | -------- | -------- | ------- | ---------- | ------ | --------- | ------- | "
+                          "----------- | ----- |\n"
+                          f"{formatted_rows}\n")
+
+        return formatted_jobs
+
+    def stats(self, response, **kwargs):
+        """Parse the description of the query stats
+
+        Args:
+            response (dict): the recent queries and timing percentiles, from QueryStats.describe()
+
+        Returns:
+            formatted_stats (str): Markdown formatted tables of recent queries and percentiles
+        """
+
+        mb = 1024 * 1024
+
+        formatted_rows = "".join(f"| {r['query_id']} | {r['instance']} | {r['command']} | {r['database']}."
+                                 f"{r['collection']} | {r['status']}{' (cached)' if r['cached'] else ''} | "
+                                 f"{r['seconds']:.3f} | {r['parse_seconds']:.3f} | {r['round_trips_seconds']:.3f} | "
+                                 f"{r['fetch_seconds']:.3f} | {r['build_seconds']:.3f} | "
+                                 f"{r['dataframe_seconds']:.3f} | {r['commands']} | {r['documents']} | "
+                                 f"{r['batches']} | {r['bytes'] / mb:.2f} |\n" for r in response["records"])
+
+        def seconds(value):
+            return "" if value is None else f"{value:.3f}"
+
+        formatted_percentiles = "".join(f"| {timing} | " + " | ".join(seconds(values[p]) for p in [50, 90, 99, 100])
+                                        + " |\n" for timing, values in response["percentiles"].items())
+
+        formatted_stats = ("#### Recent queries\n"
+                           "***\n"
+                           f"Showing **{len(response['records'])}** of **{response['queries']}** recorded queries "
+                           f"(the history keeps **{response['max_records']}**). Round trips are the time spent in "
+                           "server commands, including network transfer and decoding the reply. Fetch is the time "
+                           "spent pulling batches from the cursor, round trips included\n\n"
+                           "| Id | Instance | Command | Collection | Status | Total (s) | Parse (s) | "
+                           "Round trips (s) | Fetch (s) | Build (s) | DataFrame (s) | Commands | Documents | Batches | "
+                           "Bytes (MB) |\n"
+                           "| -- | -------- | ------- | ---------- | ------ | --------- | --------- | "
+                           "--------------- | --------- | --------- | ------------- | -------- | --------- | ------- | "
+                           "---------- |\n"
+                           f"{formatted_rows}\n"
+                           "#### Percentiles (s), cached results excluded\n"
+                           "***\n"
+                           "| Timing | p50 | p90 | p99 | max |\n"
+                           "| ------ | --- | --- | --- | --- |\n"
+                           f"{formatted_percentiles}\n")
+
+        return formatted_stats
@@ -0,0 +1,127 @@
+import threading
+import time
+from mongo_utils.cursor_stream import QueryCancelled
+
+
+class BackgroundQuery:
+    """A query running in a worker thread.
+        Note: the target function receives the job, so it can attach the
+        stream it's draining (job.stream) for progress and cancellation,
+        and keep its result (job.result).
+    """
+
+    def __init__(self, job_id, name, instance, query_input, target):
+        self.job_id = job_id
+        self.name = name
+        self.instance = instance
+        self.query_input = query_input
+        self.comment = f"jupyter_mongo:job:{job_id}:{time.time()}"
+        self.stream = None
+        self.result = None
+        self.status = "running"
+        self.error = None
+        self.cancelled = False
+        self.started = time.time()
+        self.finished = None
+        self.thread = threading.Thread(target=self._run, args=(target,), daemon=True,
+                                       name=f"jupyter_mongo_job_{job_id}")
+
+    @property
+    def documents(self):
+        return getattr(self.stream, "documents", 0)
+
+    @property
+    def batches(self):
+        return getattr(self.stream, "batches", 0)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def start(self):
+        self.thread.start()
+
+        return self
+
+    def _run(self, target):
+        try:
+            target(self)
+            self.status = "done"
+
+        except QueryCancelled:
+            self.status = "cancelled"
+
+        except Exception as e:
+            self.status = "cancelled" if self.cancelled else "failed"
+            self.error = str(e)
+
+        finally:
+            self.finished = time.time()
+
+    def cancel(self, api):
+        """Cancel the query, killing its server cursor and operations
+
+        Args:
+            api (MongoAPI): the session the query runs on
+
+        Returns:
+            killed (dict): the number of cursors and operations killed
+        """
+
+        self.cancelled = True
+
+        return api._cancel(self.stream, self.comment, **self.query_input)
+
+
+class BackgroundQueries:
+    """A registry of background queries, numbered in the order they're started"""
+
+    def __init__(self):
+        self.jobs = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def start(self, name, instance, query_input, target):
+        """Start a query in the background
+
+        Args:
+            name (str): the user_ns variable the result is bound to, defaults to mongo_job_<id>
+            instance (str): the instance the query runs against
+            query_input (dict): the parsed command
+            target (function): runs the query, given the job
+
+        Returns:
+            job (BackgroundQuery): the started job
+        """
+
+        with self.lock:
+            job_id = self.next_id
+            self.next_id += 1
+
+        job = BackgroundQuery(job_id, name or f"mongo_job_{job_id}", instance, query_input, target)
+        self.jobs[job_id] = job
+
+        return job.start()
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def describe(self):
+        """Describe every job, oldest first
+
+        Returns:
+            jobs (list): a list of dicts describing each job
+        """
+
+        return [{
+            "job_id": job.job_id,
+            "name": job.name,
+            "instance": job.instance,
+            "command": job.query_input.get("command"),
+            "collection": f"{job.query_input.get('database')}.{job.query_input.get('collection')}",
+            "status": job.status,
+            "documents": job.documents,
+            "batches": job.batches,
+            "elapsed": job.elapsed,
+            "error": job.error
+        } for job in self.jobs.values()]
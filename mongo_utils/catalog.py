@@ -0,0 +1,147 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MetadataCatalog:
+    """An in-kernel cache of each instance's database and collection names, and collection stats.
+        Note: entries older than ttl are still served, while a background
+        thread refreshes them, so only the first listing of a database waits
+        on the server. Tab completion never waits, it only reads the cache.
+    """
+
+    # Collections whose stats are fetched at the same time when a database is listed
+    stats_workers = 8
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.entries = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def configure(self, ttl):
+        self.ttl = ttl
+
+    def get(self, key, fetch, refresh=False, wait=True):
+        """Return a cached value, fetching it if it's missing and refreshing it in the background if it's stale
+
+        Args:
+            key (tuple): identifies the value, e.g. ("collections", instance, database)
+            fetch (function): reads the value from the server
+            refresh (bool): fetch the value again right away
+            wait (bool): whether a missing value is fetched before returning, or only in the background
+
+        Returns:
+            value (object): the value, or None if it's missing and wait is False
+            age (float): the number of seconds since the value was fetched
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+        if entry is None or refresh or not self.ttl:
+            if not wait:
+                self._refresh(key, fetch)
+                return None, None
+
+            entry = self._fetch(key, fetch)
+
+        elif time.time() - entry[1] > self.ttl:
+            self._refresh(key, fetch)
+
+        return entry[0], time.time() - entry[1]
+
+    def _fetch(self, key, fetch):
+        entry = (fetch(), time.time())
+
+        with self.lock:
+            self.entries[key] = entry
+
+        return entry
+
+    def _refresh(self, key, fetch):
+        """Fetch a value in a background thread, unless it's already being fetched"""
+
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def run():
+            try:
+                self._fetch(key, fetch)
+            except Exception:
+                # The stale value is kept, the next listing tries again
+                pass
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=run, daemon=True, name="jupyter_mongo_catalog").start()
+
+    def databases(self, instance, api, refresh=False, wait=True):
+        """The databases of an instance, with their size on disk. See MetadataCatalog.get"""
+
+        return self.get(("databases", instance), api.show_dbs, refresh, wait)
+
+    def collections(self, instance, api, database, refresh=False, wait=True):
+        """The collections and views of a database. See MetadataCatalog.get"""
+
+        return self.get(("collections", instance, database), lambda: api.show_collections(database=database),
+                        refresh, wait)
+
+    def collection_stats(self, instance, api, database, collections, refresh=False):
+        """The stats of some collections (documents, average size, storage and index size).
+            Missing stats are fetched stats_workers collections at a time.
+
+        Args:
+            instance (str): the instance the collections are on
+            api (MongoAPI): the session to fetch with
+            database (str): the database the collections are in
+            collections (list): the collection names
+            refresh (bool): fetch every collection's stats again right away
+
+        Returns:
+            stats (dict): the stats of each collection, by name
+        """
+
+        def stats(collection):
+            key = ("stats", instance, database, collection)
+            fetch = lambda: api._collection_stats(database=database, collection=collection)  # noqa: E731
+
+            return self.get(key, fetch, refresh)[0]
+
+        if not collections:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=min(self.stats_workers, len(collections))) as pool:
+            return dict(zip(collections, pool.map(stats, collections)))
+
+    def names(self, instance, api, database=None):
+        """The cached database names of an instance, or collection names of a database, for tab completion.
+            Missing names are fetched in the background, so they're there on the next completion.
+
+        Returns:
+            names (list): the names, empty if they're not cached yet
+        """
+
+        if database is None:
+            databases, _ = self.databases(instance, api, wait=False)
+            return [db["name"] for db in databases or []]
+
+        collections, _ = self.collections(instance, api, database, wait=False)
+        return [collection["name"] for collection in collections or []]
+
+    def clear(self, instance=None):
+        """Forget the cached metadata of one instance, or of every instance
+
+        Returns:
+            removed (int): the number of entries removed
+        """
+
+        with self.lock:
+            keys = [key for key in self.entries if instance is None or key[1] == instance]
+            for key in keys:
+                del self.entries[key]
+
+        return len(keys)
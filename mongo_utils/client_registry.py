@@ -0,0 +1,84 @@
+import hashlib
+import threading
+
+
+class ClientRegistry:
+    """A process-wide registry of pymongo MongoClients.
+        Note: a MongoClient owns a connection pool and monitor threads, so
+        clients are shared across instances and reconnects that use the same
+        host, port, user and options instead of building one per connect.
+        Every client reports its commands to the query stats.
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def key(self, host, port, username, password, **options):
+        """Build the registry key for a client.
+            The password is hashed, so a changed password gets a new client
+
+        Returns:
+            key (tuple): a hashable key
+        """
+
+        password_hash = hashlib.sha256((password or "").encode("utf-8")).hexdigest()
+
+        return (host, str(port), username, password_hash, tuple(sorted(options.items())))
+
+    def get_client(self, host, port, username, password, **options):
+        """Return the shared client for these settings, creating it if needed
+
+        Returns:
+            client (MongoClient): the shared client
+            created (bool): whether the client was created by this call
+        """
+
+        # pymongo is imported on first use, to keep loading the extension fast
+        import pymongo
+        from mongo_utils.command_monitor import command_monitor
+
+        key = self.key(host, port, username, password, **options)
+
+        with self.lock:
+            client = self.clients.get(key)
+
+            if client is not None:
+                return client, False
+
+            client = pymongo.MongoClient(
+                host=f"{host}:{port}",
+                username=username,
+                password=password,
+                event_listeners=[command_monitor],
+                **options
+            )
+            self.clients[key] = client
+
+        return client, True
+
+    def discard(self, client):
+        """Remove a client from the registry and close it, e.g. after it failed to authenticate
+
+        Args:
+            client (MongoClient): the client to remove
+        """
+
+        with self.lock:
+            for key in [k for k, v in self.clients.items() if v is client]:
+                del self.clients[key]
+
+        client.close()
+
+    def close_all(self):
+        """Close every registered client"""
+
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients.clear()
+
+        for client in clients:
+            client.close()
+
+
+client_registry = ClientRegistry()
@@ -0,0 +1,24 @@
+from pymongo import monitoring
+from mongo_utils.query_stats import query_stats
+
+
+class CommandMonitor(monitoring.CommandListener):
+    """A pymongo command listener that feeds the query stats.
+        Note: it's registered on every client the registry creates. Commands
+        issued outside of a tracked query are ignored after a dict lookup.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def started(self, event):
+        self.stats._command_started(event)
+
+    def succeeded(self, event):
+        self.stats._command_succeeded(event)
+
+    def failed(self, event):
+        self.stats._command_failed(event)
+
+
+command_monitor = CommandMonitor(query_stats)
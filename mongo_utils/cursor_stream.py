@@ -0,0 +1,266 @@
+import threading
+import time
+from itertools import islice
+
+
+class QueryCancelled(Exception):
+    """Raised by a stream whose query was cancelled while it was being drained"""
+
+
+class ResultTooLarge(Exception):
+    """Raised when a result is, or would be, over the max_result_docs or max_result_mb budget"""
+
+    alternatives = "Narrow the filter, add --limit, project fewer fields with --fields, --spill the result to disk, " \
+                   "or re-run with --no-guardrails"
+
+
+class ResultBudget:
+    """The document and byte limits of a result, shared by the streams (partitions) filling it.
+        Note: raw batches (--raw) are charged their exact BSON size. Decoded
+        batches are charged the BSON size of an even sample of their documents,
+        scaled up to the whole batch, so projected results and collections
+        without stats are sized too.
+    """
+
+    sample_size = 16
+
+    def __init__(self, max_documents=0, max_bytes=0):
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.documents = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def charge(self, documents, nbytes):
+        """Count a batch against the budget
+
+        Args:
+            documents (int): the number of documents in the batch
+            nbytes (int): the size of the batch
+
+        Raises:
+            ResultTooLarge: if the result is now over the budget
+        """
+
+        with self.lock:
+            self.documents += documents
+            self.bytes += nbytes
+
+        if self.max_documents and self.documents > self.max_documents:
+            raise ResultTooLarge(f"Aborted the query after {self.documents:,} documents, over the max_result_docs "
+                                 f"budget of {self.max_documents:,}. {ResultTooLarge.alternatives}")
+
+        if self.max_bytes and self.bytes > self.max_bytes:
+            raise ResultTooLarge(f"Aborted the query after {self.bytes / (1024 * 1024):,.0f} MB, over the "
+                                 f"max_result_mb budget of {self.max_bytes / (1024 * 1024):,.0f} MB. "
+                                 f"{ResultTooLarge.alternatives}")
+
+    def measure(self, batch):
+        """Estimate the BSON size of a batch of decoded documents from an even sample of them
+
+        Args:
+            batch (list): the documents
+
+        Returns:
+            nbytes (int): the estimated size, or 0 when there's no byte budget to charge it to
+        """
+
+        if not self.max_bytes or not batch:
+            return 0
+
+        import bson
+
+        sample = batch[::max(len(batch) // self.sample_size, 1)]
+
+        return sum(len(bson.encode(document)) for document in sample) * len(batch) // len(sample)
+
+
+class CursorStream:
+    """Iterate a pymongo cursor in batches (lists) of documents.
+        Note: the full result is never held as a single list. Consumers
+        pull one batch at a time and the server cursor is closed as soon
+        as iteration finishes, fails, or is interrupted. The time spent
+        fetching and decoding batches is kept in seconds.
+    """
+
+    def __init__(self, cursor, batch_size):
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.budget = None
+        self.documents = 0
+        self.batches = 0
+        self.seconds = 0.0
+        self.cancelled = False
+
+    @property
+    def cursors(self):
+        return [self.cursor]
+
+    def __iter__(self):
+        cursor = self.cursor
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = list(islice(cursor, self.batch_size))
+                self.seconds += time.perf_counter() - start
+                if self.cancelled:
+                    raise QueryCancelled("The query was cancelled")
+                if not batch:
+                    break
+
+                self.documents += len(batch)
+                self.batches += 1
+
+                if self.budget is not None:
+                    self.budget.charge(len(batch), self.budget.measure(batch))
+
+                yield batch
+
+        finally:
+            cursor.close()
+
+    def close(self):
+        """Close the underlying cursor, releasing it on the server"""
+        self.cursor.close()
+
+    def cancel(self):
+        """Flag the stream as cancelled, it stops at the next batch boundary"""
+        self.cancelled = True
+
+
+class RawCursorStream(CursorStream):
+    """Iterate a raw batch cursor (find_raw_batches / aggregate_raw_batches).
+        Note: each server batch arrives as a single BSON byte string and is
+        decoded with one bson.decode_all call, instead of paying the cursor's
+        per-document iteration overhead.
+    """
+
+    def __init__(self, cursor, batch_size, codec_options=None):
+        import bson
+
+        super(RawCursorStream, self).__init__(cursor, batch_size)
+        self.codec_options = codec_options or bson.DEFAULT_CODEC_OPTIONS
+        self.bytes = 0
+
+    def __iter__(self):
+        import bson
+
+        cursor = self.cursor
+        try:
+            start = time.perf_counter()
+            for raw_batch in cursor:
+                if self.cancelled:
+                    raise QueryCancelled("The query was cancelled")
+
+                self.bytes += len(raw_batch)
+
+                batch = bson.decode_all(raw_batch, self.codec_options)
+                self.seconds += time.perf_counter() - start
+
+                if batch:
+                    self.documents += len(batch)
+                    self.batches += 1
+
+                    if self.budget is not None:
+                        self.budget.charge(len(batch), len(raw_batch))
+
+                    yield batch
+
+                start = time.perf_counter()
+
+        finally:
+            cursor.close()
+
+
+class PartitionedStream:
+    """A set of streams over disjoint ranges of a collection.
+        Note: the streams are meant to be drained concurrently, up to
+        workers at a time, and their results combined in stream order.
+    """
+
+    def __init__(self, streams, workers):
+        self.streams = streams
+        self.workers = workers
+
+    @property
+    def cursors(self):
+        return [cursor for stream in self.streams for cursor in stream.cursors]
+
+    @property
+    def documents(self):
+        return sum(stream.documents for stream in self.streams)
+
+    @property
+    def batches(self):
+        return sum(stream.batches for stream in self.streams)
+
+    @property
+    def seconds(self):
+        return sum(stream.seconds for stream in self.streams)
+
+    @property
+    def bytes(self):
+        return sum(getattr(stream, "bytes", 0) for stream in self.streams)
+
+    def close(self):
+        """Close every partition's cursor"""
+        for stream in self.streams:
+            stream.close()
+
+    def cancel(self):
+        """Flag every partition as cancelled"""
+        for stream in self.streams:
+            stream.cancel()
+
+
+class ChangeStreamTail:
+    """Iterate the documents inserted into a collection, from a change stream, in batches.
+        Note: a batch is yielded once it's batch_size long, or as soon as the
+        stream goes quiet (for the change stream's max_await_time_ms) with
+        documents pending. It runs until it's cancelled, and the change stream
+        is closed on the way out.
+    """
+
+    def __init__(self, change_stream, batch_size):
+        self.change_stream = change_stream
+        self.batch_size = batch_size
+        self.documents = 0
+        self.batches = 0
+        self.seconds = 0.0
+        self.cancelled = False
+
+    @property
+    def cursors(self):
+        # The change stream's cursor is closed by the tail itself
+        return []
+
+    def __iter__(self):
+        batch = []
+        try:
+            while not self.cancelled:
+                start = time.perf_counter()
+                change = self.change_stream.try_next()
+                self.seconds += time.perf_counter() - start
+
+                if change is not None:
+                    batch.append(change["fullDocument"])
+
+                if batch and (change is None or len(batch) >= self.batch_size):
+                    self.documents += len(batch)
+                    self.batches += 1
+
+                    yield batch
+
+                    batch = []
+
+            raise QueryCancelled("The change stream was cancelled")
+
+        finally:
+            self.change_stream.close()
+
+    def close(self):
+        self.change_stream.close()
+
+    def cancel(self):
+        """Flag the tail as cancelled, it stops the next time the change stream goes quiet or returns"""
+        self.cancelled = True
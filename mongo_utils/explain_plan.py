@@ -0,0 +1,181 @@
+# Query operators that match a range of values, rather than a single value
+RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte", "$ne", "$nin", "$regex", "$exists", "$not", "$type", "$size",
+                   "$elemMatch", "$mod", "$all"}
+
+# A stage examining more documents than this per returned document is reported as unselective
+UNSELECTIVE_RATIO = 10
+
+
+def plan_sections(explain, shard=None):
+    """Find the query plans in an explain output.
+        Note: the plans are at the top for find, inside the $cursor stage of an
+        aggregation, and inside each shard's output on a sharded cluster.
+
+    Args:
+        explain (dict): the output of the explain command
+        shard (str): the shard the output came from, if any
+
+    Returns:
+        sections (list): a list of (shard, queryPlanner, executionStats) tuples
+    """
+
+    sections = []
+
+    if "queryPlanner" in explain:
+        sections.append((shard, explain["queryPlanner"], explain.get("executionStats") or {}))
+
+    for stage in explain.get("stages") or []:
+        if "$cursor" in stage:
+            sections.extend(plan_sections(stage["$cursor"], shard))
+
+    for name, output in (explain.get("shards") or {}).items():
+        sections.extend(plan_sections(output, name))
+
+    return sections
+
+
+def plan_stages(stage, shard=None, depth=0):
+    """Flatten a plan tree into one row per stage, parents first
+
+    Args:
+        stage (dict): a winningPlan or executionStages tree
+        shard (str): the shard the plan runs on, if any
+        depth (int): the depth of the stage in the tree
+
+    Returns:
+        rows (list): a list of dicts describing each stage
+    """
+
+    # The slot based engine nests the classic plan under "queryPlan"
+    if "queryPlan" in stage and "stage" not in stage:
+        stage = stage["queryPlan"]
+
+    rows = [{
+        "shard": shard,
+        "depth": depth,
+        "stage": stage.get("stage"),
+        "index": stage.get("indexName"),
+        "key_pattern": stage.get("keyPattern"),
+        "direction": stage.get("direction"),
+        "returned": stage.get("nReturned"),
+        "keys_examined": stage.get("keysExamined"),
+        "docs_examined": stage.get("docsExamined"),
+        "time_ms": stage.get("executionTimeMillisEstimate"),
+        "uses_disk": stage.get("usedDisk"),
+        "filter": stage.get("filter")
+    }]
+
+    children = list(stage.get("inputStages") or [])
+    if stage.get("inputStage"):
+        children.insert(0, stage["inputStage"])
+
+    for child in children:
+        rows.extend(plan_stages(child, shard, depth + 1))
+
+    # A mongos merges the plans of the shards
+    for shard_plan in stage.get("shards") or []:
+        child = shard_plan.get("executionStages") or shard_plan.get("winningPlan")
+        if child:
+            rows.extend(plan_stages(child, shard_plan.get("shardName"), depth + 1))
+
+    return rows
+
+
+def query_shape(command, query, sort=None):
+    """Pull the filter and sort a command runs with, e.g. from the first $match and $sort of a pipeline
+
+    Args:
+        command (str): find, count_documents or aggregate
+        query (list): the positional query args, or the pipeline
+        sort (list): the (field, direction) pairs from --sort
+
+    Returns:
+        query_filter (dict): the filter
+        sort (list): the (field, direction) pairs
+    """
+
+    if command != "aggregate":
+        return (query[0] if query else {}), list(sort or [])
+
+    query_filter, pipeline_sort = {}, []
+
+    for stage in query:
+        if "$match" in stage and not query_filter and not pipeline_sort:
+            query_filter = stage["$match"]
+        elif "$sort" in stage and not pipeline_sort:
+            pipeline_sort = list(stage["$sort"].items())
+        else:
+            break
+
+    return query_filter, pipeline_sort
+
+
+def suggest_index(query_filter, sort=None):
+    """Suggest an index for a filter and sort, following the Equality, Sort, Range rule:
+        fields matched on a single value first, then the sort keys, then fields matched on a range.
+
+    Args:
+        query_filter (dict): the query filter
+        sort (list): the (field, direction) pairs
+
+    Returns:
+        keys (list): the (field, direction) pairs of the candidate index, empty if there's nothing to index
+    """
+
+    equality, ranges = [], []
+
+    def collect(conditions):
+        for field, condition in conditions.items():
+            if field == "$and":
+                for clause in condition:
+                    collect(clause)
+            elif field.startswith("$"):
+                # $or, $expr, $text, ... can't be served by a single compound index
+                continue
+            elif isinstance(condition, dict) and any(k.startswith("$") for k in condition) and \
+                    (len(condition) > 1 or next(iter(condition)) in RANGE_OPERATORS):
+                ranges.append(field)
+            else:
+                equality.append(field)
+
+    collect(query_filter or {})
+
+    keys = []
+    for field, direction in [(f, 1) for f in equality] + list(sort or []) + [(f, 1) for f in ranges]:
+        if field not in dict(keys):
+            keys.append((field, direction))
+
+    return keys
+
+
+def plan_warnings(rows, namespace):
+    """Describe the problems in a plan, e.g. collection scans and in-memory sorts
+
+    Args:
+        rows (list): the stages from plan_stages
+        namespace (str): the database.collection the plan runs on
+
+    Returns:
+        warnings (list): a list of messages
+    """
+
+    warnings = []
+
+    for row in rows:
+        where = f" on shard {row['shard']}" if row["shard"] else ""
+        docs_examined, returned = row["docs_examined"], row["returned"]
+
+        if row["stage"] == "COLLSCAN":
+            examined = f", examining {docs_examined} documents to return {returned}" if docs_examined is not None \
+                else ""
+            warnings.append(f"COLLSCAN{where}: the query scans every document of {namespace}{examined}")
+
+        elif row["stage"] == "SORT":
+            disk = " and spilled to disk" if row["uses_disk"] else ""
+            warnings.append(f"SORT{where}: the results are sorted in memory{disk}, no index provides the sort order")
+
+        elif row["stage"] == "FETCH" and docs_examined and docs_examined > UNSELECTIVE_RATIO * max(returned or 0, 1):
+            warnings.append(f"FETCH{where}: {docs_examined} documents examined to return {returned}, "
+                            "the index used isn't selective for this filter")
+
+    return warnings
@@ -0,0 +1,371 @@
+import os
+import time
+
+# The compressions of each export format, the first one is the default
+EXPORT_COMPRESSIONS = {
+    "csv": ["none", "gzip", "bz2", "xz"],
+    "jsonl": ["none", "gzip", "bz2", "xz"],
+    "parquet": ["snappy", "none", "gzip", "zstd", "brotli", "lz4"]
+}
+
+# The export format and compression implied by a file extension
+EXPORT_EXTENSIONS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl", ".json": "jsonl", ".parquet": "parquet",
+                     ".pq": "parquet"}
+COMPRESSION_EXTENSIONS = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz"}
+
+
+def export_writer(path, format=None, compression=None, chunk_size=None, flattener=None, overwrite=False):
+    """Create the writer of an export, picking the format and compression from the file extension if they're not given
+
+    Args:
+        path (str): the file to write
+        format (str): csv, jsonl or parquet
+        compression (str): one of EXPORT_COMPRESSIONS for the format
+        chunk_size (int): the number of rows per write, and per Parquet row group
+        flattener (DocumentFlattener): flattens nested documents into dotted-path columns, if any
+        overwrite (bool): replace the file if it exists
+
+    Returns:
+        writer (ExportWriter): the writer
+    """
+
+    path = os.path.expanduser(path)
+    stem, extension = os.path.splitext(path.lower())
+
+    if compression is None and extension in COMPRESSION_EXTENSIONS:
+        compression = COMPRESSION_EXTENSIONS[extension]
+        extension = os.path.splitext(stem)[1]
+
+    format = format or EXPORT_EXTENSIONS.get(extension)
+
+    if format is None:
+        raise ValueError(f"Can't tell the export format from {path}, use --format csv, jsonl or parquet")
+
+    compression = compression or EXPORT_COMPRESSIONS[format][0]
+
+    if compression not in EXPORT_COMPRESSIONS[format]:
+        raise ValueError(f"{format} exports can't be compressed with {compression}, expected one of "
+                         f"{', '.join(EXPORT_COMPRESSIONS[format])}")
+
+    if os.path.exists(path) and not overwrite:
+        raise ValueError(f"{path} already exists, use --overwrite to replace it")
+
+    writers = {"csv": CsvExportWriter, "jsonl": JsonlExportWriter, "parquet": ParquetExportWriter}
+
+    return writers[format](path, compression, chunk_size, flattener)
+
+
+class ExportWriter:
+    """Write batches of documents to a local file, a chunk of rows at a time.
+        Note: only the current chunk is held in memory, so an export of any
+        size runs in constant memory. The file is written under a .partial
+        name and only renamed to its final name once the export finishes.
+    """
+
+    format = None
+
+    def __init__(self, path, compression, chunk_size=None, flattener=None):
+        self.path = path
+        self.partial_path = f"{path}.partial"
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.flattener = flattener
+        self.chunk = []
+        self.rows = 0
+        self.warnings = []
+        self.started = time.perf_counter()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, batch):
+        """Add a batch of documents, writing a chunk once chunk_size rows are buffered
+
+        Args:
+            batch (list): a list of documents (dicts)
+        """
+
+        if self.flattener is not None:
+            batch = self.flattener.flatten_batch(batch)
+
+        self.chunk.extend(batch)
+        self._flush(final=False)
+
+    def consume(self, batches):
+        """Write every batch from an iterable of batches, e.g. a CursorStream
+
+        Returns:
+            self (ExportWriter): the writer, so calls can be chained
+        """
+
+        for batch in batches:
+            self.write(batch)
+
+        return self
+
+    def _flush(self, final=True):
+        """Write the buffered rows chunk_size at a time, and what's left over if it's the final flush.
+            Without a chunk_size, every batch is written as it arrives.
+        """
+
+        chunk_size = self.chunk_size or len(self.chunk)
+
+        while self.chunk and (final or len(self.chunk) >= chunk_size):
+            rows, self.chunk = self.chunk[:chunk_size], self.chunk[chunk_size:]
+            self._write_chunk(rows)
+            self.rows += len(rows)
+
+    def _write_chunk(self, rows):
+        raise NotImplementedError
+
+    def _finish(self):
+        raise NotImplementedError
+
+    def close(self):
+        """Write the last chunk and move the file to its final name
+
+        Returns:
+            summary (dict): the file, the rows and bytes written, and how fast they were written
+        """
+
+        self._flush()
+        self._finish()
+        os.replace(self.partial_path, self.path)
+
+        seconds = max(time.perf_counter() - self.started, 1e-9)
+        size = os.path.getsize(self.path)
+
+        return {"path": self.path, "format": self.format, "compression": self.compression, "rows": self.rows,
+                "bytes": size, "seconds": seconds, "rows_per_second": self.rows / seconds,
+                "mb_per_second": size / (1024 * 1024) / seconds}
+
+    def abort(self):
+        """Stop the export and remove the partially written file"""
+
+        try:
+            self._finish()
+        finally:
+            if os.path.exists(self.partial_path):
+                os.remove(self.partial_path)
+
+
+class _TextExportWriter(ExportWriter):
+    """Write an export to a text file, compressed on the fly with gzip, bz2 or xz"""
+
+    def __init__(self, path, compression, chunk_size=None, flattener=None):
+        super(_TextExportWriter, self).__init__(path, compression, chunk_size, flattener)
+
+        if compression == "gzip":
+            import gzip
+            self.file = gzip.open(self.partial_path, "wt", encoding="utf-8", newline="")
+        elif compression == "bz2":
+            import bz2
+            self.file = bz2.open(self.partial_path, "wt", encoding="utf-8", newline="")
+        elif compression == "xz":
+            import lzma
+            self.file = lzma.open(self.partial_path, "wt", encoding="utf-8", newline="")
+        else:
+            self.file = open(self.partial_path, "w", encoding="utf-8", newline="")
+
+    def _finish(self):
+        self.file.close()
+
+
+class CsvExportWriter(_TextExportWriter):
+    """Write an export as CSV.
+        Note: the header is the columns of the first chunk. Columns that
+        first appear later are left out, and reported once the export is
+        done. Sub-documents and arrays are written as extended JSON.
+    """
+
+    format = "csv"
+
+    def __init__(self, path, compression, chunk_size=None, flattener=None):
+        super(CsvExportWriter, self).__init__(path, compression, chunk_size, flattener)
+        self.writer = None
+        self.dropped = set()
+
+    def _write_chunk(self, rows):
+        import csv
+        from bson import json_util
+
+        if self.writer is None:
+            columns = list(dict.fromkeys(key for row in rows for key in row))
+            self.writer = csv.DictWriter(self.file, columns, extrasaction="ignore")
+            self.writer.writeheader()
+
+        header = set(self.writer.fieldnames)
+
+        for row in rows:
+            self.dropped.update(key for key in row if key not in header)
+
+        def cell(value):
+            if isinstance(value, (dict, list)):
+                return json_util.dumps(value, json_options=json_util.RELAXED_JSON_OPTIONS)
+            return value
+
+        self.writer.writerows({key: cell(value) for key, value in row.items()} for row in rows)
+
+    def _finish(self):
+        if self.dropped:
+            self.warnings = [f"Columns that first appeared after the CSV header was written were left out: "
+                             f"{', '.join(sorted(map(str, self.dropped)))}. Pick the columns with --fields"]
+
+        super(CsvExportWriter, self)._finish()
+
+
+class JsonlExportWriter(_TextExportWriter):
+    """Write an export as JSON lines (relaxed extended JSON), one document per line"""
+
+    format = "jsonl"
+
+    def _write_chunk(self, rows):
+        from bson import json_util
+
+        options = json_util.RELAXED_JSON_OPTIONS
+
+        self.file.write("".join(json_util.dumps(row, json_options=options) + "\n" for row in rows))
+
+
+class ParquetExportWriter(ExportWriter):
+    """Write an export as a Parquet file, one row group per chunk.
+        Note: the schema is the columns and types of the first chunk, and
+        columns that are entirely empty so far are written as strings. When
+        a later chunk widens a column, e.g. ints to doubles or an empty column
+        to a type, the row groups written so far are rewritten with the wider
+        schema. Other chunks are cast to it. Columns that first appear later
+        are left out.
+    """
+
+    format = "parquet"
+
+    def __init__(self, path, compression, chunk_size=None, flattener=None):
+        try:
+            # pyarrow is imported on first use, it's only needed for Parquet exports
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("Exporting to Parquet needs pyarrow, install it with `pip install pyarrow`")
+
+        super(ParquetExportWriter, self).__init__(path, compression, chunk_size, flattener)
+        self.writer = None
+        self.schema = None
+        self.untyped = set()
+        self.dropped = set()
+
+    def _write_chunk(self, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        from mongo_utils.frame_builder import FrameBuilder
+        from mongo_utils.spill import arrow_table
+
+        table = arrow_table(FrameBuilder().consume([rows]).to_frame())
+
+        if self.writer is None:
+            self.untyped = {field.name for field in table.schema if pa.types.is_null(field.type)}
+            self.schema = pa.schema([pa.field(field.name, pa.string()) if field.name in self.untyped else field
+                                     for field in table.schema])
+            self.writer = pq.ParquetWriter(self.partial_path, self.schema, compression=self.compression)
+
+        schema = self._widen(table.schema)
+        if not schema.equals(self.schema):
+            self._rewrite(schema)
+
+        self.dropped.update(name for name in table.column_names if name not in self.schema.names)
+        self.writer.write_table(self._conform(table), row_group_size=len(rows))
+
+    def _widen(self, chunk_schema):
+        """Widen the export's schema to hold a chunk: empty columns take the chunk's type, and ints
+            become doubles when the chunk has doubles
+
+        Returns:
+            schema (Schema): the export's schema, or a wider one
+        """
+
+        import pyarrow as pa
+
+        fields = []
+        for field in self.schema:
+            index = chunk_schema.get_field_index(field.name)
+            chunk_type = chunk_schema.field(index).type if index >= 0 else pa.null()
+
+            if pa.types.is_null(chunk_type) or chunk_type == field.type:
+                fields.append(field)
+            elif field.name in self.untyped:
+                self.untyped.discard(field.name)
+                fields.append(pa.field(field.name, chunk_type))
+            elif pa.types.is_integer(field.type) and pa.types.is_floating(chunk_type):
+                fields.append(pa.field(field.name, pa.float64()))
+            else:
+                fields.append(field)
+
+        return pa.schema(fields)
+
+    def _rewrite(self, schema):
+        """Rewrite the row groups written so far with a wider schema, one row group at a time"""
+
+        import pyarrow.parquet as pq
+
+        self.writer.close()
+
+        written = f"{self.partial_path}.widening"
+        os.replace(self.partial_path, written)
+
+        try:
+            self.writer = pq.ParquetWriter(self.partial_path, schema, compression=self.compression)
+            source = pq.ParquetFile(written)
+
+            for index in range(source.num_row_groups):
+                row_group = source.read_row_group(index).cast(schema)
+                self.writer.write_table(row_group, row_group_size=row_group.num_rows)
+        finally:
+            os.remove(written)
+
+        self.schema = schema
+
+    def _conform(self, table):
+        """Cast a chunk to the export's schema, filling in the columns it doesn't have"""
+
+        import pyarrow as pa
+
+        arrays = []
+        for field in self.schema:
+            if field.name not in table.column_names:
+                arrays.append(pa.nulls(table.num_rows, field.type))
+                continue
+
+            column = table.column(field.name)
+
+            if column.type == field.type:
+                arrays.append(column)
+                continue
+
+            try:
+                arrays.append(column.cast(field.type))
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                if not pa.types.is_string(field.type):
+                    raise ValueError(f"Column {field.name} changes type from {field.type} to {column.type} after "
+                                     f"row {self.rows}. Leave it out with --fields, or export to csv or jsonl")
+
+                arrays.append(pa.array([None if value is None else str(value) for value in column.to_pylist()],
+                                       pa.string()))
+
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def _finish(self):
+        if self.dropped:
+            self.warnings = [f"Columns that first appeared after the first Parquet row group were left out: "
+                             f"{', '.join(sorted(map(str, self.dropped)))}. Pick the columns with --fields"]
+
+        if self.writer is not None:
+            self.writer.close()
+
+    def close(self):
+        if self.writer is None and not self.chunk:
+            # An empty result is still written as a valid (empty) file
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            pq.write_table(pa.table({}), self.partial_path, compression=self.compression)
+
+        return super(ParquetExportWriter, self).close()
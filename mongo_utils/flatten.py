@@ -0,0 +1,101 @@
+class DocumentFlattener:
+    """Flatten nested documents into dotted-path fields, e.g. {"a": {"b": 1}} into {"a.b": 1}.
+        Note: arrays are kept as lists, joined into a comma separated string,
+        or exploded into one row per element (like DataFrame.explode, so a
+        document with two arrays gets a row per combination). Documents inside
+        exploded arrays are flattened under the array's path. Arrays nested
+        inside array elements are kept.
+    """
+
+    array_policies = ["keep", "join", "explode"]
+
+    def __init__(self, max_depth=None, arrays="keep"):
+        if arrays not in self.array_policies:
+            raise ValueError(f"Unknown array policy {arrays!r}, expected one of {', '.join(self.array_policies)}")
+
+        self.max_depth = max_depth or None
+        self.arrays = arrays
+
+    def flatten_batch(self, batch):
+        """Flatten a batch of documents
+
+        Args:
+            batch (list): a list of documents (dicts)
+
+        Returns:
+            flat_batch (list): the flattened documents, more of them than in batch if arrays are exploded
+        """
+
+        flat_batch = []
+        append = flat_batch.append
+        flatten = self._flatten
+
+        for document in batch:
+            flat = {}
+            lists = flatten(document, "", 1, flat)
+
+            if lists and self.arrays == "explode":
+                flat_batch.extend(self._explode(flat, lists))
+            else:
+                append(flat)
+
+        return flat_batch
+
+    def _flatten(self, document, prefix, depth, flat):
+        """Copy a document's fields into flat under prefix, recursing into sub-documents
+
+        Returns:
+            lists (list): the paths that hold arrays, to explode
+        """
+
+        lists = []
+        expand = self.max_depth is None or depth <= self.max_depth
+
+        for key, value in document.items():
+            path = prefix + key
+            value_type = type(value)
+
+            if value_type is dict and value and expand:
+                lists.extend(self._flatten(value, path + ".", depth + 1, flat))
+
+            elif value_type is list:
+                if self.arrays == "join":
+                    flat[path] = ",".join(map(str, value))
+                else:
+                    flat[path] = value
+                    lists.append(path)
+
+            else:
+                flat[path] = value
+
+        return lists
+
+    def _explode(self, flat, lists):
+        rows = [flat]
+
+        for path in lists:
+            depth = path.count(".") + 1
+            exploded = []
+
+            for row in rows:
+                values = row[path]
+
+                if not values:
+                    row[path] = None
+                    exploded.append(row)
+                    continue
+
+                for value in values:
+                    element_row = dict(row)
+
+                    if type(value) is dict and value and (self.max_depth is None or depth <= self.max_depth):
+                        del element_row[path]
+                        self._flatten(value, path + ".", depth + 1, element_row)
+                    else:
+                        element_row[path] = value
+
+                    exploded.append(element_row)
+
+            rows = exploded
+
+        return rows
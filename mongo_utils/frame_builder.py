@@ -0,0 +1,428 @@
+class FrameBuilder:
+    """Build a DataFrame from batches of Mongo documents.
+        Note: each batch is appended into per-column buffers, so the
+        documents of a batch can be released as soon as it's consumed.
+        Fields missing from a document are filled with None, matching
+        what pandas does for a list of dicts. With a flattener, nested
+        documents are flattened into dotted-path columns as they're appended.
+    """
+
+    def __init__(self, flattener=None):
+        self.columns = {}
+        self.rows = 0
+        self.flattener = flattener
+
+    def append(self, batch):
+        """Append a batch of documents to the column buffers
+
+        Args:
+            batch (list): a list of documents (dicts)
+        """
+
+        if self.flattener is not None:
+            batch = self.flattener.flatten_batch(batch)
+
+        columns = self.columns
+        row = self.rows
+
+        for document in batch:
+            for key, value in document.items():
+                column = columns.get(key)
+
+                if column is None:
+                    column = columns[key] = [None] * row
+                elif len(column) < row:
+                    column.extend([None] * (row - len(column)))
+
+                column.append(value)
+
+            row += 1
+
+        for column in columns.values():
+            if len(column) < row:
+                column.extend([None] * (row - len(column)))
+
+        self.rows = row
+
+    def consume(self, batches):
+        """Append every batch from an iterable of batches
+
+        Args:
+            batches (iterable): an iterable of lists of documents, e.g. a CursorStream
+
+        Returns:
+            self (FrameBuilder): the builder, so calls can be chained
+        """
+
+        for batch in batches:
+            self.append(batch)
+
+        return self
+
+    def extend(self, other):
+        """Append another builder's rows after this builder's rows.
+            The other builder's buffers are handed over and it's left empty.
+
+        Args:
+            other (FrameBuilder): the builder to take the rows from
+
+        Returns:
+            self (FrameBuilder): the builder, so calls can be chained
+        """
+
+        columns = self.columns
+        rows = self.rows + other.rows
+
+        for key in list(other.columns):
+            column = columns.get(key)
+
+            if column is None:
+                column = columns[key] = [None] * self.rows
+
+            column.extend(other.columns.pop(key))
+
+        for column in columns.values():
+            if len(column) < rows:
+                column.extend([None] * (rows - len(column)))
+
+        self.rows = rows
+        other.rows = 0
+
+        return self
+
+    def to_frame(self):
+        """Convert the column buffers into a DataFrame.
+            Note: buffers are released one column at a time as they're
+            converted, so the peak stays close to the final DataFrame.
+
+        Returns:
+            dataframe (DataFrame): the built DataFrame
+        """
+
+        # pandas is imported on first use, to keep loading the extension fast
+        import pandas as pd
+
+        data = {}
+
+        for key in list(self.columns):
+            data[key] = pd.Series(self.columns.pop(key))
+
+        self.rows = 0
+
+        return pd.DataFrame(data, copy=False)
+
+
+class TypedFrameBuilder(FrameBuilder):
+    """Build a DataFrame with compact dtypes from batches of Mongo documents.
+        Note: each column's kind is inferred from the first batch it appears
+        in, and every batch is converted to a typed chunk (int32/int64, float32
+        when lossless, bool, datetime64, categorical for low cardinality
+        strings, ObjectId as str or 12 byte values) as soon as it's appended,
+        so the Python objects of a batch are released right away. A batch that
+        doesn't fit its column's kind promotes the column, ints to floats and
+        anything else to strings or objects.
+    """
+
+    def __init__(self, objectid_dtype="string", category_ratio=0.5, flattener=None):
+        super(TypedFrameBuilder, self).__init__(flattener)
+        self.objectid_dtype = objectid_dtype
+        self.category_ratio = category_ratio
+        self.chunks = {}
+        self.kinds = {}
+
+    def append(self, batch):
+        """Append a batch of documents as a typed chunk of each column
+
+        Args:
+            batch (list): a list of documents (dicts)
+        """
+
+        rows = self.rows
+
+        # The parent fills self.columns with this batch's values, padded with None
+        self.rows = 0
+        super(TypedFrameBuilder, self).append(batch)
+        size = self.rows
+        self.rows = rows + size
+
+        if not size:
+            return
+
+        # Columns missing from this batch get a placeholder for size nulls
+        for key in self.chunks.keys() - self.columns.keys():
+            self.chunks[key].append(size)
+
+        for key in list(self.columns):
+            values = self.columns.pop(key)
+
+            if key not in self.chunks:
+                self.chunks[key] = [rows] if rows else []
+
+            # _convert may retype the column's earlier chunks, so it runs before they're looked up
+            chunk = self._convert(key, values)
+            self.chunks[key].append(chunk)
+
+    def extend(self, other):
+        """Append another typed builder's rows after this builder's rows.
+            The other builder's chunks are handed over and it's left empty.
+
+        Args:
+            other (TypedFrameBuilder): the builder to take the rows from
+
+        Returns:
+            self (TypedFrameBuilder): the builder, so calls can be chained
+        """
+
+        for key in list(self.chunks) + [key for key in other.chunks if key not in self.chunks]:
+            chunks = self.chunks.setdefault(key, [self.rows] if self.rows else [])
+            other_chunks = other.chunks.pop(key, [other.rows] if other.rows else [])
+
+            kind = self._merge_kinds(self.kinds.get(key), other.kinds.get(key))
+            chunks[:] = self._retype(chunks, self.kinds.get(key), kind)
+            chunks.extend(self._retype(other_chunks, other.kinds.get(key), kind))
+            self.kinds[key] = kind
+
+        self.rows += other.rows
+        other.rows = 0
+        other.kinds = {}
+
+        return self
+
+    def to_frame(self):
+        """Concatenate each column's chunks into a DataFrame.
+            Note: chunks are released one column at a time as they're combined.
+
+        Returns:
+            dataframe (DataFrame): the built DataFrame
+        """
+
+        import pandas as pd
+        from pandas.api.types import union_categoricals
+
+        data = {}
+
+        for key in list(self.chunks):
+            kind = self.kinds.get(key)
+            chunks = self.chunks.pop(key)
+            chunks = [self._nulls(kind, chunk, chunks) if isinstance(chunk, int) else chunk for chunk in chunks]
+
+            if len(chunks) == 1:
+                data[key] = pd.Series(chunks[0])
+            elif kind == "category":
+                data[key] = pd.Series(union_categoricals(chunks))
+            else:
+                data[key] = pd.concat([pd.Series(chunk) for chunk in chunks], ignore_index=True)
+
+        self.rows = 0
+        self.kinds = {}
+
+        return pd.DataFrame(data, copy=False)
+
+    def _kind(self, values):
+        """Infer the kind of a list of values from the types it holds"""
+
+        from datetime import datetime
+        from bson import ObjectId
+
+        types = set(map(type, values))
+        types.discard(type(None))
+
+        if not types:
+            return None
+
+        if types == {bool}:
+            return "bool"
+
+        if all(issubclass(t, int) and t is not bool for t in types):
+            return "int"
+
+        if float in types and all(t is float or (issubclass(t, int) and t is not bool) for t in types):
+            return "float"
+
+        if types == {datetime}:
+            return "datetime"
+
+        if types == {str}:
+            return "category" if self._low_cardinality(values) else "string"
+
+        if types == {ObjectId}:
+            return "objectid"
+
+        return "object"
+
+    def _low_cardinality(self, values):
+        return len(set(values)) <= self.category_ratio * len(values)
+
+    def _merge_kinds(self, kind, other):
+        if kind is None or kind == other:
+            return other or kind
+
+        if other is None:
+            return kind
+
+        if {kind, other} == {"int", "float"}:
+            return "float"
+
+        if {kind, other} == {"category", "string"}:
+            return "string"
+
+        return "object"
+
+    def _convert(self, key, values):
+        """Convert a batch of a column's values to a typed chunk, promoting the column if they don't fit"""
+
+        kind = self._kind(values)
+        current = self.kinds.get(key)
+
+        if kind is None:
+            return len(values)
+
+        # A categorical column stays categorical while each batch has few distinct values
+        if kind == "string" and current == "category" and self._low_cardinality(values):
+            kind = "category"
+
+        merged = self._merge_kinds(current, kind)
+
+        if merged != current and current is not None:
+            self.chunks[key][:] = self._retype(self.chunks[key], current, merged)
+
+        self.kinds[key] = merged
+
+        return self._typed(merged, values)
+
+    def _typed(self, kind, values):
+        import numpy as np
+        import pandas as pd
+
+        has_nulls = None in values
+
+        if kind == "bool":
+            return pd.array(values, dtype="boolean") if has_nulls else np.array(values, dtype=bool)
+
+        if kind == "int":
+            try:
+                array = pd.array(values, dtype="Int64") if has_nulls else np.array(values, dtype=np.int64)
+            except OverflowError:
+                return self._typed("object", values)
+
+            if len(array) and -2 ** 31 <= array.min() and array.max() < 2 ** 31:
+                array = array.astype("Int32" if has_nulls else np.int32)
+
+            return array
+
+        if kind == "float":
+            array = np.array(values, dtype=np.float64)
+            compact = array.astype(np.float32)
+
+            return compact if np.array_equal(compact, array, equal_nan=True) else array
+
+        if kind == "datetime":
+            first = next(value for value in values if value is not None)
+            if first.tzinfo is not None:
+                return pd.to_datetime(values, utc=True).array
+
+            return np.array(values, dtype="datetime64[ms]")
+
+        if kind == "category":
+            return pd.Categorical(values)
+
+        if kind == "objectid" and self.objectid_dtype == "bytes":
+            return np.array([b"" if value is None else value.binary for value in values], dtype="S12")
+
+        if kind == "objectid" and self.objectid_dtype == "string":
+            values = [None if value is None else str(value) for value in values]
+
+        array = np.empty(len(values), dtype=object)
+        array[:] = values
+
+        return array
+
+    def _retype(self, chunks, kind, target):
+        """Convert chunks of one kind to another, e.g. categoricals to strings.
+            Numeric promotions are left to concatenation."""
+
+        import pandas as pd
+
+        if kind == target or kind is None or target in ("int", "float"):
+            return chunks
+
+        retyped = []
+        for chunk in chunks:
+            if isinstance(chunk, int):
+                retyped.append(chunk)
+                continue
+
+            array = pd.Series(chunk).astype(object).to_numpy(copy=True)
+            array[pd.isna(array)] = None
+            retyped.append(array)
+
+        return retyped
+
+    def _nulls(self, kind, size, chunks):
+        """Build a chunk of size nulls, in the dtype of the column's other chunks"""
+
+        import numpy as np
+        import pandas as pd
+
+        if kind == "int":
+            return pd.array([None] * size, dtype="Int32")
+
+        if kind == "float":
+            return np.full(size, np.nan, dtype=np.float32)
+
+        if kind == "bool":
+            return pd.array([None] * size, dtype="boolean")
+
+        if kind == "datetime":
+            return np.full(size, np.datetime64("NaT"), dtype="datetime64[ms]")
+
+        if kind == "category":
+            categories = next(chunk for chunk in chunks if not isinstance(chunk, int)).categories
+            return pd.Categorical.from_codes(np.full(size, -1), categories=categories)
+
+        if kind == "objectid" and self.objectid_dtype == "bytes":
+            return np.zeros(size, dtype="S12")
+
+        return np.full(size, None, dtype=object)
+
+
+def append_frame(dataframe, rows):
+    """Append rows to a DataFrame built by a frame builder, e.g. the delta of an incremental refresh.
+        See concat_frames
+
+    Args:
+        dataframe (DataFrame): the existing result
+        rows (DataFrame): the rows to append
+
+    Returns:
+        appended (DataFrame): a new frame with the rows of both
+    """
+
+    return concat_frames([dataframe, rows])
+
+
+def concat_frames(frames):
+    """Concatenate DataFrames built by frame builders, e.g. the pages of a previewed result.
+        Note: pd.concat turns categoricals whose categories differ into object
+        columns, so those are re-unioned to keep them compact.
+
+    Args:
+        frames (list): the frames, in order
+
+    Returns:
+        concatenated (DataFrame): a new frame with the rows of every frame
+    """
+
+    import pandas as pd
+    from pandas.api.types import union_categoricals
+
+    concatenated = pd.concat(frames, ignore_index=True)
+
+    for column in concatenated.columns:
+        parts = [frame[column] for frame in frames if column in frame.columns]
+
+        if len(parts) == len(frames) and len(parts) > 1 and \
+                all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            concatenated[column] = union_categoricals(parts)
+
+    return concatenated
@@ -0,0 +1,58 @@
+def column_values(column, objectid=False):
+    """Convert a DataFrame column to a list of values BSON can encode, in one pass over the column
+
+    Args:
+        column (Series): the column to convert
+        objectid (bool): whether 24 character hex strings are turned back into ObjectIds
+
+    Returns:
+        values (list): numpy scalars as Python ones, missing values (NaN, NaT, NA) as None
+    """
+
+    import pandas as pd
+
+    missing = column.isna()
+
+    if pd.api.types.is_datetime64_any_dtype(column.dtype):
+        # BSON dates are UTC, without a timezone
+        if column.dt.tz is not None:
+            column = column.dt.tz_convert("UTC").dt.tz_localize(None)
+
+        values = list(column.dt.to_pydatetime())
+    else:
+        values = column.tolist()
+
+    if missing.any():
+        values = [None if is_missing else value for value, is_missing in zip(values, missing.tolist())]
+
+    if objectid:
+        from bson import ObjectId
+
+        values = [ObjectId(value) if isinstance(value, str) and ObjectId.is_valid(value) else value
+                  for value in values]
+
+    return values
+
+
+def frame_documents(dataframe, batch_size, objectid_columns=None):
+    """Convert a DataFrame to documents, column by column, one chunk of rows at a time.
+        Note: only one chunk's documents are held in memory, so a frame of
+        millions of rows can be written without building every document first.
+
+    Args:
+        dataframe (DataFrame): the rows to convert
+        batch_size (int): the number of rows per chunk
+        objectid_columns (list): the columns whose hex strings are ObjectIds, e.g. _id from objectid_dtype=string
+
+    Yields:
+        (offset, documents) (tuple): the index of the chunk's first row, and its documents
+    """
+
+    objectid_columns = set(objectid_columns or [])
+    names = [str(name) for name in dataframe.columns]
+
+    for offset in range(0, len(dataframe), batch_size):
+        chunk = dataframe.iloc[offset:offset + batch_size]
+        columns = [column_values(chunk.iloc[:, i], name in objectid_columns) for i, name in enumerate(names)]
+
+        yield offset, [dict(zip(names, row)) for row in zip(*columns)]
@@ -0,0 +1,137 @@
+import json
+import threading
+import weakref
+from mongo_utils.result_cache import ResultCache
+
+
+def delta_filter(query_filter, field, after, upto):
+    """Restrict a filter to the documents between two watermarks
+
+    Args:
+        query_filter (dict): the query's filter
+        field (str): the watermark field, e.g. _id or a timestamp
+        after (object): the previous watermark, None on the first fetch
+        upto (object): the current watermark, the highest value on the server
+
+    Returns:
+        query_filter (dict): the filter, limited to after < field <= upto
+    """
+
+    bounds = {"$lte": upto}
+    if after is not None:
+        bounds["$gt"] = after
+
+    window = {field: bounds}
+
+    return {"$and": [query_filter, window]} if query_filter else window
+
+
+def change_filter(query_filter):
+    """Rewrite a find filter to match the fullDocument of change stream events
+
+    Args:
+        query_filter (dict): the query's filter
+
+    Returns:
+        query_filter (dict): the filter with every field prefixed by fullDocument.
+    """
+
+    prefixed = {}
+
+    for field, condition in query_filter.items():
+        if field in ("$and", "$or", "$nor"):
+            prefixed[field] = [change_filter(clause) for clause in condition]
+        elif field.startswith("$"):
+            raise ValueError(f"{field} filters can't be applied to a change stream, drop --follow")
+        else:
+            prefixed[f"fullDocument.{field}"] = condition
+
+    return prefixed
+
+
+def field_value(document, field):
+    """Read a (dotted) field from a document, None if it's missing"""
+
+    for part in field.split("."):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(part)
+
+    return document
+
+
+def highest(values):
+    """The highest of some watermark values, ignoring missing ones. None if they can't be compared"""
+
+    try:
+        return max((value for value in values if value is not None), default=None)
+    except TypeError:
+        return None
+
+
+class IncrementalResults:
+    """The watermarks of results refreshed with --incremental, by result name.
+        Note: a watermark is the highest value of the watermark field on the
+        server when the result was last fetched, so a re-run only asks for the
+        documents past it. A result is fetched in full again if its query
+        changed, or if its variable was rebound in the notebook since.
+    """
+
+    # Options that don't change which documents a query matches, so they're left out of the key
+    ignored_options = ResultCache.ignored_options + ["result_name", "follow", "comment"]
+
+    def __init__(self):
+        self.entries = {}
+        self.tails = {}
+        self.lock = threading.Lock()
+
+    def key(self, instance, query_input):
+        normalized = {k: v for k, v in query_input.items() if k not in self.ignored_options}
+        normalized["instance"] = instance
+
+        return json.dumps(normalized, sort_keys=True, default=repr)
+
+    def get(self, name, key, dataframe):
+        """Return the watermark of a result, if it can be refreshed incrementally
+
+        Args:
+            name (str): the variable the result is bound to
+            key (str): the key from IncrementalResults.key()
+            dataframe (DataFrame): the current value of the variable
+
+        Returns:
+            watermark (object): the watermark, or None to fetch the result in full
+        """
+
+        with self.lock:
+            entry = self.entries.get(name)
+
+        if entry is None or entry["key"] != key or dataframe is None or entry["dataframe"]() is not dataframe:
+            return None
+
+        return entry["watermark"]
+
+    def put(self, name, key, dataframe, watermark):
+        """Record the watermark of a result and the frame it was appended to"""
+
+        with self.lock:
+            self.entries[name] = {"key": key, "dataframe": weakref.ref(dataframe), "watermark": watermark}
+
+    def advance(self, name, dataframe, watermark):
+        """Move a result's watermark forward, e.g. as a change stream appends to it.
+            Watermarks that can't be compared with the current one are ignored.
+        """
+
+        with self.lock:
+            entry = self.entries.get(name)
+
+            if entry is None:
+                return
+
+            entry["dataframe"] = weakref.ref(dataframe)
+
+            try:
+                if watermark is not None and (entry["watermark"] is None or watermark > entry["watermark"]):
+                    entry["watermark"] = watermark
+            except TypeError:
+                pass
@@ -1,35 +1,208 @@
-import pymongo
+from mongo_utils.client_registry import client_registry
+from mongo_utils.cursor_stream import ChangeStreamTail, CursorStream, PartitionedStream, RawCursorStream, \
+    ResultBudget
 
 
 class MongoAPI:
     """A class to perform pymongo calls to a Mongo instance."""
 
+    default_batch_size = 10000
+
+    # Instance options passed through to the MongoClient, and the type they're converted to
+    client_options = {
+        "maxPoolSize": int,
+        "minPoolSize": int,
+        "maxIdleTimeMS": int,
+        "compressors": str,
+        "zlibCompressionLevel": int
+    }
+
     def __init__(self, host, port, username, password, serverSelectionTimeout, **kwargs):
 
         authMechanism = kwargs.get("authMechanism") or "SCRAM-SHA-256"
         authSource = kwargs.get("authSource") or "admin"
 
-        self.session = pymongo.MongoClient(
-            host=f"{host}:{port}",
-            username=username,
-            password=password,
-            serverSelectionTimeoutMS=serverSelectionTimeout,
-            authMechanism=authMechanism,
-            authSource=authSource
-        )
+        options = {
+            "serverSelectionTimeoutMS": serverSelectionTimeout,
+            "authMechanism": authMechanism,
+            "authSource": authSource
+        }
+
+        for option, option_type in self.client_options.items():
+            if kwargs.get(option) not in (None, ""):
+                options[option] = option_type(kwargs[option])
+
+        self.session, self.new_client = client_registry.get_client(host, port, username, password, **options)
+
+    def _verify(self):
+        """Run a round trip on a newly created client to check it connects and authenticates.
+            Shared clients were verified when they were created, so they're skipped.
+            A client that fails is removed from the registry.
+        """
+
+        if not self.new_client:
+            return
+
+        try:
+            self.session.admin.command("ping")
+        except Exception:
+            client_registry.discard(self.session)
+            raise
+
+    # Number of sampled keys per partition when splitting a collection for a parallel scan
+    partition_sample_size = 100
+
+    # Time limit (in milliseconds) of the count that checks a find's result size before it runs
+    preflight_max_time_ms = 2000
+
+    # Server error codes of a distinct whose values don't fit in a single 16 MB response
+    distinct_too_big_codes = (17217, 10334)
 
     def _handler(self, command, **kwargs):
         """Broker Mongo commands"""
         return getattr(self, command)(**kwargs)
 
+    def _cancel(self, stream=None, comment=None, **kwargs):
+        """Cancel a running query on the server.
+            Open cursors are killed with killCursors, and operations still running
+            (e.g. the initial find) are found by their comment and killed with killOp.
+
+        Args:
+            stream (CursorStream): the stream draining the query, if it has started
+            comment (str): the comment the query was tagged with
+
+        Returns:
+            killed (dict): the number of cursors and operations killed
+        """
+
+        db_name = kwargs.get("database")
+        collection = kwargs.get("collection")
+
+        killed = {"cursors": 0, "operations": 0}
+
+        if stream is not None and hasattr(stream, "cancel"):
+            stream.cancel()
+
+            cursor_ids = [cursor.cursor_id for cursor in stream.cursors if cursor.cursor_id]
+            if cursor_ids:
+                self.session[db_name].command("killCursors", collection, cursors=cursor_ids)
+                killed["cursors"] = len(cursor_ids)
+
+        if comment is not None:
+            operations = self.session.admin.aggregate([{"$currentOp": {}}, {"$match": {"command.comment": comment}}])
+
+            for operation in operations:
+                self.session.admin.command("killOp", op=operation["opid"])
+                killed["operations"] += 1
+
+        return killed
+
+    def _cursor_options(self, query, cursor=True, **kwargs):
+        """Collect the options the user asked to push down to the server
+
+        Args:
+            query (list): the positional query args, e.g. [filter, projection]
+            cursor (bool): whether the command returns a cursor, i.e. also
+                accepts limit and batch_size
+
+        Returns:
+            query (list): the positional args, without a positional projection
+                if --fields replaces it
+            options (dict): keyword args for find / find_one
+        """
+
+        options = {}
+
+        if kwargs.get("fields"):
+            query = query[:1]
+            options["projection"] = kwargs["fields"]
+
+        for option in ["sort", "skip", "hint", "max_time_ms", "comment"]:
+            if kwargs.get(option) is not None:
+                options[option] = kwargs[option]
+
+        if cursor:
+            if kwargs.get("limit") is not None:
+                options["limit"] = kwargs["limit"]
+
+            options["batch_size"] = kwargs.get("batch_size") or self.default_batch_size
+
+        return query, options
+
+    def _watermark(self, field, **kwargs):
+        """Read the highest value of a field among the documents matching a query,
+            with a single sorted lookup (served by an index on the field, if there's one)
+
+        Args:
+            field (str): the watermark field, e.g. _id or a timestamp
+
+        Returns:
+            watermark (object): the highest value, or None if no document matches
+        """
+
+        db_name = kwargs.get("database")
+        collection = kwargs.get("collection")
+        query = kwargs.get("query") or [{}]
+
+        options = {"projection": {field: 1}, "sort": [(field, -1)]}
+
+        if kwargs.get("max_time_ms") is not None:
+            options["max_time_ms"] = kwargs["max_time_ms"]
+
+        if kwargs.get("comment") is not None:
+            options["comment"] = kwargs["comment"]
+
+        document = self.session[db_name][collection].find_one(query[0], **options)
+
+        if document is None:
+            return None
+
+        from mongo_utils.incremental import field_value
+
+        return field_value(document, field)
+
+    def _watch(self, **kwargs):
+        """Open a change stream on the documents inserted into a collection that match a query.
+            Note: change streams need a replica set or a sharded cluster.
+
+        Returns:
+            results (ChangeStreamTail): an iterable of batches of inserted documents
+        """
+
+        from mongo_utils.incremental import change_filter
+
+        db_name = kwargs.get("database")
+        collection = kwargs.get("collection")
+        query = kwargs.get("query") or [{}]
+
+        pipeline = [{"$match": dict(change_filter(query[0]), operationType="insert")}]
+
+        # A find projection keeps _id unless it's excluded, fullDocument._id has to be asked for
+        projection = kwargs.get("fields") or (query[1] if len(query) > 1 else None) or {}
+        included = {f"fullDocument.{field}": 1 for field, value in projection.items() if value}
+        excluded = [f"fullDocument.{field}" for field, value in projection.items() if not value]
+
+        if included:
+            pipeline.append({"$project": dict({"fullDocument._id": 1}, **included)})
+        if excluded:
+            pipeline.append({"$unset": excluded})
+
+        change_stream = self.session[db_name][collection].watch(pipeline, max_await_time_ms=1000,
+                                                                comment=kwargs.get("comment"))
+
+        results = ChangeStreamTail(change_stream, kwargs.get("batch_size") or self.default_batch_size)
+
+        return results
+
     def show_dbs(self, **kwargs):
         """Return a list of databases in the current MongoClient session
 
         Returns:
-            dbs (list): a list of database names
+            dbs (list): a list of dicts with each database's name and size on disk
         """
 
-        dbs = self.session.list_database_names()
+        dbs = [{"name": db["name"], "size": db.get("sizeOnDisk"), "empty": db.get("empty")}
+               for db in self.session.list_databases()]
 
         return dbs
 
@@ -37,15 +210,45 @@ class MongoAPI:
         """Return a list of collections in a database for the current MongoClient session
 
         Returns:
-            collections (list): a list of collection names
+            collections (list): a list of dicts with each collection's name and type (collection, view, ...)
         """
 
         db_name = kwargs.get("database")
 
-        collections = self.session[db_name].list_collection_names()
+        collections = sorted(({"name": collection["name"], "type": collection.get("type", "collection")}
+                              for collection in self.session[db_name].list_collections(nameOnly=True)),
+                             key=lambda collection: collection["name"])
 
         return collections
 
+    def _collection_stats(self, **kwargs):
+        """Read a collection's size from $collStats, summed over its shards.
+            Views, and collections the user can't run $collStats on, have no stats.
+
+        Returns:
+            stats (dict): the document count, average document size, data, storage
+                and index sizes (in bytes) and number of indexes, or None
+        """
+
+        from pymongo.errors import OperationFailure
+
+        db_name = kwargs.get("database")
+        collection = kwargs.get("collection")
+
+        fields = ["count", "size", "storageSize", "totalIndexSize", "nindexes"]
+        stats = dict.fromkeys(fields, 0)
+
+        try:
+            for shard in self.session[db_name][collection].aggregate([{"$collStats": {"storageStats": {}}}]):
+                for field in fields:
+                    stats[field] += shard["storageStats"].get(field) or 0
+        except OperationFailure:
+            return None
+
+        stats["avgObjSize"] = stats["size"] / stats["count"] if stats["count"] else 0
+
+        return stats
+
     def find_one(self, **kwargs):
         """Get a single document from the database.
 
@@ -55,36 +258,605 @@ class MongoAPI:
 
         db_name = kwargs.get("database")
         collection = kwargs.get("collection")
-        query = kwargs.get("query")
+        query, options = self._cursor_options(kwargs.pop("query"), cursor=False, **kwargs)
 
-        results = self.session[db_name][collection].find_one(*query)
+        results = self.session[db_name][collection].find_one(*query, **options)
 
         return results
 
     def find(self, **kwargs):
-        """_summary_
+        """Query a collection, streaming the results in batches.
 
         Returns:
-            results (list): Returns a listified instance of Cursor corresponding to this query.
+            results (CursorStream): an iterable of document batches, each at most batch_size long
         """
         db_name = kwargs.get("database")
         collection = kwargs.get("collection")
-        query = kwargs.get("query")
+        query, options = self._cursor_options(kwargs.pop("query"), **kwargs)
 
-        results = self.session[db_name][collection].find(*query)
+        if (kwargs.get("parallel") or 1) > 1:
+            results = self._find_parallel(self.session[db_name][collection], query, options, kwargs["parallel"],
+                                          kwargs.get("partition_key") or "_id", kwargs.get("raw"))
 
-        return list(results)
+        elif kwargs.get("raw"):
+            results = self._find_raw(self.session[db_name][collection], query, options)
 
-    def count_documents(self, **kwargs):
-        """Count the number of documents in a collection.
+        else:
+            cursor = self.session[db_name][collection].find(*query, **options)
+
+            results = CursorStream(cursor, options["batch_size"])
+
+        return self._apply_budget(results, **kwargs)
+
+    def export(self, **kwargs):
+        """Query a collection for an export, streaming the results in batches. See find
 
         Returns:
-            results (int): The number of documents in the collection
+            results (CursorStream): an iterable of document batches, each at most batch_size long
+        """
+
+        return self.find(**kwargs)
+
+    def _apply_budget(self, results, **kwargs):
+        """Enforce the max_result_docs and max_result_bytes budgets on a result as it streams.
+            Arrow tables (--raw with pymongoarrow) are fetched whole, so they're checked once they arrive.
+
+        Returns:
+            results (CursorStream, PartitionedStream or Table): the same result
+        """
+
+        if not kwargs.get("max_result_docs") and not kwargs.get("max_result_bytes"):
+            return results
+
+        budget = ResultBudget(kwargs.get("max_result_docs") or 0, kwargs.get("max_result_bytes") or 0)
+
+        # Arrow tables arrive whole, there's no stream to charge as it goes
+        if hasattr(results, "to_pandas"):
+            budget.charge(results.num_rows, results.nbytes)
+            return results
+
+        for stream in getattr(results, "streams", [results]):
+            stream.budget = budget
+
+        return results
+
+    def _preflight_count(self, cap, **kwargs):
+        """Count the documents a find would return, stopping at cap.
+            An unfiltered count is read from the collection metadata.
+
+        Args:
+            cap (int): the number of documents past which counting stops
+
+        Returns:
+            count (int): the number of documents, at most cap, or None if counting timed out
+        """
+
+        from pymongo.errors import ExecutionTimeout
+
+        collection = self.session[kwargs.get("database")][kwargs.get("collection")]
+        query = kwargs.get("query") or [{}]
+        skip = kwargs.get("skip") or 0
+
+        options = {"maxTimeMS": self.preflight_max_time_ms}
+        if kwargs.get("comment") is not None:
+            options["comment"] = kwargs["comment"]
+
+        try:
+            if not query[0]:
+                return min(max(collection.estimated_document_count(**options) - skip, 0), cap)
+
+            if skip:
+                options["skip"] = skip
+            if kwargs.get("hint"):
+                options["hint"] = kwargs["hint"]
+
+            return collection.count_documents(query[0], limit=cap, **options)
+
+        except ExecutionTimeout:
+            return None
+
+    def _find_raw(self, collection, query, options):
+        """Query a collection, skipping pymongo's per-document decoding.
+            Note: if pymongoarrow is installed, the raw BSON batches are decoded
+            straight into typed Arrow columns. Otherwise each raw batch is decoded
+            in a single bson.decode_all call.
+
+        Returns:
+            results (Table or RawCursorStream): an Arrow table, or an iterable of document batches
+        """
+
+        try:
+            from pymongoarrow.api import find_arrow_all
+        except ImportError:
+            find_arrow_all = None
+
+        if find_arrow_all is not None:
+            query_filter = query[0] if query else {}
+            if len(query) > 1:
+                options = dict(options, projection=query[1])
+
+            return find_arrow_all(collection, query_filter, **options)
+
+        cursor = collection.find_raw_batches(*query, **options)
+
+        results = RawCursorStream(cursor, options["batch_size"], collection.codec_options)
+
+        return results
+
+    def _find_parallel(self, collection, query, options, partitions, partition_key, raw=False):
+        """Split a query into disjoint ranges of a partition key, one cursor per range.
+            Note: the ranges are drained concurrently by the consumer over the shared
+            connection pool. Range filters only match values of their own BSON type,
+            so the ranges split the most common type of the sampled keys, and one more
+            partition holds every document outside of them: keys of another type, null
+            or missing. The partition key shouldn't hold arrays, whose elements can
+            fall in several ranges.
+
+        Returns:
+            results (PartitionedStream): the per-range streams, in key order
+        """
+
+        if any(options.get(option) is not None for option in ["sort", "skip", "limit"]):
+            raise ValueError("--parallel can't be combined with --sort, --skip or --limit")
+
+        query_filter = query[0] if query else {}
+
+        bounds = self._partition_bounds(collection, partition_key, partitions)
+
+        ranges = []
+        for lower, upper in zip([None] + bounds, bounds + [None]):
+            key_range = {}
+            if lower is not None:
+                key_range["$gte"] = lower
+            if upper is not None:
+                key_range["$lt"] = upper
+
+            ranges.append({partition_key: key_range} if key_range else {})
+
+        # Documents that don't fall in any range, e.g. string _ids among ObjectIds, get their own partition
+        if bounds:
+            ranges.append({"$nor": list(ranges)})
+
+        streams = []
+        for key_range in ranges:
+            partition_filter = {"$and": [query_filter, key_range]} if query_filter and key_range else \
+                query_filter or key_range
+
+            if raw:
+                cursor = collection.find_raw_batches(partition_filter, *query[1:], **options)
+                streams.append(RawCursorStream(cursor, options["batch_size"], collection.codec_options))
+            else:
+                cursor = collection.find(partition_filter, *query[1:], **options)
+                streams.append(CursorStream(cursor, options["batch_size"]))
+
+        results = PartitionedStream(streams, partitions)
+
+        return results
+
+    def _partition_bounds(self, collection, partition_key, partitions):
+        """Pick the boundaries between partitions from a random sample of the key.
+            Only the keys of the most common type are split into ranges.
+
+        Returns:
+            bounds (list): up to partitions - 1 sorted, distinct key values of a single type
+        """
+
+        pipeline = [
+            {"$sample": {"size": partitions * self.partition_sample_size}},
+            {"$project": {"_id": 0, "key": f"${partition_key}"}}
+        ]
+
+        def kind(value):
+            # Numbers of any width compare with each other, as they do on the server
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return "number"
+            return type(value).__name__
+
+        keys_by_kind = {}
+        for doc in collection.aggregate(pipeline):
+            # NaN can't be ordered, it's left to the partition outside of the ranges
+            if doc.get("key") is not None and doc["key"] == doc["key"]:
+                keys_by_kind.setdefault(kind(doc["key"]), []).append(doc["key"])
+
+        if not keys_by_kind:
+            return []
+
+        keys = max(keys_by_kind.values(), key=len)
+
+        try:
+            keys.sort()
+        except TypeError:
+            # Values Python can't order, e.g. documents, aren't split into ranges
+            return []
+
+        bounds = []
+        for i in range(1, partitions):
+            bound = keys[i * len(keys) // partitions]
+            if not bounds or bound > bounds[-1]:
+                bounds.append(bound)
+
+        return bounds
+
+    def aggregate(self, **kwargs):
+        """Run an aggregation pipeline, streaming the results in batches.
+
+        Returns:
+            results (CursorStream): an iterable of document batches, each at most batch_size long
         """
         db_name = kwargs.get("database")
         collection = kwargs.get("collection")
-        query = kwargs.get("query")
+        pipeline = kwargs.get("query")
+        batch_size = kwargs.get("batch_size") or self.default_batch_size
+
+        options = {"batchSize": batch_size}
+
+        if kwargs.get("allow_disk_use"):
+            options["allowDiskUse"] = True
+
+        if kwargs.get("max_time_ms") is not None:
+            options["maxTimeMS"] = kwargs["max_time_ms"]
+
+        if kwargs.get("comment") is not None:
+            options["comment"] = kwargs["comment"]
 
-        results = self.session[db_name][collection].count_documents(*query)
+        if kwargs.get("raw"):
+            results = self._aggregate_raw(self.session[db_name][collection], pipeline, options)
+        else:
+            cursor = self.session[db_name][collection].aggregate(pipeline, **options)
+
+            results = CursorStream(cursor, batch_size)
+
+        return self._apply_budget(results, **kwargs)
+
+    def _aggregate_raw(self, collection, pipeline, options):
+        """Run an aggregation pipeline, skipping pymongo's per-document decoding.
+            See _find_raw
+
+        Returns:
+            results (Table or RawCursorStream): an Arrow table, or an iterable of document batches
+        """
+
+        try:
+            from pymongoarrow.api import aggregate_arrow_all
+        except ImportError:
+            aggregate_arrow_all = None
+
+        if aggregate_arrow_all is not None:
+            return aggregate_arrow_all(collection, pipeline, **options)
+
+        cursor = collection.aggregate_raw_batches(pipeline, **options)
+
+        results = RawCursorStream(cursor, options["batchSize"], collection.codec_options)
 
         return results
+
+    def explain(self, **kwargs):
+        """Explain how the server runs a find, count_documents or aggregate.
+            Note: count_documents runs as an aggregation ($match then $group),
+            so that's the pipeline explained for it.
+
+        Returns:
+            results (dict): the output of the explain command
+        """
+        db_name = kwargs.get("database")
+        collection = kwargs.get("collection")
+        command = kwargs.get("explained_command")
+        query = kwargs.get("query") or []
+
+        if command == "find":
+            explained = {"find": collection, "filter": query[0] if query else {}}
+
+            projection = kwargs.get("fields") or (query[1] if len(query) > 1 else None)
+            options = [("projection", projection), ("sort", dict(kwargs.get("sort") or []) or None),
+                       ("skip", kwargs.get("skip")), ("limit", kwargs.get("limit")), ("hint", kwargs.get("hint"))]
+
+            explained.update((option, value) for option, value in options if value is not None)
+
+        else:
+            if command == "count_documents":
+                pipeline = [{"$match": query[0] if query else {}}]
+                pipeline += [{"$skip": kwargs["skip"]}] if kwargs.get("skip") else []
+                pipeline += [{"$limit": kwargs["limit"]}] if kwargs.get("limit") else []
+                pipeline += [{"$group": {"_id": 1, "n": {"$sum": 1}}}]
+            else:
+                pipeline = query
+
+            explained = {"aggregate": collection, "pipeline": pipeline, "cursor": {}}
+
+            if kwargs.get("allow_disk_use"):
+                explained["allowDiskUse"] = True
+
+            if kwargs.get("hint"):
+                explained["hint"] = kwargs["hint"]
+
+        options = {"verbosity": kwargs.get("verbosity") or "executionStats"}
+
+        if kwargs.get("max_time_ms") is not None:
+            options["maxTimeMS"] = kwargs["max_time_ms"]
+
+        if kwargs.get("comment") is not None:
+            options["comment"] = kwargs["comment"]
+
+        results = self.session[db_name].command("explain", explained, **options)
+
+        return results
+
+    def indexes(self, **kwargs):
+        """List a collection's indexes with their size and usage.
+            Note: sizes come from $collStats and usage from $indexStats, summed
+            over the shards / replica set members that report them. Either is
+            left out if the user isn't allowed to run it.
+
+        Returns:
+            results (list): a list of dicts describing each index
+        """
+
+        from pymongo.errors import OperationFailure
+
+        db_name = kwargs.get("database")
+        collection = self.session[db_name][kwargs.get("collection")]
+
+        results = []
+        for index in collection.list_indexes():
+            index = dict(index)
+            index.update(size=None, ops=None, since=None)
+            results.append(index)
+
+        by_name = {index["name"]: index for index in results}
+
+        try:
+            for stats in collection.aggregate([{"$collStats": {"storageStats": {}}}]):
+                for name, size in stats["storageStats"].get("indexSizes", {}).items():
+                    if name in by_name:
+                        by_name[name]["size"] = (by_name[name]["size"] or 0) + size
+        except OperationFailure:
+            pass
+
+        try:
+            for usage in collection.aggregate([{"$indexStats": {}}]):
+                index = by_name.get(usage["name"])
+                if index is not None:
+                    index["ops"] = (index["ops"] or 0) + usage["accesses"]["ops"]
+                    since = usage["accesses"]["since"]
+                    index["since"] = since if index["since"] is None else min(index["since"], since)
+        except OperationFailure:
+            pass
+
+        return results
+
+    def insert_df(self, **kwargs):
+        """Write a DataFrame to a collection in unordered batches, several at a time.
+            Note: rows are converted to documents column by column, one batch at
+            a time. With upsert_on, each row updates ($set) the document matching
+            those fields, or is inserted if there's none. A failed batch doesn't
+            stop the others, its errors are reported.
+
+        Returns:
+            results (dict): the totals, the elapsed time and the errors of each failed batch
+        """
+
+        import time
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+        from pymongo import UpdateOne
+        from pymongo.errors import BulkWriteError, PyMongoError
+        from pymongo.write_concern import WriteConcern
+        from mongo_utils.frame_documents import frame_documents
+
+        db_name = kwargs.get("database")
+        dataframe = kwargs.get("dataframe")
+        upsert_on = kwargs.get("upsert_on") or []
+        batch_size = kwargs.get("batch_size") or self.default_batch_size
+
+        missing = [field for field in upsert_on if field not in dataframe.columns]
+        if missing:
+            raise ValueError(f"--upsert-on fields missing from the dataframe: {', '.join(missing)}")
+
+        write_concern = {}
+        if kwargs.get("w") is not None:
+            write_concern["w"] = int(kwargs["w"]) if kwargs["w"].isdigit() else kwargs["w"]
+        if kwargs.get("journal"):
+            write_concern["j"] = True
+
+        collection = self.session[db_name][kwargs.get("collection")]
+        if write_concern:
+            collection = collection.with_options(write_concern=WriteConcern(**write_concern))
+
+        results = {"rows": len(dataframe), "batches": 0, "inserted": 0, "upserted": 0, "matched": 0, "modified": 0,
+                   "seconds": 0.0, "errors": []}
+
+        def write(offset, documents):
+            try:
+                if upsert_on:
+                    requests = [UpdateOne({field: document[field] for field in upsert_on},
+                                          {"$set": {k: v for k, v in document.items() if k not in upsert_on}},
+                                          upsert=True) for document in documents]
+
+                    return offset, len(documents), collection.bulk_write(requests, ordered=False).bulk_api_result
+
+                inserted = collection.insert_many(documents, ordered=False).inserted_ids
+
+                return offset, len(documents), {"nInserted": len(inserted)}
+
+            except BulkWriteError as e:
+                return offset, len(documents), e.details
+            except PyMongoError as e:
+                return offset, len(documents), {"writeErrors": [{"errmsg": str(e)}], "failed": True}
+
+        def collect(future):
+            offset, size, result = future.result()
+
+            results["batches"] += 1
+            results["inserted"] += result.get("nInserted", 0)
+            results["upserted"] += result.get("nUpserted", 0)
+            results["matched"] += result.get("nMatched", 0)
+            results["modified"] += result.get("nModified", 0)
+
+            errors = result.get("writeErrors") or []
+            if errors or result.get("writeConcernErrors"):
+                results["errors"].append({
+                    "batch": results["batches"],
+                    "rows": f"{offset}-{offset + size - 1}",
+                    "failed": size if result.get("failed") else len(errors),
+                    "error": (errors or result["writeConcernErrors"])[0]["errmsg"]
+                })
+
+        workers = kwargs.get("workers") or 4
+        start = time.perf_counter()
+
+        # Batches are converted while the previous ones are written, at most two per worker are held in memory
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+
+            for offset, documents in frame_documents(dataframe, batch_size, kwargs.get("objectids")):
+                pending.append(pool.submit(write, offset, documents))
+
+                if len(pending) >= 2 * workers:
+                    collect(pending.popleft())
+
+            while pending:
+                collect(pending.popleft())
+
+        results["seconds"] = time.perf_counter() - start
+
+        return results
+
+    def count_documents(self, **kwargs):
+        """Count the number of documents in a collection.
+            Note: with --estimate, or an empty filter and no --skip, --limit,
+            --hint or --exact, the count is read from the collection metadata
+            (estimated_document_count) instead of scanning the collection.
+
+        Returns:
+            results (dict): the number of documents, and whether it's an estimate
+        """
+        db_name = kwargs.get("database")
+        collection = self.session[db_name][kwargs.get("collection")]
+        query = kwargs.get("query") or [{}]
+
+        options = {}
+
+        if kwargs.get("max_time_ms") is not None:
+            options["maxTimeMS"] = kwargs["max_time_ms"]
+
+        if kwargs.get("comment") is not None:
+            options["comment"] = kwargs["comment"]
+
+        if self._estimate_count(query[0], **kwargs):
+            return {"count": collection.estimated_document_count(**options), "estimated": True}
+
+        for option in ["skip", "limit", "hint"]:
+            if kwargs.get(option) is not None:
+                options[option] = kwargs[option]
+
+        return {"count": collection.count_documents(*query, **options), "estimated": False}
+
+    def distinct(self, **kwargs):
+        """List the distinct values of a field, computed on the server.
+            Note: like the distinct command, the elements of array values are
+            listed one by one. With --limit, or when the values don't fit in
+            the 16 MB response of the distinct command, they're grouped by an
+            aggregation instead, and returned in sort order.
+
+        Returns:
+            results (list): the distinct values
+        """
+
+        from pymongo.errors import OperationFailure
+
+        db_name = kwargs.get("database")
+        collection = self.session[db_name][kwargs.get("collection")]
+        field = kwargs.get("field")
+        query = kwargs.get("query") or [{}]
+
+        options = {}
+
+        if kwargs.get("max_time_ms") is not None:
+            options["maxTimeMS"] = kwargs["max_time_ms"]
+
+        if kwargs.get("comment") is not None:
+            options["comment"] = kwargs["comment"]
+
+        if kwargs.get("limit") is None:
+            try:
+                return collection.distinct(field, query[0], **options)
+            except OperationFailure as e:
+                if e.code not in self.distinct_too_big_codes:
+                    raise
+
+        pipeline = self._group_pipeline(field, query[0], unwind=True) + [{"$sort": {"_id": 1}}]
+        pipeline += [{"$limit": kwargs["limit"]}] if kwargs.get("limit") else []
+
+        return [document["_id"] for document in collection.aggregate(pipeline, allowDiskUse=True, **options)]
+
+    def value_counts(self, **kwargs):
+        """Count the documents holding each value of a field, computed on the server.
+            Note: runs as $group, $sort (most frequent first) and, with --top,
+            $limit, so only the counts are transferred. Documents without the
+            field are counted under None.
+
+        Returns:
+            results (CursorStream): an iterable of batches of dicts with each value (_id) and its count
+        """
+        db_name = kwargs.get("database")
+        collection = self.session[db_name][kwargs.get("collection")]
+        query = kwargs.get("query") or [{}]
+
+        pipeline = self._group_pipeline(kwargs.get("field"), query[0], kwargs.get("unwind"))
+        pipeline += [{"$sort": {"count": -1, "_id": 1}}]
+        pipeline += [{"$limit": kwargs["top"]}] if kwargs.get("top") else []
+
+        batch_size = kwargs.get("batch_size") or self.default_batch_size
+
+        options = {"batchSize": batch_size}
+
+        if kwargs.get("allow_disk_use"):
+            options["allowDiskUse"] = True
+
+        if kwargs.get("max_time_ms") is not None:
+            options["maxTimeMS"] = kwargs["max_time_ms"]
+
+        if kwargs.get("comment") is not None:
+            options["comment"] = kwargs["comment"]
+
+        results = CursorStream(collection.aggregate(pipeline, **options), batch_size)
+
+        return self._apply_budget(results, **kwargs)
+
+    def _group_pipeline(self, field, query_filter, unwind=False):
+        """Build the stages that group a collection's documents by a field, counting them
+
+        Args:
+            field (str): the (dotted) field to group by
+            query_filter (dict): the documents to group, {} for all of them
+            unwind (bool): group the elements of array values one by one
+
+        Returns:
+            pipeline (list): the $match, $unwind and $group stages
+        """
+
+        pipeline = [{"$match": query_filter}] if query_filter else []
+        pipeline += [{"$unwind": f"${field}"}] if unwind else []
+        pipeline += [{"$group": {"_id": f"${field}", "count": {"$sum": 1}}}]
+
+        return pipeline
+
+    def _estimate_count(self, query_filter, **kwargs):
+        """Decide whether a count can be read from the collection metadata
+
+        Args:
+            query_filter (dict): the count's filter
+
+        Returns:
+            estimate (bool): True for --estimate, or for an unfiltered count without --exact
+        """
+
+        unfiltered = not query_filter and all(kwargs.get(option) is None for option in ["skip", "limit", "hint"])
+
+        if kwargs.get("estimate"):
+            if not unfiltered:
+                raise ValueError("--estimate counts the whole collection, it can't be combined with a filter, "
+                                 "--skip, --limit or --hint")
+            return True
+
+        return unfiltered and not kwargs.get("exact")
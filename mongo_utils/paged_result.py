@@ -0,0 +1,137 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from mongo_utils.frame_builder import concat_frames
+
+
+class PagedResult:
+    """A query result fetched a page at a time, as it's looked at (--preview).
+        Note: each page is one batch of the open server cursor, decoded into
+        a DataFrame only when it's fetched. While a page is shown, the next
+        one is fetched in a background thread. The server closes cursors
+        that are idle for 10 minutes, so page through a preview or call
+        to_pandas() before then, or re-run the cell.
+    """
+
+    def __init__(self, stream, new_builder):
+        self.stream = stream
+        self.new_builder = new_builder
+        self.pages = []
+        self.current = 0
+        self.exhausted = False
+        self.error = None
+        self.batches = iter(stream)
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jupyter_mongo_preview")
+        self.prefetching = None
+
+    def __len__(self):
+        """The number of rows fetched so far"""
+        return sum(len(page) for page in self.pages)
+
+    def __repr__(self):
+        state = "failed" if self.error is not None else "complete" if self.exhausted else "open"
+        return f"<PagedResult {len(self.pages)} pages ({len(self)} rows) fetched, page size " \
+               f"{self.stream.batch_size}, {state}>"
+
+    @property
+    def page_size(self):
+        return self.stream.batch_size
+
+    def _fetch(self):
+        """Fetch and decode the next page
+
+        Returns:
+            fetched (bool): False once the cursor is exhausted, closed or failed
+        """
+
+        with self.lock:
+            if self.exhausted:
+                return False
+
+            try:
+                batch = next(self.batches)
+            except StopIteration:
+                self.exhausted = True
+            except Exception as e:
+                # The cursor is gone once its generator raised, later pages re-raise this instead
+                self.exhausted = True
+                self.error = e
+
+            if self.exhausted:
+                self.pool.shutdown(wait=False)
+                return False
+
+            self.pages.append(self.new_builder().consume([batch]).to_frame())
+
+            return True
+
+    def _prefetch(self):
+        """Fetch the page after the last fetched one in the background, unless it's already being fetched"""
+
+        if not self.exhausted and (self.prefetching is None or self.prefetching.done()):
+            self.prefetching = self.pool.submit(self._fetch)
+
+    def page(self, number=0):
+        """Show a page of the result, fetching it (and the pages before it) if it wasn't yet
+
+        Args:
+            number (int): the page, counting from 0
+
+        Returns:
+            page (DataFrame): the page's rows
+        """
+
+        while len(self.pages) <= number and self._fetch():
+            pass
+
+        if number >= len(self.pages):
+            if self.error is not None:
+                raise self.error
+            if number == 0:
+                return self.to_pandas()
+            raise IndexError(f"The result only has {len(self.pages)} pages")
+
+        self.current = number
+
+        if number + 1 >= len(self.pages):
+            self._prefetch()
+
+        return self.pages[number]
+
+    def next(self):
+        """Show the page after the current one"""
+        return self.page(self.current + 1)
+
+    def previous(self):
+        """Show the page before the current one"""
+        return self.page(max(self.current - 1, 0))
+
+    def to_pandas(self):
+        """Fetch the rest of the result and materialize every page as a single DataFrame
+
+        Returns:
+            dataframe (DataFrame): the full result
+        """
+
+        import pandas as pd
+
+        while self._fetch():
+            pass
+
+        if self.error is not None:
+            raise self.error
+
+        if not self.pages:
+            return pd.DataFrame()
+
+        return concat_frames(self.pages) if len(self.pages) > 1 else self.pages[0]
+
+    def close(self):
+        """Stop paging and release the server cursor. The pages fetched so far are kept"""
+
+        with self.lock:
+            self.exhausted = True
+            self.batches.close()
+            self.stream.close()
+
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,302 @@
+import ast
+import json
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from bson import Decimal128, Int64, ObjectId, Timestamp
+from bson.json_util import object_hook
+
+
+# Each token is matched at the current position as the query is parsed, skipping whitespace before it.
+# Each alternative is a named group, and anything that isn't a token is reported as an error.
+TOKEN_PATTERN = re.compile(r"""\s*(?:
+    (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+    |(?P<number>-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    |(?P<punct>[{}\[\]:,()])
+    |(?P<word>-?[A-Za-z_$][\w$.]*)
+    |(?P<error>.)
+    |(?P<end>$)
+)""", re.VERBOSE | re.DOTALL)
+
+# Arrays of plain numbers and strings, e.g. a pasted $in list of ids, are handed to json.loads
+# in one go. Single quoted strings qualify too, as long as they hold no quotes or escapes.
+_JSON_NUMBER = r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?"
+SCALAR_ARRAY_PATTERNS = [
+    (re.compile(rf"""((?:\s*(?:"[^"\\]*"|{_JSON_NUMBER})\s*,)*\s*(?:"[^"\\]*"|{_JSON_NUMBER}))\s*,?\s*\]"""), False),
+    (re.compile(rf"""((?:\s*(?:'[^'"\\]*'|{_JSON_NUMBER})\s*,)*\s*(?:'[^'"\\]*'|{_JSON_NUMBER}))\s*,?\s*\]"""), True)
+]
+
+LITERALS = {
+    "true": True, "True": True,
+    "false": False, "False": False,
+    "null": None, "None": None, "undefined": None,
+    "Infinity": float("inf"), "-Infinity": float("-inf"), "NaN": float("nan")
+}
+
+# Extended JSON wrappers, e.g. {"$date": ...} or {"$oid": ...}, are converted by bson's object_hook
+EXTENDED_JSON_KEYS = {
+    "$oid", "$date", "$numberLong", "$numberInt", "$numberDouble", "$numberDecimal", "$timestamp",
+    "$binary", "$uuid", "$regex", "$regularExpression", "$minKey", "$maxKey", "$symbol", "$code", "$dbPointer"
+}
+
+
+def _parse_date(value=None):
+    """Turn the argument of ISODate() / Date() into a naive UTC datetime, like pymongo returns"""
+
+    if value is None:
+        parsed = datetime.now(timezone.utc)
+    elif isinstance(value, (int, float)):
+        parsed = datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+    else:
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
+
+        parsed = datetime.fromisoformat(value)
+
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return parsed
+
+
+# Mongo shell constructors, e.g. ObjectId("..."), and how to build them from their arguments
+CONSTRUCTORS = {
+    "ObjectId": lambda *args: ObjectId(*args),
+    "ISODate": _parse_date,
+    "Date": _parse_date,
+    "NumberLong": lambda value: Int64(int(value)),
+    "NumberInt": lambda value: int(value),
+    "NumberDecimal": lambda value: Decimal128(str(value)),
+    "Timestamp": lambda time, inc: Timestamp(int(time), int(inc))
+}
+
+# Constructors that build a new value every time they're called without arguments (the current date, a new id)
+VOLATILE_CONSTRUCTORS = {"ObjectId", "ISODate", "Date"}
+
+
+class QueryParser:
+    """A single-pass parser for the query line of a cell magic.
+        Note: it accepts JSON, Python literals and Mongo shell syntax alike:
+        single or double quotes, unquoted keys, True/true/None/null, shell
+        constructors (ObjectId, ISODate, NumberLong, ...) and extended JSON
+        ({"$date": ...}). The query is a comma separated list of arguments,
+        e.g. a filter and a projection.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.end = 0
+        # Set once a constructor builds a new value on every call, e.g. ISODate() or ObjectId()
+        self.volatile = False
+        self.advance()
+
+    def advance(self):
+        """Move to the next token, setting self.kind, self.token and self.start"""
+
+        match = TOKEN_PATTERN.match(self.text, self.end)
+        self.kind = match.lastgroup
+        self.token = match.group(self.kind)
+        self.start = match.start(self.kind)
+        self.end = match.end()
+
+        if self.kind == "error":
+            raise ValueError(f"Unexpected character {self.token!r} at position {self.start} of the query")
+
+    def error(self, message):
+        return ValueError(f"{message} at position {self.start} of the query: {self.text[self.start:self.start + 30]!r}")
+
+    def parse(self):
+        """Parse the whole query
+
+        Returns:
+            args (list): the comma separated arguments of the query
+        """
+
+        args = []
+
+        while self.kind != "end":
+            args.append(self.value())
+
+            if self.kind != "end":
+                self.expect(",")
+
+        return args
+
+    def expect(self, punct):
+        if self.kind != "punct" or self.token != punct:
+            raise self.error(f"Expected '{punct}'")
+        self.advance()
+
+    def value(self):
+        kind, token = self.kind, self.token
+
+        if kind == "string":
+            self.advance()
+            return self.string(token)
+
+        if kind == "number":
+            self.advance()
+            return float(token) if "." in token or "e" in token or "E" in token else int(token)
+
+        if kind == "punct":
+            if token == "{":
+                self.advance()
+                return self.document()
+
+            if token == "[":
+                return self.array()
+
+        if kind == "word":
+            if token in LITERALS:
+                self.advance()
+                return LITERALS[token]
+
+            if token == "new":
+                self.advance()
+                if self.kind == "word" and self.token in CONSTRUCTORS:
+                    return self.value()
+
+            elif token in CONSTRUCTORS:
+                self.advance()
+                return self.constructor(token)
+
+        raise self.error("Unexpected end" if kind == "end" else f"Unexpected {self.token!r}")
+
+    def string(self, token):
+        if "\\" not in token:
+            return token[1:-1]
+
+        return ast.literal_eval(token)
+
+    def document(self):
+        document = {}
+
+        while not (self.kind == "punct" and self.token == "}"):
+            # Keys may be quoted, or bare as in the Mongo shell, e.g. {$gt: 5}
+            if self.kind == "string":
+                key = self.string(self.token)
+            elif self.kind in ("word", "number"):
+                key = self.token
+            else:
+                raise self.error("Unterminated document" if self.kind == "end" else "Expected a key")
+
+            self.advance()
+            self.expect(":")
+            document[key] = self.value()
+
+            if self.kind == "punct" and self.token == ",":
+                self.advance()
+            elif not (self.kind == "punct" and self.token == "}"):
+                raise self.error("Expected ',' or '}'")
+
+        self.advance()
+
+        if document and next(iter(document)) in EXTENDED_JSON_KEYS:
+            return object_hook(document)
+
+        return document
+
+    def array(self):
+        # Fast path: hand a run of plain scalars straight to json.loads
+        for pattern, single_quoted in SCALAR_ARRAY_PATTERNS:
+            match = pattern.match(self.text, self.end)
+
+            if match is not None:
+                scalars = match.group(1)
+                if single_quoted:
+                    scalars = scalars.replace("'", '"')
+
+                try:
+                    array = json.loads(f"[{scalars}]")
+                except ValueError:
+                    break
+
+                self.end = match.end()
+                self.advance()
+                return array
+
+        self.advance()
+        array = []
+        append = array.append
+
+        while not (self.kind == "punct" and self.token == "]"):
+            if self.kind == "end":
+                raise self.error("Unterminated array")
+
+            append(self.value())
+
+            if self.kind == "punct" and self.token == ",":
+                self.advance()
+            elif not (self.kind == "punct" and self.token == "]"):
+                raise self.error("Expected ',' or ']'")
+
+        self.advance()
+
+        return array
+
+    def constructor(self, name):
+        self.expect("(")
+
+        args = []
+        while not (self.kind == "punct" and self.token == ")"):
+            args.append(self.value())
+
+            if self.kind == "punct" and self.token == ",":
+                self.advance()
+            elif not (self.kind == "punct" and self.token == ")"):
+                raise self.error("Expected ',' or ')'")
+
+        self.advance()
+
+        if not args and name in VOLATILE_CONSTRUCTORS:
+            self.volatile = True
+
+        try:
+            return CONSTRUCTORS[name](*args)
+        except Exception as e:
+            raise ValueError(f"Invalid {name}({', '.join(map(repr, args))}): {e}")
+
+
+# The number of parsed queries memoized by their text
+MEMO_SIZE = 256
+
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+
+
+def parse_query(text):
+    """Parse the query line of a cell magic into a list of arguments.
+        Note: parsed queries are memoized by their text, so re-running a cell
+        doesn't parse it again. The documents in the result are shared with the
+        memo, so callers must copy them rather than modify them in place.
+        Queries with ISODate(), Date() or ObjectId() aren't memoized, so those
+        are evaluated again on every run.
+
+    Args:
+        text (str): the query line
+
+    Returns:
+        args (list): the arguments, e.g. [filter] or [filter, projection]
+    """
+
+    text = text.strip()
+
+    with _memo_lock:
+        args = _memo.get(text)
+
+        if args is not None:
+            _memo.move_to_end(text)
+            return list(args)
+
+    parser = QueryParser(text)
+    args = parser.parse()
+
+    if not parser.volatile:
+        with _memo_lock:
+            _memo[text] = tuple(args)
+
+            while len(_memo) > MEMO_SIZE:
+                _memo.popitem(last=False)
+
+    return args
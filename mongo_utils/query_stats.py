@@ -0,0 +1,247 @@
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class QueryRecord:
+    """The timing and resource usage of a single cell query.
+        Note: "round_trips" is the time pymongo spent on server commands
+        (server execution, network transfer and decoding the reply), as
+        reported by command monitoring. "fetch" is the time spent pulling
+        batches from the cursor, round trips included.
+    """
+
+    def __init__(self, query_id, instance, query_input, comment=None):
+        self.query_id = query_id
+        self.instance = instance
+        self.command = query_input.get("command")
+        self.database = query_input.get("database")
+        self.collection = query_input.get("collection")
+        self.comment = comment or f"jupyter_mongo:query:{query_id}:{time.time()}"
+        self.started = time.time()
+        self.stages = {"parse": 0.0, "round_trips": 0.0, "fetch": 0.0, "build": 0.0, "dataframe": 0.0}
+        self.seconds = 0.0
+        self.commands = 0
+        self.failed_commands = 0
+        self.documents = 0
+        self.batches = 0
+        self.bytes = 0
+        self.rows = 0
+        self.cached = False
+        self.status = "running"
+        self.error = None
+
+    @contextmanager
+    def time(self, stage):
+        """Add the time spent in the block to a stage"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage] += time.perf_counter() - start
+
+    def as_dict(self):
+        record = {k: v for k, v in vars(self).items() if k != "stages"}
+        record.update({f"{stage}_seconds": seconds for stage, seconds in self.stages.items()})
+
+        return record
+
+
+class QueryStats:
+    """An in-kernel history of query records, fed by pymongo command monitoring.
+        Note: commands are attributed to a query by its comment, by the cursor
+        id of a getMore, or else by the thread that is running the query, so
+        the partitions of a parallel scan and background queries are counted.
+        Commands are reported on the thread that sends them, so the lookup
+        tables and the records they update are guarded by a lock.
+    """
+
+    def __init__(self, max_records=1000):
+        self.history = deque(maxlen=max_records)
+        self.track_bytes = False
+        self.exporters = []
+        self.ids = itertools.count(1)
+        self.local = threading.local()
+        self.active = {}
+        self.cursors = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def configure(self, max_records, track_bytes):
+        """Update the history length and whether reply sizes are measured
+
+        Args:
+            max_records (int): the number of queries to keep
+            track_bytes (bool): whether to measure the BSON size of every reply
+        """
+
+        if max_records != self.history.maxlen:
+            self.history = deque(self.history, maxlen=max_records)
+
+        self.track_bytes = track_bytes
+
+    def add_exporter(self, exporter):
+        """Register a function called with every finished query, e.g. to push it to a metrics pipeline
+
+        Args:
+            exporter (function): called with the record as a dict (QueryRecord.as_dict())
+        """
+
+        self.exporters.append(exporter)
+
+    def remove_exporter(self, exporter):
+        self.exporters.remove(exporter)
+
+    @contextmanager
+    def track(self, instance, query_input, comment=None):
+        """Record a query run in the block.
+            The record is bound to the current thread and its comment while the block runs.
+
+        Args:
+            instance (str): the instance the query runs against
+            query_input (dict): the parsed command
+            comment (str): the comment the query is tagged with, defaults to a new one
+
+        Yields:
+            record (QueryRecord): the record to fill in
+        """
+
+        record = QueryRecord(next(self.ids), instance, query_input, comment)
+        previous = getattr(self.local, "record", None)
+        self.local.record = record
+        with self.lock:
+            self.active[record.comment] = record
+        start = time.perf_counter()
+
+        try:
+            yield record
+            record.status = "done"
+
+        except BaseException as e:
+            record.status = "cancelled" if isinstance(e, KeyboardInterrupt) else "failed"
+            record.error = str(e)
+            raise
+
+        finally:
+            record.seconds = time.perf_counter() - start + record.stages["parse"]
+            self.local.record = previous
+            with self.lock:
+                self.active.pop(record.comment, None)
+                for cursor_id in [k for k, v in list(self.cursors.items()) if v is record]:
+                    self.cursors.pop(cursor_id, None)
+
+            self.history.append(record)
+            self._export(record)
+
+    def _export(self, record):
+        if not self.exporters:
+            return
+
+        exported = record.as_dict()
+
+        for exporter in list(self.exporters):
+            try:
+                exporter(exported)
+            except Exception as e:
+                record.error = record.error or f"Exporter {getattr(exporter, '__name__', exporter)} failed: {e}"
+
+    def clear(self):
+        self.history.clear()
+
+    def describe(self, last=20):
+        """Describe the recent queries and the percentiles of their timings
+
+        Args:
+            last (int): the number of recent queries to list
+
+        Returns:
+            description (dict): the recent records (as dicts, oldest first) and,
+                per timing, the p50, p90, p99 and max over the whole history
+        """
+
+        records = list(self.history)
+
+        percentiles = {}
+        for timing in ["total", "round_trips", "fetch", "build", "dataframe"]:
+            values = sorted(r.seconds if timing == "total" else r.stages[timing] for r in records if not r.cached)
+            percentiles[timing] = {p: self._percentile(values, p) for p in [50, 90, 99, 100]}
+
+        description = {
+            "records": [r.as_dict() for r in records[-last:]] if last else [],
+            "queries": len(records),
+            "max_records": self.history.maxlen,
+            "percentiles": percentiles
+        }
+
+        return description
+
+    def _percentile(self, values, percentile):
+        if not values:
+            return None
+
+        return values[min(len(values) - 1, max(0, -(-len(values) * percentile // 100) - 1))]
+
+    # Command monitoring, see mongo_utils.command_monitor #
+
+    def _record_for(self, event):
+        command = event.command
+        comment = command.get("comment")
+
+        if isinstance(comment, str) and comment in self.active:
+            return self.active[comment]
+
+        if event.command_name == "getMore" and command.get("getMore") in self.cursors:
+            return self.cursors[command["getMore"]]
+
+        return getattr(self.local, "record", None)
+
+    def _command_started(self, event):
+        with self.lock:
+            record = self._record_for(event)
+
+            if record is not None:
+                self.pending[(event.request_id, event.connection_id)] = record
+
+    def _command_succeeded(self, event):
+        reply = event.reply
+        cursor = reply.get("cursor") if hasattr(reply, "get") else None
+
+        key = (event.request_id, event.connection_id)
+        size = 0
+
+        if self.track_bytes and key in self.pending:
+            import bson
+
+            # Measured outside the lock, it's the slow part
+            size = len(bson.encode(reply))
+
+        with self.lock:
+            record = self.pending.pop(key, None)
+
+            if record is None:
+                return
+
+            record.commands += 1
+            record.stages["round_trips"] += event.duration_micros / 1e6
+
+            if cursor and cursor.get("id"):
+                self.cursors[cursor["id"]] = record
+
+            record.bytes += size
+
+    def _command_failed(self, event):
+        with self.lock:
+            record = self.pending.pop((event.request_id, event.connection_id), None)
+
+            if record is None:
+                return
+
+            record.commands += 1
+            record.failed_commands += 1
+            record.stages["round_trips"] += event.duration_micros / 1e6
+
+
+query_stats = QueryStats()
@@ -0,0 +1,182 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """An in-kernel LRU cache of query results (DataFrames).
+        Note: entries expire after ttl seconds, and the least recently used
+        entries are evicted once the cached frames exceed max_bytes. Setting
+        either to 0 disables the cache. Background jobs and multi-query cells
+        use it from several threads, so entries and byte counts only change
+        under the lock.
+    """
+
+    # Options that don't change the result of a query, so they're left out of the key
+    ignored_options = ["batch_size", "no_cache", "refresh", "spill_dir", "spill_threshold", "max_result_docs",
+                       "max_result_bytes", "preflight"]
+
+    def __init__(self, max_bytes=0, ttl=0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0 and self.ttl > 0
+
+    def configure(self, max_bytes, ttl):
+        """Update the memory budget and TTL, evicting entries if the budget shrank
+
+        Args:
+            max_bytes (int): the memory budget for all cached frames
+            ttl (int): the number of seconds an entry stays valid
+        """
+
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.ttl = ttl
+
+            self._evict(0)
+
+    def key(self, instance, query_input):
+        """Build a cache key from the instance and the parsed query
+
+        Args:
+            instance (str): the instance the query runs against
+            query_input (dict): the parsed command, query and pushdown options
+
+        Returns:
+            key (str): a normalized, hashable representation of the query
+        """
+
+        normalized = {k: v for k, v in query_input.items() if k not in self.ignored_options}
+        normalized["instance"] = instance
+
+        return json.dumps(normalized, sort_keys=True, default=repr)
+
+    def get(self, key):
+        """Return a cached frame, or None if it's missing or expired
+
+        Args:
+            key (str): the key from ResultCache.key()
+
+        Returns:
+            dataframe (DataFrame): a shallow copy of the cached frame, or None
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and time.time() - entry["created"] > self.ttl:
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            entry["hits"] += 1
+            self.hits += 1
+
+            dataframe = entry["dataframe"]
+
+        return dataframe.copy(deep=False)
+
+    def put(self, key, dataframe, **kwargs):
+        """Cache a frame, evicting least recently used entries to make room.
+            Frames larger than the whole budget aren't cached.
+
+        Args:
+            key (str): the key from ResultCache.key()
+            dataframe (DataFrame): the query result
+            kwargs: the parsed query, used to describe the entry
+        """
+
+        if not self.enabled:
+            return
+
+        size = int(dataframe.memory_usage(index=True, deep=True).sum())
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            if size > self.max_bytes:
+                return
+
+            self._evict(size)
+
+            self.entries[key] = {
+                "instance": kwargs.get("instance"),
+                "command": kwargs.get("command"),
+                "database": kwargs.get("database"),
+                "collection": kwargs.get("collection"),
+                "dataframe": dataframe,
+                "rows": len(dataframe),
+                "bytes": size,
+                "created": time.time(),
+                "hits": 0
+            }
+            self.size += size
+
+    def clear(self, instance=None):
+        """Remove all entries, or only the entries of one instance
+
+        Args:
+            instance (str): the instance to clear, or None for all
+
+        Returns:
+            removed (int): the number of entries removed
+        """
+
+        with self.lock:
+            keys = [k for k, entry in self.entries.items() if instance is None or entry["instance"] == instance]
+
+            for k in keys:
+                self._remove(k)
+
+        return len(keys)
+
+    def describe(self, instance=None):
+        """Describe the cache and its entries, most recently used last
+
+        Args:
+            instance (str): only describe the entries of this instance, or None for all
+
+        Returns:
+            description (dict): the cache totals and a list of dicts describing each entry
+        """
+
+        now = time.time()
+
+        with self.lock:
+            entries = [dict({k: v for k, v in entry.items() if k != "dataframe"}, age=now - entry["created"])
+                       for entry in self.entries.values() if instance is None or entry["instance"] == instance]
+
+        description = {
+            "entries": entries,
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+        return description
+
+    # The helpers below expect the lock to be held
+
+    def _evict(self, needed):
+        while self.entries and self.size + needed > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry["bytes"]
@@ -0,0 +1,208 @@
+import os
+import threading
+import uuid
+from datetime import datetime
+
+# The file extension and pyarrow dataset format of each spill format
+SPILL_FORMATS = {"feather": ("arrow", "ipc"), "parquet": ("parquet", "parquet")}
+
+
+def spill_path(spill_dir, database, collection):
+    """Pick a new directory for a spilled result
+
+    Returns:
+        path (str): <spill_dir>/<database>.<collection>.<timestamp>.<id>
+    """
+
+    name = f"{database}.{collection}.{datetime.now():%Y%m%dT%H%M%S}.{uuid.uuid4().hex[:6]}"
+
+    return os.path.join(os.path.expanduser(spill_dir), name)
+
+
+def arrow_table(dataframe):
+    """Convert a DataFrame to an Arrow table, writing values Arrow can't represent (e.g. ObjectId) as strings"""
+
+    import pyarrow as pa
+
+    arrays = []
+    for name in dataframe.columns:
+        column = dataframe[name]
+        try:
+            arrays.append(pa.array(column, from_pandas=True))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            arrays.append(pa.array([None if value is None else str(value) for value in column], pa.string()))
+
+    return pa.Table.from_arrays(arrays, names=[str(name) for name in dataframe.columns])
+
+
+class SpillWriter:
+    """Write batches of a query result to a directory of columnar part files.
+        Note: each batch is written as its own part file (Arrow IPC or Parquet),
+        so only one batch is in memory at a time. Values Arrow can't represent
+        (e.g. ObjectId) are written as strings, and the part schemas are unified
+        when the writer is closed.
+    """
+
+    def __init__(self, path, format="feather", new_builder=None):
+        try:
+            # pyarrow is imported on first use, it's only needed to spill
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("Spilling results to disk needs pyarrow, install it with `pip install pyarrow`")
+
+        if format not in SPILL_FORMATS:
+            raise ValueError(f"Unknown spill format {format!r}, expected one of {', '.join(SPILL_FORMATS)}")
+
+        if os.path.exists(path) and os.listdir(path):
+            raise ValueError(f"The spill directory {path} already exists and isn't empty")
+
+        os.makedirs(path, exist_ok=True)
+
+        self.path = path
+        self.format = format
+        self.new_builder = new_builder
+        self.schemas = []
+        self.rows = 0
+        self.parts = {}
+        self.lock = threading.Lock()
+
+    def write(self, batch, partition=0):
+        """Write a batch of documents, or a DataFrame or Arrow table, as a new part file.
+            Parts are numbered per partition, so the files sort in partition order.
+
+        Args:
+            batch (list, DataFrame or Table): the rows to write
+            partition (int): the partition the batch belongs to, for parallel scans
+        """
+
+        import pyarrow as pa
+        from mongo_utils.frame_builder import FrameBuilder
+
+        if isinstance(batch, list):
+            builder = (self.new_builder or FrameBuilder)()
+            builder.append(batch)
+            batch = builder.to_frame()
+
+        table = batch if isinstance(batch, pa.Table) else arrow_table(batch)
+
+        if not table.num_rows:
+            return
+
+        with self.lock:
+            part = self.parts.get(partition, 0)
+            self.parts[partition] = part + 1
+
+        extension = SPILL_FORMATS[self.format][0]
+        part_path = os.path.join(self.path, f"part-{partition:04d}-{part:06d}.{extension}")
+
+        if self.format == "feather":
+            import pyarrow.feather as feather
+
+            # Uncompressed, so the files can be memory-mapped without copying
+            feather.write_feather(table, part_path, compression="uncompressed")
+        else:
+            import pyarrow.parquet as pq
+
+            pq.write_table(table, part_path)
+
+        with self.lock:
+            self.schemas.append(table.schema)
+            self.rows += table.num_rows
+
+    def close(self):
+        """Finish the spill
+
+        Returns:
+            result (SpilledResult): a lazy handle on the written files
+        """
+
+        return SpilledResult(self.path, self.format, self._unify_schemas(), self.rows)
+
+    def _unify_schemas(self):
+        import pyarrow as pa
+
+        types = {}
+        for schema in self.schemas:
+            for field in schema:
+                types.setdefault(field.name, []).append(field)
+
+        fields = []
+        for name, column_fields in types.items():
+            try:
+                fields.append(pa.unify_schemas([pa.schema([field]) for field in column_fields],
+                                               promote_options="permissive").field(name))
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                # Columns whose type changes between batches are read back as strings
+                fields.append(pa.field(name, pa.string()))
+
+        return pa.schema(fields)
+
+
+class SpilledResult:
+    """A query result spilled to local disk, loaded lazily.
+        Note: feather (Arrow IPC) parts are memory-mapped, so reading columns
+        doesn't copy them into the kernel's memory. Use to_pandas() with
+        columns and a filter to load only what you need.
+    """
+
+    def __init__(self, path, format, schema, rows):
+        self.path = path
+        self.format = format
+        self.schema = schema
+        self.rows = rows
+
+    def __len__(self):
+        return self.rows
+
+    def __repr__(self):
+        return f"<SpilledResult {self.rows} rows, {len(self.schema)} columns, {self.format} at {self.path}>"
+
+    @property
+    def files(self):
+        extension = SPILL_FORMATS[self.format][0]
+
+        return sorted(os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith(extension))
+
+    @property
+    def bytes(self):
+        return sum(os.path.getsize(path) for path in self.files)
+
+    @property
+    def dataset(self):
+        """The spilled files as a pyarrow dataset, e.g. to scan with a filter"""
+
+        import pyarrow.dataset as ds
+        from pyarrow import fs
+
+        return ds.dataset(self.files, schema=self.schema, format=SPILL_FORMATS[self.format][1],
+                          filesystem=fs.LocalFileSystem(use_mmap=True))
+
+    def to_table(self, columns=None, filter=None):
+        """Load the result, or some of its columns and rows, as an Arrow table
+
+        Args:
+            columns (list): the columns to load, or None for all
+            filter (Expression): a pyarrow.dataset filter, e.g. pyarrow.dataset.field("age") > 30
+
+        Returns:
+            table (Table): the loaded rows
+        """
+
+        return self.dataset.to_table(columns=columns, filter=filter)
+
+    def to_pandas(self, columns=None, filter=None):
+        """Load the result, or some of its columns and rows, as a DataFrame. See to_table"""
+
+        return self.to_table(columns, filter).to_pandas()
+
+    def head(self, n=5):
+        return self.dataset.head(n).to_pandas()
+
+    def remove(self):
+        """Delete the spilled files"""
+
+        for path in self.files:
+            os.remove(path)
+
+        if not os.listdir(self.path):
+            os.rmdir(self.path)
@@ -1,14 +1,20 @@
 from argparse import ArgumentParser
-import ast
-import json
-import re
 from mongo_utils.mongo_api import MongoAPI
 
 
 class UserInputParser(ArgumentParser):
-    """A class to parse a user's line and cell magics from Jupyter."""
+    """A class to parse a user's line and cell magics from Jupyter.
+        Note: the argparse trees are built by the first instance and shared
+        by every later one in the process.
+    """
+
+    _shared_parsers = None
 
     def __init__(self, *args, **kwargs):
+        if UserInputParser._shared_parsers is not None:
+            self.__dict__.update(UserInputParser._shared_parsers)
+            return
+
         self.valid_commands = list(filter(lambda func: not func.startswith("_") and hasattr(getattr(MongoAPI, func),
                                                                                             "__call__"), dir(MongoAPI)))
         self.line_parser = ArgumentParser(prog=r"%mongo")
@@ -23,6 +29,8 @@ class UserInputParser(ArgumentParser):
             in your current connection")
         self.parser_show_databases.add_argument("-i", "--instance", required=True, help="the instance to run \
             the command against")
+        self.parser_show_databases.add_argument("--refresh", action="store_true", help="list the databases from \
+            the server instead of the metadata catalog")
 
         # Subparser for "show_collections"
         self.parser_show_collections = self.line_subparsers.add_parser("show_collections", help="Show the collections \
@@ -30,6 +38,60 @@ class UserInputParser(ArgumentParser):
         self.parser_show_collections.add_argument("-i", "--instance", required=True, help="the instance to run the \
             command against")
         self.parser_show_collections.add_argument("-d", "--database", required=True, help="the name of the database")
+        self.parser_show_collections.add_argument("--refresh", action="store_true", help="list the collections and \
+            their stats from the server instead of the metadata catalog")
+        self.parser_show_collections.add_argument("--no-stats", action="store_true", help="only list the names, \
+            without fetching each collection's size")
+
+        # Subparser for "indexes"
+        self.parser_indexes = self.line_subparsers.add_parser("indexes", help="List a collection's indexes with \
+            their size and usage")
+        self.parser_indexes.add_argument("-i", "--instance", required=True, help="the instance to run the command \
+            against")
+        self.parser_indexes.add_argument("-d", "--database", required=True, help="the name of the database")
+        self.parser_indexes.add_argument("-c", "--collection", required=True, help="the name of the collection")
+
+        # Subparser for "cache"
+        self.parser_cache = self.line_subparsers.add_parser("cache", help="Show or clear the cached query results")
+        self.parser_cache.add_argument("-i", "--instance", help="only show or clear the results of this instance")
+        self.parser_cache.add_argument("--clear", action="store_true", help="remove the cached results")
+
+        # Subparser for "jobs"
+        self.parser_jobs = self.line_subparsers.add_parser("jobs", help="Show the progress of background queries")
+
+        # Subparser for "cancel"
+        self.parser_cancel = self.line_subparsers.add_parser("cancel", help="Cancel a background query, killing its \
+            cursor on the server")
+        self.parser_cancel.add_argument("job_id", type=int, help="the id of the background query, see `%%mongo jobs`")
+
+        # Subparser for "stats"
+        self.parser_stats = self.line_subparsers.add_parser("stats", help="Show the timing breakdown and resource \
+            usage of recent queries")
+        self.parser_stats.add_argument("-n", "--last", type=int, default=20, help="the number of recent queries \
+            to list (default: 20)")
+        self.parser_stats.add_argument("--clear", action="store_true", help="clear the query history")
+        self.parser_stats.add_argument("--as", dest="result_name", help="the name of the notebook variable to bind \
+            every recorded query to, as a dataframe")
+
+        # Subparser for "insert_df"
+        self.parser_insert_df = self.line_subparsers.add_parser("insert_df", help="Write a dataframe from the \
+            notebook to a collection in batches")
+        self.parser_insert_df.add_argument("dataframe", help="the name of the notebook variable holding the dataframe")
+        self.parser_insert_df.add_argument("-i", "--instance", required=True, help="the instance to write to")
+        self.parser_insert_df.add_argument("-d", "--database", required=True, help="the name of the database")
+        self.parser_insert_df.add_argument("-c", "--collection", required=True, help="the name of the collection")
+        self.parser_insert_df.add_argument("-b", "--batch-size", type=int, help="the number of rows per insert_many \
+            or bulk_write batch (default: the find_batch_size opt)")
+        self.parser_insert_df.add_argument("--workers", type=int, default=4, help="the number of batches written \
+            at the same time, each on its own pooled connection (default: 4)")
+        self.parser_insert_df.add_argument("--upsert-on", help="comma separated fields identifying a document, \
+            e.g. _id. Each row then updates ($set) the matching document, or is inserted if there's none")
+        self.parser_insert_df.add_argument("--objectids", help="comma separated columns whose 24 character hex \
+            strings are written as ObjectIds, e.g. _id read back with the objectid_dtype opt set to string")
+        self.parser_insert_df.add_argument("-w", "--write-concern", dest="w", help="the write concern, e.g. 0, 1 \
+            or majority (default: the instance's)")
+        self.parser_insert_df.add_argument("-j", "--journal", action="store_true", help="wait for each batch to be \
+            written to the journal")
 
         # CELL SUBPARSERS #
         # Subparser for "find_one"
@@ -39,6 +101,9 @@ class UserInputParser(ArgumentParser):
         self.parser_find_one.add_argument("-d", "--database", required=True, help="the name of the database that \
             contains the collection")
         self.parser_find_one.add_argument("-c", "--collection", required=True, help="the name of the collection")
+        self._add_pushdown_arguments(self.parser_find_one, cursor=False)
+        self._add_flatten_arguments(self.parser_find_one)
+        self._add_cache_arguments(self.parser_find_one)
 
         # Subparser for "find"
         self.parser_find = self.cell_subparsers.add_parser("find", help="Query the collection")
@@ -46,6 +111,74 @@ class UserInputParser(ArgumentParser):
         self.parser_find.add_argument("-d", "--database", required=True, help="the name of the database that contains \
             the collection")
         self.parser_find.add_argument("-c", "--collection", required=True, help="the name of the collection to query")
+        self._add_pushdown_arguments(self.parser_find)
+        self.parser_find.add_argument("-r", "--raw", action="store_true", help="fetch raw BSON batches and decode \
+            them in bulk (into Arrow columns if pymongoarrow is installed)")
+        self.parser_find.add_argument("--parallel", type=int, help="split the collection into this many key ranges \
+            and fetch them concurrently")
+        self.parser_find.add_argument("--partition-key", help="the field to split the collection on for --parallel \
+            (default: _id)")
+        self.parser_find.add_argument("--incremental", nargs="?", const="_id", metavar="FIELD", help="keep the \
+            --as result and, when the cell is re-run, only fetch and append the documents whose FIELD (default: \
+            _id) is past the highest value fetched so far. For append-only collections")
+        self.parser_find.add_argument("--follow", action="store_true", help="with --incremental, keep appending \
+            inserted documents from a change stream in the background, until `%%mongo cancel`")
+        self._add_flatten_arguments(self.parser_find)
+        self._add_dtype_arguments(self.parser_find)
+        self._add_spill_arguments(self.parser_find)
+        self._add_preview_arguments(self.parser_find)
+        self._add_guardrail_arguments(self.parser_find)
+        self._add_cache_arguments(self.parser_find)
+        self._add_background_arguments(self.parser_find)
+
+        # Subparser for "aggregate"
+        self.parser_aggregate = self.cell_subparsers.add_parser("aggregate", help="Run an aggregation pipeline \
+            against the collection")
+        self.parser_aggregate.add_argument("-i", "--instance", required=True, help="the instance to run the command \
+            against")
+        self.parser_aggregate.add_argument("-d", "--database", required=True, help="the name of the database that \
+            contains the collection")
+        self.parser_aggregate.add_argument("-c", "--collection", required=True, help="the name of the collection to \
+            aggregate")
+        self.parser_aggregate.add_argument("--allow-disk-use", action="store_true", help="allow pipeline stages to \
+            write temporary data to disk on the server")
+        self.parser_aggregate.add_argument("-b", "--batch-size", type=int, help="the number of documents to pull from \
+            the cursor per batch while building the result")
+        self.parser_aggregate.add_argument("--max-time-ms", type=int, help="the time limit (in milliseconds) for the \
+            pipeline on the server")
+        self.parser_aggregate.add_argument("-r", "--raw", action="store_true", help="fetch raw BSON batches and \
+            decode them in bulk (into Arrow columns if pymongoarrow is installed)")
+        self._add_flatten_arguments(self.parser_aggregate)
+        self._add_dtype_arguments(self.parser_aggregate)
+        self._add_spill_arguments(self.parser_aggregate)
+        self._add_preview_arguments(self.parser_aggregate)
+        self._add_guardrail_arguments(self.parser_aggregate)
+        self._add_cache_arguments(self.parser_aggregate)
+        self._add_background_arguments(self.parser_aggregate)
+
+        # Subparser for "export"
+        self.parser_export = self.cell_subparsers.add_parser("export", help="Stream the results of a query to a \
+            local csv, jsonl or parquet file, without building a dataframe")
+        self.parser_export.add_argument("-i", "--instance", required=True, help="the instance to run the command \
+            against")
+        self.parser_export.add_argument("-d", "--database", required=True, help="the name of the database that \
+            contains the collection")
+        self.parser_export.add_argument("-c", "--collection", required=True, help="the name of the collection to \
+            query")
+        self.parser_export.add_argument("-o", "--output", required=True, help="the file to write, e.g. \
+            events.csv.gz. The format and compression are picked from its extension unless they're given")
+        self.parser_export.add_argument("--format", choices=["csv", "jsonl", "parquet"], help="the file format")
+        self.parser_export.add_argument("--compression", choices=["none", "gzip", "bz2", "xz", "snappy", "zstd",
+                                                                  "brotli", "lz4"], help="gzip, bz2 or xz for csv \
+            and jsonl (none by default), snappy (the default), gzip, zstd, brotli, lz4 or none for parquet")
+        self.parser_export.add_argument("--chunk-size", type=int, help="the number of rows per parquet row group, \
+            or per write to a csv or jsonl file. Defaults to the batch size")
+        self.parser_export.add_argument("--overwrite", action="store_true", help="replace the file if it exists")
+        self._add_pushdown_arguments(self.parser_export)
+        self._add_flatten_arguments(self.parser_export)
+        self._add_background_arguments(self.parser_export)
+        # The result is the file, so there's nothing to cache
+        self.parser_export.set_defaults(no_cache=True)
 
         # Subparser for "count_documents"
         self.parser_count_documents = self.cell_subparsers.add_parser("count_documents", help="Count the number of \
@@ -54,41 +187,291 @@ class UserInputParser(ArgumentParser):
             command against")
         self.parser_count_documents.add_argument("-d", "--database", required=True, help="the name of the database")
         self.parser_count_documents.add_argument("-c", "--collection", required=True, help="the name of the collection")
+        self.parser_count_documents.add_argument("--estimate", action="store_true", help="read the count from the \
+            collection metadata instead of scanning it. Only for unfiltered counts ({}), which use it by default")
+        self.parser_count_documents.add_argument("--exact", action="store_true", help="count an unfiltered \
+            collection by scanning it, e.g. when the metadata may be off after an unclean shutdown or on a \
+            sharded cluster with orphaned documents")
+        self.parser_count_documents.add_argument("--skip", type=int, help="the number of matching documents to skip")
+        self.parser_count_documents.add_argument("--limit", type=int, help="stop counting after this many matching \
+            documents")
+        self.parser_count_documents.add_argument("--hint", help="the name of the index to count with, e.g. ts_-1")
+        self.parser_count_documents.add_argument("--max-time-ms", type=int, help="the time limit (in milliseconds) \
+            for the count on the server")
+        self._add_cache_arguments(self.parser_count_documents)
+
+        # Subparser for "distinct"
+        self.parser_distinct = self.cell_subparsers.add_parser("distinct", help="List the distinct values of a \
+            field, computed on the server")
+        self.parser_distinct.add_argument("field", help="the field, dotted paths allowed")
+        self.parser_distinct.add_argument("-i", "--instance", required=True, help="the instance to run the command \
+            against")
+        self.parser_distinct.add_argument("-d", "--database", required=True, help="the name of the database")
+        self.parser_distinct.add_argument("-c", "--collection", required=True, help="the name of the collection")
+        self.parser_distinct.add_argument("--limit", type=int, help="only return the first N values, in sort order")
+        self.parser_distinct.add_argument("--max-time-ms", type=int, help="the time limit (in milliseconds) for the \
+            command on the server")
+        self._add_cache_arguments(self.parser_distinct)
+
+        # Subparser for "value_counts"
+        self.parser_value_counts = self.cell_subparsers.add_parser("value_counts", help="Count the documents \
+            holding each value of a field, computed on the server")
+        self.parser_value_counts.add_argument("field", help="the field, dotted paths allowed")
+        self.parser_value_counts.add_argument("-i", "--instance", required=True, help="the instance to run the \
+            command against")
+        self.parser_value_counts.add_argument("-d", "--database", required=True, help="the name of the database")
+        self.parser_value_counts.add_argument("-c", "--collection", required=True, help="the name of the collection")
+        self.parser_value_counts.add_argument("--top", type=int, help="only return the N most frequent values")
+        self.parser_value_counts.add_argument("--unwind", action="store_true", help="count the elements of array \
+            values one by one, instead of each array as a whole")
+        self.parser_value_counts.add_argument("--allow-disk-use", action="store_true", help="allow the grouping to \
+            write temporary data to disk on the server, for fields with many values")
+        self.parser_value_counts.add_argument("--max-time-ms", type=int, help="the time limit (in milliseconds) for \
+            the aggregation on the server")
+        self._add_guardrail_arguments(self.parser_value_counts)
+        self._add_cache_arguments(self.parser_value_counts)
+
+        # Subparser for "explain"
+        self.parser_explain = self.cell_subparsers.add_parser("explain", help="Show how the server runs a find, \
+            count_documents or aggregate, and warn about collection scans")
+        self.parser_explain.add_argument("explained_command", choices=["find", "count_documents", "aggregate"],
+                                         help="the command to explain")
+        self.parser_explain.add_argument("-i", "--instance", required=True, help="the instance to run the command \
+            against")
+        self.parser_explain.add_argument("-d", "--database", required=True, help="the name of the database that \
+            contains the collection")
+        self.parser_explain.add_argument("-c", "--collection", required=True, help="the name of the collection")
+        self.parser_explain.add_argument("--verbosity", choices=["queryPlanner", "executionStats", "allPlansExecution"],
+                                         default="executionStats", help="queryPlanner only plans the query, \
+                                         executionStats (the default) also runs it")
+        self._add_pushdown_arguments(self.parser_explain, cursor=False)
+        self.parser_explain.add_argument("--limit", type=int, help="the maximum number of documents to return")
+        self.parser_explain.add_argument("--allow-disk-use", action="store_true", help="allow pipeline stages to \
+            write temporary data to disk on the server")
+        # Plans change as indexes are built, so they aren't cached
+        self.parser_explain.set_defaults(no_cache=True)
+
+        UserInputParser._shared_parsers = dict(self.__dict__)
+
+    def _add_cache_arguments(self, parser):
+        """Add the options that control the query result cache
+
+        Args:
+            parser (ArgumentParser): the subparser to add the options to
+        """
+
+        parser.add_argument("--no-cache", action="store_true", help="don't read or store this result in the cache")
+        parser.add_argument("--refresh", action="store_true", help="re-run the query and replace the cached result")
+
+    def _add_background_arguments(self, parser):
+        """Add the options that run a query in the background
+
+        Args:
+            parser (ArgumentParser): the subparser to add the options to
+        """
+
+        parser.add_argument("--background", action="store_true", help="run the query in a background thread and \
+            return right away. The result is bound to the --as variable when it finishes")
+        parser.add_argument("--as", dest="result_name", help="the name of the notebook variable to bind the result to")
+
+    def _add_flatten_arguments(self, parser):
+        """Add the options that flatten nested documents into dotted-path columns
+
+        Args:
+            parser (ArgumentParser): the subparser to add the options to
+        """
+
+        parser.add_argument("--flatten", nargs="?", type=int, const=0, metavar="DEPTH", help="expand sub-documents \
+            into dotted-path columns, e.g. address.city, up to DEPTH levels deep (default: all). Combine with \
+            --fields address.city,... to only fetch and build those paths")
+        parser.add_argument("--arrays", choices=["keep", "join", "explode"], help="with --flatten, keep arrays as \
+            lists (the default), join them into comma separated strings, or explode them into a row per element")
+
+    def _add_dtype_arguments(self, parser):
+        """Add the options that control how column dtypes are picked
+
+        Args:
+            parser (ArgumentParser): the subparser to add the options to
+        """
+
+        parser.add_argument("--no-infer-dtypes", action="store_true", help="keep the values as Python objects \
+            instead of compact dtypes (categoricals, int32, float32, ...), see the infer_dtypes opt")
+
+    def _add_spill_arguments(self, parser):
+        """Add the options that write a result to local disk instead of memory
+
+        Args:
+            parser (ArgumentParser): the subparser to add the options to
+        """
+
+        parser.add_argument("--spill", nargs="?", const=True, metavar="PATH", help="write the result to local disk \
+            (in the spill_dir opt, or PATH) and return a lazily loaded handle instead of a dataframe")
+        parser.add_argument("--spill-format", choices=["feather", "parquet"], help="the file format to spill to. \
+            feather (the default) is memory-mapped when read, parquet is smaller on disk")
+
+    def _add_preview_arguments(self, parser):
+        """Add the option that fetches a result a page at a time, as it's looked at
+
+        Args:
+            parser (ArgumentParser): the subparser to add the option to
+        """
+
+        parser.add_argument("--preview", nargs="?", type=int, const=20, metavar="PAGE_SIZE", help="show the first \
+            page (20 documents by default) and bind a handle on the open cursor that fetches the next pages on \
+            demand, instead of fetching the whole result")
+
+    def _add_guardrail_arguments(self, parser):
+        """Add the options that lift the result size budgets, or check them before the query runs
+
+        Args:
+            parser (ArgumentParser): the subparser to add the option to
+        """
+
+        parser.add_argument("--no-guardrails", action="store_true", help="don't check the result size before the \
+            query runs, or abort it once it's over the max_result_docs or max_result_mb opts")
+        parser.add_argument("--preflight", action="store_true", help="count the documents a find matches before \
+            it runs, and refuse it if they're over the max_result_docs or max_result_mb opts, see the preflight_count \
+            opt. Without it, the budgets are only enforced as the result streams")
+
+    def _add_pushdown_arguments(self, parser, cursor=True):
+        """Add the options that are pushed down to the server with a query
+
+        Args:
+            parser (ArgumentParser): the subparser to add the options to
+            cursor (bool): whether the command returns a cursor, i.e. also
+                accepts --limit and --batch-size
+        """
+
+        parser.add_argument("--fields", help="comma separated fields to return (projection), dotted paths allowed. \
+            Use field:0 to exclude a field, e.g. name,address.city,_id:0. A leading - also excludes it, but then the \
+            value has to be attached with =, e.g. --fields=-_id")
+        parser.add_argument("--sort", help="comma separated fields to sort by. Use field:-1 to sort descending, \
+            e.g. ts:-1,name. A leading - also sorts descending, but then the value has to be attached with =, \
+            e.g. --sort=-ts")
+        parser.add_argument("--skip", type=int, help="the number of documents to skip")
+        parser.add_argument("--hint", help="the name of the index to use, e.g. ts_-1")
+        parser.add_argument("--max-time-ms", type=int, help="the time limit (in milliseconds) for the query \
+            on the server")
+
+        if cursor:
+            parser.add_argument("--limit", type=int, help="the maximum number of documents to return")
+            parser.add_argument("-b", "--batch-size", type=int, help="the number of documents to pull from the \
+                cursor per batch while building the result")
+
+    def transform_pushdown(self, parsed_command):
+        """Turn the user's pushdown options into the structures pymongo expects
+
+        Args:
+            parsed_command (dict): the parsed command from argparse
+
+        Returns:
+            parsed_command (dict): the same dict, with "fields" turned into a
+                projection dict and "sort" into a list of (field, direction)
+        """
+
+        fields = parsed_command.get("fields")
+        if fields:
+            parsed_command["fields"] = dict(self._split_field_spec(fields, off=0))
+
+        sort = parsed_command.get("sort")
+        if sort:
+            parsed_command["sort"] = self._split_field_spec(sort, off=-1)
+
+        return parsed_command
+
+    def _split_field_spec(self, spec, off):
+        """Split "a,b:-1,-c" style field specs into (field, value) pairs.
+            A field is "on" (1) unless it's suffixed with :<off> or prefixed with -
+
+        Args:
+            spec (str): the comma separated field spec
+            off (int): the value for fields that are switched off
+
+        Returns:
+            pairs (list): a list of (field, value) tuples
+        """
+
+        pairs = []
+
+        for field in map(str.strip, spec.split(",")):
+            if not field:
+                continue
+
+            value = 1
+            if field.startswith("-"):
+                field, value = field[1:], off
+            elif ":" in field:
+                field, value = field.rsplit(":", 1)
+                value = int(value)
+
+            pairs.append((field, value))
+
+        return pairs
 
     def display_help(self, command):
         self.parser.parse_args([command], "--help")
 
     def transform_query(self, query):
-        r"""Split a user-supplied Mongo query string into a list
-            of JSON objects to be passed to pymongo commands as
-            parameterized args.
-
-            Regex pattern explanation: r"\}\s{0,}\,\s{0,}\{"
-            -- Positive Lookbehind (?<=\})
-                -- \} matches the character } literally (case sensitive)
-                -- \s matches any whitespace character (equivalent to [\r\n\t\f\v ])
-                -- {0,} matches the previous token between zero and unlimited times, as many times as possible
-                -- \, matches the character , literally (case sensitive)
-                -- \s matches any whitespace character (equivalent to [\r\n\t\f\v ])
-                -- {0,} matches the previous token between zero and unlimited times, as many times as possible
-            -- Positive Lookahead (?=\{)
-                -- \{ matches the character { literally (case sensitive)
+        """Parse a user-supplied Mongo query string into a list
+            of arguments to be passed to pymongo commands as
+            parameterized args, e.g. [filter, projection].
+            Note: see QueryParser for the accepted syntax, which
+            includes Mongo shell constructors and extended JSON
 
         Args:
             query (str): The user's query string
 
         Returns:
-            split_query (str): a list
+            split_query (list): a list of query arguments
         """
 
-        try:
-            split_query = re.split(r"(?<=\})\s{0,}\,\s{0,}(?=\{)", query)
-            split_query = list(map(lambda q: ast.literal_eval(json.loads(json.dumps(q))), split_query))
+        # The query parser (and bson) are imported on first use, to keep loading the extension fast
+        from mongo_utils.query_parser import parse_query
 
-            return split_query
+        split_query = parse_query(query)
 
-        except Exception:
-            raise
+        return split_query
+
+    def transform_pipeline(self, pipeline):
+        """Transform a user-supplied aggregation pipeline string into a list of stages.
+            The stages may be wrapped in [] or not, e.g. both of these work:
+            [{'$match': {'a': 1}}, {'$group': {'_id': '$b'}}]
+            {'$match': {'a': 1}}, {'$group': {'_id': '$b'}}
+
+        Args:
+            pipeline (str): The user's pipeline string
+
+        Returns:
+            stages (list): a list of pipeline stages
+        """
+
+        from mongo_utils.query_parser import parse_query
+
+        stages = parse_query(pipeline)
+
+        if len(stages) == 1 and isinstance(stages[0], list):
+            stages = list(stages[0])
+
+        return stages
+
+    def split_statements(self, input):
+        """Split a cell into its commands, each a command line followed by its query line.
+            Blank lines between commands are ignored.
+
+        Args:
+            input (str): the entire contents of the cell from Jupyter
+
+        Returns:
+            statements (list): the command and query line of each command, or
+                the cell as it was if it isn't made of command and query line pairs
+        """
+
+        lines = [line for line in input.strip().split("\n") if line.strip()]
+
+        if len(lines) <= 2 or len(lines) % 2:
+            return [input]
+
+        return ["\n".join(lines[i:i + 2]) for i in range(0, len(lines), 2)]
 
     def parse_input(self, input, type):
         """Parses the user's line magic from Jupyter
@@ -144,16 +527,21 @@ class UserInputParser(ArgumentParser):
                     parsed_user_query = split_user_input[1]
 
                     # Transform the user's query into a list of JSON objects that
-                    # can be unpacked args like pymongo expects
-                    split_user_query = self.transform_query(parsed_user_query)
-
-                    parsed_input["input"].update(vars(parsed_user_command))
+                    # can be unpacked args like pymongo expects, or into the list
+                    # of stages for an aggregation pipeline
+                    if "aggregate" in (parsed_user_command.command, vars(parsed_user_command).get("explained_command")):
+                        split_user_query = self.transform_pipeline(parsed_user_query)
+                    else:
+                        split_user_query = self.transform_query(parsed_user_query)
+
+                    parsed_input["input"].update(self.transform_pushdown(vars(parsed_user_command)))
                     parsed_input["input"].update({"query": split_user_query})
 
                 else:
                     parsed_input["error"] = True
                     parsed_input["message"] = f"Expected to get 2 lines in your cell magic, \
-                        but got {len(split_user_input)}. Try `--help` or `-h`"
+                        but got {len(split_user_input)}. To run several commands in one cell, give each \
+                        a command line and a query line. Try `--help` or `-h`"
 
             except SystemExit:
                 parsed_input["error"] = True
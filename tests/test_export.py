@@ -0,0 +1,36 @@
+import csv
+import pytest
+from mongo_utils.export import export_writer
+
+
+def test_parquet_columns_are_widened_by_later_chunks(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = tmp_path / "events.parquet"
+
+    writer = export_writer(str(path), chunk_size=2)
+    writer.consume([[{"a": 1, "b": None}, {"a": 2, "b": None}],
+                    [{"a": 2.5, "b": None}, {"a": 3, "b": None}],
+                    [{"a": 4, "b": 7}, {"a": 5, "b": 8}]])
+    summary = writer.close()
+
+    table = pq.read_table(str(path))
+
+    assert summary["rows"] == 6
+    assert str(table.schema.field("a").type) == "double"
+    assert str(table.schema.field("b").type) == "int64"
+    assert table.column("a").to_pylist() == [1, 2, 2.5, 3, 4, 5]
+    assert table.column("b").to_pylist() == [None, None, None, None, 7, 8]
+    assert [entry.name for entry in tmp_path.iterdir()] == ["events.parquet"]
+
+
+def test_csv_columns_that_appear_later_are_reported(tmp_path):
+    path = tmp_path / "events.csv"
+
+    writer = export_writer(str(path), chunk_size=1)
+    writer.consume([[{"a": 1}], [{"a": 2, "late": "x"}]])
+    writer.close()
+
+    with open(path) as file:
+        assert list(csv.DictReader(file)) == [{"a": "1"}, {"a": "2"}]
+
+    assert "late" in writer.warnings[0]
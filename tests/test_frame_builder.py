@@ -0,0 +1,46 @@
+import pandas as pd
+import pytest
+from mongo_utils.frame_builder import TypedFrameBuilder
+
+
+def build(*batches):
+    builder = TypedFrameBuilder()
+    for batch in batches:
+        builder.append(batch)
+
+    return builder.to_frame()
+
+
+def values(column):
+    return [None if pd.isna(value) else value for value in column]
+
+
+@pytest.mark.parametrize("batches, expected", [
+    # int -> float
+    ([[{"v": 1}, {"v": 2}], [{"v": 3}, {"v": 4}], [{"v": 5.5}, {"v": 6.5}]], [1, 2, 3, 4, 5.5, 6.5]),
+    # category -> string
+    ([[{"v": "a"}] * 4, [{"v": "b"}] * 4, [{"v": value} for value in "wxyz"]],
+     ["a"] * 4 + ["b"] * 4 + list("wxyz")),
+    # int -> object
+    ([[{"v": 1}, {"v": 2}], [{"v": 3}, {"v": 4}], [{"v": "x"}, {"v": [1]}]], [1, 2, 3, 4, "x", [1]]),
+])
+def test_promotion_across_batches_keeps_every_row(batches, expected):
+    dataframe = build(*batches)
+
+    assert len(dataframe) == len(expected)
+    assert values(dataframe["v"]) == expected
+
+
+@pytest.mark.parametrize("first, promoting_batch, promoted", [
+    (1, [{"v": 2.5}, {"v": 3.5}], [2.5, 3.5]),
+    ("a", [{"v": "x"}, {"v": "y"}], ["x", "y"]),
+    (1, [{"v": {"a": 1}}, {"v": [1]}], [{"a": 1}, [1]]),
+])
+def test_promotion_after_null_placeholders(first, promoting_batch, promoted):
+    # A batch without the column, and one where it's always None, leave placeholder chunks
+    dataframe = build([{"other": 1}, {"other": 2}], [{"v": first}, {"v": first}], [{"v": None}, {"v": None}],
+                      [{"other": 3}], promoting_batch)
+
+    assert len(dataframe) == 9
+    assert values(dataframe["v"]) == [None, None, first, first, None, None, None] + promoted
+    assert values(dataframe["other"]) == [1, 2, None, None, None, None, 3, None, None]
@@ -0,0 +1,47 @@
+import pytest
+from bson import ObjectId
+from mongo_utils.mongo_api import MongoAPI
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def collection():
+    collection = mongomock.MongoClient().db.events
+    collection.insert_many([{"_id": ObjectId(), "k": n} for n in range(40)] +
+                           [{"_id": f"legacy-{n}", "k": f"x{n}"} for n in range(5)] +
+                           [{"_id": n, "k": None} for n in range(5)] +
+                           [{"_id": 2.5}])
+    return collection
+
+
+def api(sample_size=100):
+    # The partitions are planned against the collection passed in, so there's no client to connect
+    api = MongoAPI.__new__(MongoAPI)
+    api.partition_sample_size = sample_size
+    return api
+
+
+def scan(api, collection, key):
+    results = api._find_parallel(collection, [{}], {"batch_size": 7}, 4, key)
+    return sorted(repr(document["_id"]) for stream in results.streams for batch in stream for document in batch)
+
+
+@pytest.mark.parametrize("key", ["_id", "k"])
+def test_partitions_cover_keys_of_every_type(collection, key):
+    assert scan(api(), collection, key) == sorted(repr(document["_id"]) for document in collection.find())
+
+
+def test_keys_of_other_types_than_the_sampled_bounds_are_kept(collection, monkeypatch):
+    # A sample that only drew ObjectIds
+    ids = sorted(document["_id"] for document in collection.find({"_id": {"$type": "objectId"}}))
+    partitioned = api()
+    monkeypatch.setattr(partitioned, "_partition_bounds", lambda *args: [ids[10], ids[20], ids[30]])
+
+    assert scan(partitioned, collection, "_id") == sorted(repr(document["_id"]) for document in collection.find())
+
+
+def test_bounds_are_picked_among_the_most_common_type(collection):
+    bounds = api()._partition_bounds(collection, "_id", 4)
+
+    assert len(bounds) == 3 and all(isinstance(bound, ObjectId) for bound in bounds)
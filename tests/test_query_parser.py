@@ -0,0 +1,46 @@
+import re
+import time
+from datetime import datetime
+from bson import ObjectId
+from mongo_utils.query_parser import parse_query
+
+
+def test_filter_and_projection_are_split_on_the_top_level_comma():
+    assert parse_query("{'status': 'active'}, {'name': 1, '_id': 0}") == [{"status": "active"}, {"name": 1, "_id": 0}]
+
+
+def test_commas_and_braces_inside_strings_and_arrays_are_kept():
+    query = "{'note': 'a}, {b', '$or': [{'a': 1}, {'b': 2}]}, {'note': 1}"
+
+    assert parse_query(query) == [{"note": "a}, {b", "$or": [{"a": 1}, {"b": 2}]}, {"note": 1}]
+
+
+def test_quotes_inside_strings():
+    assert parse_query("""{"name": "O'Brien", 'quote': 'say "hi"', 'escaped': 'it\\'s'}""") == \
+        [{"name": "O'Brien", "quote": 'say "hi"', "escaped": "it's"}]
+
+
+def test_extended_json():
+    query = '{"_id": {"$oid": "5f1d7f3b9d1e8a0001a1b2c3"}, "ts": {"$gte": {"$date": "2024-01-01T00:00:00Z"}}, ' \
+            '"name": {"$regex": "^jo", "$options": "i"}}'
+
+    parsed = parse_query(query)[0]
+
+    assert parsed["_id"] == ObjectId("5f1d7f3b9d1e8a0001a1b2c3")
+    assert parsed["ts"]["$gte"].replace(tzinfo=None) == datetime(2024, 1, 1)
+    assert parsed["name"].pattern == "^jo" and parsed["name"].flags & re.IGNORECASE
+
+
+def test_zero_argument_constructors_are_evaluated_on_every_parse():
+    first = parse_query("{'_id': ObjectId(), 'ts': {'$gt': ISODate()}}")[0]
+    time.sleep(0.002)
+    second = parse_query("{'_id': ObjectId(), 'ts': {'$gt': ISODate()}}")[0]
+
+    assert first["_id"] != second["_id"]
+    assert first["ts"]["$gt"] < second["ts"]["$gt"]
+
+
+def test_constant_queries_are_memoized():
+    query = "{'_id': ObjectId('5f1d7f3b9d1e8a0001a1b2c3'), 'ts': ISODate('2024-01-01T00:00:00Z')}"
+
+    assert parse_query(query)[0] is parse_query(query)[0]
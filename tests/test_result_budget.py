@@ -0,0 +1,69 @@
+import bson
+import pytest
+from mongo_utils.cursor_stream import CursorStream, ResultTooLarge
+from mongo_utils.mongo_api import MongoAPI
+
+pa = pytest.importorskip("pyarrow")
+
+
+def api():
+    # The budget doesn't touch the server, so there's no client to connect
+    return MongoAPI.__new__(MongoAPI)
+
+
+def test_arrow_table_under_the_budget_is_returned():
+    table = pa.table({"n": list(range(10))})
+
+    assert api()._apply_budget(table, max_result_docs=100, max_result_bytes=1024 * 1024) is table
+
+
+def test_arrow_table_over_the_budget_is_refused():
+    table = pa.table({"n": list(range(10))})
+
+    with pytest.raises(ResultTooLarge):
+        api()._apply_budget(table, max_result_docs=5)
+
+    with pytest.raises(ResultTooLarge):
+        api()._apply_budget(table, max_result_bytes=8)
+
+
+class Cursor:
+    def __init__(self, documents):
+        self.documents = iter(documents)
+        self.closed = False
+
+    def __iter__(self):
+        return self.documents
+
+    def close(self):
+        self.closed = True
+
+
+def test_stream_is_charged_as_it_streams():
+    cursor = Cursor({"n": n} for n in range(10))
+    stream = api()._apply_budget(CursorStream(cursor, 4), max_result_docs=6)
+
+    with pytest.raises(ResultTooLarge):
+        list(stream)
+
+    assert cursor.closed
+
+
+def test_stream_is_charged_its_measured_size():
+    # No collection stats or document size is passed, as for views and projected finds
+    cursor = Cursor({"n": n, "text": "x" * 1000} for n in range(100))
+    stream = api()._apply_budget(CursorStream(cursor, 10), max_result_bytes=50 * 1024)
+
+    with pytest.raises(ResultTooLarge):
+        list(stream)
+
+    assert cursor.closed
+    assert stream.documents == 60
+
+
+def test_projected_stream_under_the_byte_budget_is_returned():
+    cursor = Cursor({"n": n} for n in range(100))
+    stream = api()._apply_budget(CursorStream(cursor, 10), max_result_bytes=50 * 1024)
+
+    assert sum(len(batch) for batch in stream) == 100
+    assert stream.budget.bytes == sum(len(bson.encode({"n": n})) for n in range(100))